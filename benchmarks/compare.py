@@ -0,0 +1,37 @@
+import json
+import argparse
+
+def flatten(results, prefix=''):
+    '''
+    Flatten nested results to {'name.key': number}
+    '''
+    flat = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[prefix + k] = v
+    return flat
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('base', help='JSON results to compare against')
+    parser.add_argument('new', help='JSON results to compare')
+    parser.add_argument('--all', action='store_true', help='Include per action step latency')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f'base: {base["commit"]}  new: {new["commit"]}')
+
+    base_flat = flatten(base['results'])
+    new_flat = flatten(new['results'])
+    for key in sorted(base_flat.keys() & new_flat.keys()):
+        if not args.all and '.step_latency.' in key:
+            continue
+        b = base_flat[key]
+        n = new_flat[key]
+        ratio = f'{n / b:.3f}x' if b else '-'
+        print(f'{key:60s} {b:14.4f} {n:14.4f} {ratio:>9s}')
@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import gym
+import gym_coup
+from gym_coup.envs.coup_env import VALID_ACTIONS_BY_MASK
+from coup_rl.qtable import QTable
+from coup_rl.agent import Agent
+from coup_rl.self_play import play_game
+from coup_rl.utils import convert_obs_to_q_index, convert_obs_to_state_offset
+
+# Default QTable shape, as created by SelfPlay
+SHAPE = (15, 15, 4, 4, 13, 13, 26)
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of this process in MB
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def random_action(env, rng):
+    valid_actions = VALID_ACTIONS_BY_MASK[env.get_valid_action_mask(bitmask=True)]
+    return valid_actions[rng.integers(len(valid_actions))]
+
+def play_random_game(env, rng):
+    '''
+    Play one game with random valid actions
+    Returns the list of (action, step time)
+    '''
+    env.reset()
+    steps = []
+    done = False
+    while not done:
+        action = random_action(env, rng)
+        start = time.perf_counter()
+        _, _, done, _ = env.step(action)
+        steps.append((action, time.perf_counter() - start))
+    return steps
+
+def bench_random_games(games, seed):
+    '''
+    Games per second, steps per second and step latency by action with a random policy
+    '''
+    env_seed, action_seed = np.random.SeedSequence(seed).spawn(2)
+    env = gym.make('coup-v0')
+    env.seed(env_seed)
+    rng = np.random.default_rng(action_seed)
+    step_times = {}
+    num_steps = 0
+    start = time.perf_counter()
+    for _ in range(games):
+        for action, t in play_random_game(env, rng):
+            step_times.setdefault(action, []).append(t)
+            num_steps += 1
+    elapsed = time.perf_counter() - start
+
+    latency = {}
+    for action, times in sorted(step_times.items()):
+        latency[env.actions[action]] = {'count': len(times),
+                                        'mean_us': float(np.mean(times)) * 1e6,
+                                        'p99_us': float(np.percentile(times, 99)) * 1e6}
+    return {'games': games,
+            'games_per_sec': games / elapsed,
+            'steps_per_sec': num_steps / elapsed,
+            'step_latency': latency}
+
+def bench_agent_games(games, seed, epsilon):
+    '''
+    Games per second of two learning Agents sharing a new QTable
+    epsilon 0 is a fully greedy policy
+    '''
+    env_seed, p1_seed, p2_seed = np.random.SeedSequence(seed).spawn(3)
+    env = gym.make('coup-v0')
+    env.seed(env_seed)
+    qtable = QTable(SHAPE, 0.1, 0.9, epsilon)
+    p1 = Agent(1, env, qtable, rng=np.random.default_rng(p1_seed))
+    p2 = Agent(2, env, qtable, rng=np.random.default_rng(p2_seed))
+    start = time.perf_counter()
+    for _ in range(games):
+        env.reset()
+        play_game(env, p1, p2)
+    elapsed = time.perf_counter() - start
+    return {'games': games,
+            'epsilon': epsilon,
+            'games_per_sec': games / elapsed}
+
+def bench_lookups(games, seed):
+    '''
+    Per call time of the functions on the agent's hot path,
+    over the states seen in random games
+    '''
+    env_seed, action_seed, table_seed = np.random.SeedSequence(seed).spawn(3)
+    env = gym.make('coup-v0')
+    env.seed(env_seed)
+    rng = np.random.default_rng(action_seed)
+    qtable = QTable(SHAPE, 0.1, 0.9, 0.1)
+    qtable.table[...] = np.random.default_rng(table_seed).random(SHAPE)
+
+    # Record observations and valid actions at every step
+    records = []
+    for _ in range(games):
+        env.reset()
+        done = False
+        while not done:
+            mask = env.get_valid_action_mask(bitmask=True)
+            records.append((env.get_obs(), mask))
+            action = random_action(env, rng)
+            _, _, done, _ = env.step(action)
+    obs_list = [o for o, _ in records]
+    stored = [(convert_obs_to_state_offset(o), np.array([a for a in VALID_ACTIONS_BY_MASK[m] if a < 26]))
+              for o, m in records]
+    stored = [(s, a) for s, a in stored if len(a)]
+    ind_tpls = [[tuple(convert_obs_to_q_index(o)) + (a,) for a in acts] for o, (_, acts) in zip(obs_list, stored)]
+
+    def per_call(fn, items):
+        start = time.perf_counter()
+        for x in items:
+            fn(x)
+        return (time.perf_counter() - start) / len(items) * 1e6
+
+    # The env is left at the end of the last game, so time valid actions on a fresh game
+    env.reset()
+    n = len(records)
+    return {'calls': n,
+            'get_valid_actions_us': per_call(lambda _: env.get_valid_actions(), range(n)),
+            'get_obs_us': per_call(lambda _: env.get_obs(), range(n)),
+            'convert_obs_to_q_index_us': per_call(convert_obs_to_q_index, obs_list),
+            'convert_obs_to_state_offset_us': per_call(convert_obs_to_state_offset, obs_list),
+            'get_max_ind_us': per_call(qtable.get_max_ind, ind_tpls),
+            'get_best_action_us': per_call(lambda x: qtable.get_best_action(*x), stored)}
+
+def bench_table_io(seed):
+    '''
+    Save and load time and file size of a default shape table,
+    compressed and uncompressed, and memory mapped loading
+    '''
+    rng = np.random.default_rng(seed)
+    qtable = QTable(SHAPE, 0.1, 0.9, 0.1)
+    # About 10% of cells visited, like a partly trained agent
+    flat = qtable.table.reshape(-1)
+    visited = rng.random(flat.shape) < 0.1
+    flat[visited] = rng.standard_normal(np.count_nonzero(visited))
+
+    results = {'nbytes': qtable.table.nbytes}
+    with tempfile.TemporaryDirectory() as tmp:
+        for compress in [True, False]:
+            name = 'compressed' if compress else 'uncompressed'
+            filename = os.path.join(tmp, name + '.npz')
+            start = time.perf_counter()
+            qtable.save(filename, compress=compress)
+            save_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            QTable().load(filename)
+            load_time = time.perf_counter() - start
+
+            results[name] = {'save_sec': save_time,
+                             'load_sec': load_time,
+                             'file_mb': os.path.getsize(filename) / 2**20}
+            if not compress:
+                start = time.perf_counter()
+                QTable().load(filename, mmap_mode='r')
+                results[name]['mmap_load_sec'] = time.perf_counter() - start
+    return results
+
+def bench_table_memory():
+    '''
+    Peak memory to create a default shape table
+    '''
+    before = peak_rss_mb()
+    qtable = QTable(SHAPE, 0.1, 0.9, 0.1)
+    # Touch every page so it is resident
+    qtable.table[...] = 0.0
+    return {'nbytes': qtable.table.nbytes,
+            'peak_rss_before_mb': before}
+
+BENCHMARKS = {
+    'random_games':   lambda args: bench_random_games(args.games, args.seed),
+    'greedy_games':   lambda args: bench_agent_games(args.games, args.seed, 0.0),
+    'training_games': lambda args: bench_agent_games(args.games, args.seed, 0.1),
+    'lookups':        lambda args: bench_lookups(max(args.games // 10, 1), args.seed),
+    'table_io':       lambda args: bench_table_io(args.seed),
+    'table_memory':   lambda args: bench_table_memory(),
+}
+
+def run_benchmark(name, args):
+    '''
+    Run a single benchmark. Called in a fresh process so peak RSS is its own
+    '''
+    result = BENCHMARKS[name](args)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def get_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coup RL benchmarks')
+    parser.add_argument('-o', '--output', help='Save results to this JSON file')
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS), help='Benchmarks to run. Default all')
+    parser.add_argument('-g', '--games', type=int, default=2000, help='Number of games for game benchmarks')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the games and tables')
+    args = parser.parse_args()
+
+    results = {'commit': get_commit(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'platform': platform.platform(),
+               'games': args.games,
+               'seed': args.seed,
+               'results': {}}
+
+    ctx = mp.get_context('spawn')
+    for name in args.benchmarks:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            result = executor.submit(run_benchmark, name, args).result()
+        results['results'][name] = result
+        print(f'{name}: ' + json.dumps({k: v for k, v in result.items() if not isinstance(v, dict)}))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -3,4 +3,9 @@ from gym.envs.registration import register
 register(
     id='coup-v0',
     entry_point='gym_coup.envs:CoupEnv',
+)
+
+register(
+    id='coup-batch-v0',
+    entry_point='gym_coup.envs:BatchCoupEnv',
 )
\ No newline at end of file
@@ -1 +1,3 @@
-from gym_coup.envs.coup_env import CoupEnv
\ No newline at end of file
+from gym_coup.envs.coup_env import CoupEnv
+from gym_coup.envs.batch_coup_env import BatchCoupEnv
+from gym_coup.envs.trajectory import TrajectoryWriter, TrajectoryReader, replay_episode
\ No newline at end of file
@@ -0,0 +1,525 @@
+import gym
+import numpy as np
+import logging
+from gym_coup.envs.coup_env import *
+
+logging.basicConfig()
+logger = logging.getLogger('gym_coup')
+
+_COINS_BUCKET = np.array([[get_coins_bucket(c, o) for o in range(13)] for c in range(13)])
+
+class BatchCoupEnv(gym.Env):
+    '''
+    Gym env that simulates many 2p Coup games at once
+
+    Games are stored as structure-of-arrays, and each call to step()
+    applies one vectorized transition to every game in the batch.
+    The game rules are the same as in Game. Finished games are reset
+    automatically after their final observation and reward are returned.
+    '''
+    metadata = {'render.modes': ['human']}
+
+    actions = CoupEnv.actions
+
+    def __init__(self, num_envs=1024, p_first_turn=0):
+        '''
+        num_envs:     Number of games to simulate at once
+        p_first_turn: Which player goes first in every game, 0-indexed
+        '''
+        self.num_envs = num_envs
+        self.p_first_turn = p_first_turn
+        self.rng = np.random.default_rng()
+
+        self.action_space = gym.spaces.Discrete(len(self.actions))
+        # Same observation as CoupEnv, with one row per game
+        low  = np.array([0, 0, -1, -1, 0, 0, -1, -1, 0, 0, -1, -1, 0, 0, -1, -1, 0, 0, -1, -1, 0], dtype='int8')
+        high = np.array([4, 4, 4, 4, 4, 4, 4, 4, 1, 1, 1, 1, 1, 1, 1, 1, 12, 12, 31, 31, 1], dtype='int8')
+        self.observation_space = gym.spaces.Box(np.tile(low, (num_envs, 1)),
+                                                np.tile(high, (num_envs, 1)),
+                                                dtype='int8')
+
+        n = num_envs
+        # Cards in each player's hand, NONE for empty slots.
+        # Slots 0-1 are always sorted, 2-3 are only used mid-exchange.
+        self.cards          = np.full((n, 2, 4), NONE, dtype=np.int8)
+        self.face_up        = np.full((n, 2, 4), NONE, dtype=np.int8)
+        self.coins          = np.zeros((n, 2), dtype=np.int8)
+        self.last_action    = np.full((n, 2), NONE, dtype=np.int8)
+        self.lost_challenge = np.zeros((n, 2), dtype=bool)
+        # Number of each card left in the deck
+        self.deck           = np.zeros((n, len(Card.names)), dtype=np.int8)
+        self.whose_turn     = np.zeros(n, dtype=np.int8)
+        self.whose_action   = np.zeros(n, dtype=np.int8)
+        self.is_turn_begin  = np.zeros(n, dtype=bool)
+        self.game_over      = np.zeros(n, dtype=bool)
+        self.turn_count     = np.zeros(n, dtype=np.int32)
+
+        self._all = np.arange(n)
+        # Valid action mask of the current state, if already computed
+        self._mask = None
+
+        # Vectorized handler for each action, indexed by action number
+        self._handlers = [getattr(self, '_' + self.actions[a]) for a in range(len(self.actions) - 1)]
+
+    def seed(self, seed=None):
+        '''
+        Seed the random number generator for all following games
+
+        seed: Int, numpy SeedSequence, or None for fresh entropy from the OS
+        '''
+        self.rng = np.random.default_rng(seed)
+        return [seed]
+
+    def reset(self, seed=None, indices=None):
+        '''
+        Start a new game in every env
+
+        seed:    Seed the env first, so these and following games can be replayed. See seed()
+        indices: Only restart the games at these indices, e.g. to end games that run too long
+        '''
+        if seed is not None:
+            self.seed(seed)
+        self._reset_games(self._all if indices is None else np.asarray(indices))
+
+    def render(self, mode='human', index=0):
+        '''
+        Log the state of a single game in the batch
+        '''
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        logger.info(f'Game {index}, Turn {self.turn_count[index]}')
+        logger.info('Player: Cards | IsCardFaceUp | Coins | LastAction')
+        for p in range(2):
+            held = self.cards[index, p] != NONE
+            text = f'P{p + 1}: '
+            text += ''.join(f'{Card.names[c]} ' for c in self.cards[index, p][held])
+            text += '| '
+            text += ''.join(f'{bool(f)} ' for f in self.face_up[index, p][held])
+            la = self.last_action[index, p]
+            text += f'| {self.coins[index, p]} | {"_" if la == NONE else self.actions[la]}'
+            logger.info(text)
+
+    def step(self, actions):
+        '''
+        Take one action in every game
+
+        actions: Array of action numbers, one per game
+
+        Returns (obs, rewards, dones, info)
+            obs:     (num_envs, 21) int8, each from the view of the player who acted
+            rewards: (num_envs,) int8, for the player who acted
+            dones:   (num_envs,) bool. These games have already been reset.
+        '''
+        actions = np.asarray(actions)
+        if actions.shape != (self.num_envs,):
+            raise RuntimeError(f'Expected {self.num_envs} actions, got shape {actions.shape}')
+
+        valid = self.get_valid_action_mask()[self._all, actions]
+        if not valid.all():
+            bad = np.flatnonzero(~valid)
+            raise RuntimeError(f'Invalid action {actions[bad[0]]} in {len(bad)} game(s), first is game {bad[0]}')
+
+        # Who takes this action
+        whose_a = self.whose_action.copy()
+        # Num face up cards of each player before the action
+        num_up_1 = (self.face_up == 1).sum(axis=2)
+
+        self._mask = None
+        for a in np.unique(actions):
+            self._handlers[a](np.flatnonzero(actions == a))
+
+        # Get the observation from the perspective of
+        # the player who just took the action
+        obs = self.get_obs(whose_a == 1)
+
+        # Num face up cards of each player after the action
+        dif = (self.face_up == 1).sum(axis=2) - num_up_1
+        # -1 if you lose a card, +1 if your opp loses a card
+        rewards = (dif[self._all, 1 - whose_a] - dif[self._all, whose_a]).astype(np.int8)
+
+        dones = self.game_over.copy()
+        if dones.any():
+            self._reset_games(np.flatnonzero(dones))
+
+        return (obs, rewards, dones, dict())
+
+    def get_obs(self, p2_view=False):
+        '''
+        Return the current state of every game as a (num_envs, 21) int8 array
+
+        p2_view: Bool or bool array per game.
+                 Whether to get the observation from P2's view/perspective
+
+        Each row is laid out the same as CoupEnv.get_obs()
+        '''
+        first = np.broadcast_to(np.asarray(p2_view, dtype=np.int8), (self.num_envs,))
+        second = 1 - first
+        i = self._all
+
+        obs = np.empty((self.num_envs, 21), dtype=np.int8)
+        obs[:, 0:4]   = self.cards[i, first]
+        obs[:, 4:8]   = self.cards[i, second]
+        obs[:, 8:12]  = self.face_up[i, first]
+        obs[:, 12:16] = self.face_up[i, second]
+        obs[:, 16]    = self.coins[i, first]
+        obs[:, 17]    = self.coins[i, second]
+        obs[:, 18]    = self.last_action[i, first]
+        obs[:, 19]    = self.last_action[i, second]
+        obs[:, 20]    = self.whose_action
+        return obs
+
+    def get_valid_action_mask(self):
+        '''
+        Get the valid actions of every game as a read-only (num_envs, 32) bool array.
+        Looked up from the precomputed VALID_ACTION_TABLE, and cached until the next step.
+        '''
+        if self._mask is not None:
+            return self._mask
+
+        i = self._all
+        c = self.whose_action
+        o = 1 - c
+
+        phase = np.where(self.last_action[i, c] == EXCHANGE, PHASE_EXCHANGE_RETURN, PHASE_RESPOND_TO_BLOCK)
+        phase[self.whose_turn != c] = PHASE_RESPOND
+        phase[self.lost_challenge[i, c]] = PHASE_LOSE_CARD
+        phase[self.is_turn_begin] = PHASE_TURN_BEGIN
+
+        index = get_valid_action_index(phase,
+                                       _COINS_BUCKET[self.coins[i, c], self.coins[i, o]],
+                                       self.last_action[i, o],
+                                       self.face_up[i, c, 0] * 2 + self.face_up[i, c, 1])
+        self._mask = VALID_ACTION_ARRAYS[index]
+        self._mask.flags.writeable = False
+        return self._mask
+
+    # Game state helpers
+    # Each takes an array g of game indices
+
+    def _reset_games(self, g):
+        self._mask = None
+        self.cards[g] = NONE
+        self.face_up[g] = NONE
+        self.coins[g] = 2
+        self.last_action[g] = NONE
+        self.lost_challenge[g] = False
+        self.deck[g] = 3
+        self.whose_turn[g] = self.p_first_turn
+        self.whose_action[g] = self.p_first_turn
+        self.is_turn_begin[g] = True
+        self.game_over[g] = False
+        self.turn_count[g] = 0
+
+        for slot in range(2):
+            for p in range(2):
+                self.cards[g, p, slot] = self._draw_card(g)
+                self.face_up[g, p, slot] = 0
+        self._sort_cards(g, 0)
+        self._sort_cards(g, 1)
+
+        # In a 2 player game, the player going first starts with 1 coin instead of 2
+        self.coins[g, self.p_first_turn] = 1
+
+    def _draw_card(self, g):
+        '''
+        Draw a random card from the deck of each game in g
+        '''
+        counts = self.deck[g]
+        cum = np.cumsum(counts, axis=1)
+        r = (self.rng.random(len(g)) * cum[:, -1]).astype(cum.dtype)
+        card = (r[:, None] >= cum).sum(axis=1)
+        self.deck[g, card] -= 1
+        return card
+
+    def _sort_cards(self, g, p):
+        '''
+        Sort the cards of player(s) p, same order as Card.__lt__.
+        Empty slots are moved to the end.
+        '''
+        cards = self.cards[g, p]
+        keys = np.where(cards == NONE, 127, cards * 2 + self.face_up[g, p]).astype(np.int8)
+        keys.sort(axis=1)
+        held = keys != 127
+        self.cards[g, p] = np.where(held, keys >> 1, NONE)
+        self.face_up[g, p] = np.where(held, keys & 1, NONE)
+
+    def _has_face_down_card(self, g, p, card_val):
+        return ((self.cards[g, p] == card_val) & (self.face_up[g, p] == 0)).any(axis=1)
+
+    def _next_player_turn(self, g):
+        self.whose_turn[g] = 1 - self.whose_turn[g]
+        # Players will always have the first action on their turn
+        self.whose_action[g] = self.whose_turn[g]
+        self.turn_count[g] += 1
+        self.is_turn_begin[g] = True
+
+    def _next_player_action(self, g):
+        self.whose_action[g] = 1 - self.whose_action[g]
+        self.is_turn_begin[g] = False
+
+    def _players(self, g):
+        c = self.whose_action[g]
+        return c, 1 - c
+
+    def _add_coins(self, g, p, num):
+        self.coins[g, p] += num
+
+    def _steal_coins(self, g, thief, victim):
+        num_steal = np.where(self.coins[g, victim] >= 2, 2, 1).astype(np.int8)
+        self.coins[g, victim] -= num_steal
+        self.coins[g, thief] += num_steal
+
+    def _draw_exchange_cards(self, g):
+        # The player whose action it is draws 2 cards into the spare slots
+        c = self.whose_action[g]
+        for slot in [2, 3]:
+            self.cards[g, c, slot] = self._draw_card(g)
+            self.face_up[g, c, slot] = 0
+
+    def _challenge_fail_replace_card(self, g, card_val):
+        # If the challenged player actually had the correct card,
+        # shuffle it into the deck and give them a new card
+        _, p = self._players(g)
+        match = (self.cards[g, p] == card_val) & (self.face_up[g, p] == 0)
+        slot = match.argmax(axis=1)
+        self.deck[g, card_val] += 1
+        self.cards[g, p, slot] = self._draw_card(g)
+        self._sort_cards(g, p)
+
+    def _lose_all_cards(self, g, p):
+        self.face_up[g, p, 0] = 1
+        self.face_up[g, p, 1] = 1
+        self.game_over[g] = True
+
+    # Actions
+
+    def _income(self, g):
+        c, _ = self._players(g)
+        self._add_coins(g, c, 1)
+        self.last_action[g, c] = INCOME
+        self._next_player_turn(g)
+
+    def _foreign_aid(self, g):
+        c, _ = self._players(g)
+        self.last_action[g, c] = FOREIGN_AID
+        self._next_player_action(g)
+
+    def _coup(self, g):
+        c, _ = self._players(g)
+        self.coins[g, c] -= 7
+        self.last_action[g, c] = COUP
+        self._next_player_action(g)
+
+    def _tax(self, g):
+        c, _ = self._players(g)
+        self.last_action[g, c] = TAX
+        self._next_player_action(g)
+
+    def _assassinate(self, g):
+        c, _ = self._players(g)
+        self.last_action[g, c] = ASSASSINATE
+        # Pay the coins whether or not the action is blocked/challenged
+        self.coins[g, c] -= 3
+        self._next_player_action(g)
+
+    def _exchange(self, g):
+        c, _ = self._players(g)
+        self.last_action[g, c] = EXCHANGE
+        self._next_player_action(g)
+
+    def _steal(self, g):
+        c, _ = self._players(g)
+        self.last_action[g, c] = STEAL
+        self._next_player_action(g)
+
+    def _lose_card(self, g, slot):
+        c, _ = self._players(g)
+        self.face_up[g, c, slot] = 1
+        self.lost_challenge[g, c] = False
+        self._sort_cards(g, c)
+
+        # Check if the player has no cards remaining
+        self.game_over[g] = (self.face_up[g, c] != 0).all(axis=1)
+        self._next_player_turn(g)
+
+    def _lose_card_1(self, g):
+        self.last_action[g, self.whose_action[g]] = LOSE_CARD_1
+        self._lose_card(g, 0)
+
+    def _lose_card_2(self, g):
+        self.last_action[g, self.whose_action[g]] = LOSE_CARD_2
+        self._lose_card(g, 1)
+
+    def _pass_fa(self, g):
+        self.last_action[g, self.whose_action[g]] = PASS_FA
+        self._next_player_action(g)
+        # Opponent did not block, so complete the action
+        self._add_coins(g, self.whose_action[g], 2)
+        self._next_player_turn(g)
+
+    def _pass_tax(self, g):
+        self.last_action[g, self.whose_action[g]] = PASS_TAX
+        self._next_player_action(g)
+        # Opponent did not challenge, so complete the action
+        self._add_coins(g, self.whose_action[g], 3)
+        self._next_player_turn(g)
+
+    def _pass_exchange(self, g):
+        self.last_action[g, self.whose_action[g]] = PASS_EXCHANGE
+        self._next_player_action(g)
+        # Opponent did not challenge, so draw 2 cards.
+        # It is still the exchanging player's choice of which cards to return.
+        self._draw_exchange_cards(g)
+
+    def _pass_steal(self, g):
+        c, o = self._players(g)
+        self.last_action[g, c] = PASS_STEAL
+        self._next_player_action(g)
+        # Opponent did not block or challenge, so complete the action
+        self._steal_coins(g, o, c)
+        self._next_player_turn(g)
+
+    def _pass_block(self, g, action):
+        self.last_action[g, self.whose_action[g]] = action
+        # Block succeeds, so nothing to do. Next turn.
+        self._next_player_turn(g)
+
+    def _pass_fa_block(self, g):
+        self._pass_block(g, PASS_FA_BLOCK)
+
+    def _pass_assassinate_block(self, g):
+        self._pass_block(g, PASS_ASSASSINATE_BLOCK)
+
+    def _pass_steal_block(self, g):
+        self._pass_block(g, PASS_STEAL_BLOCK)
+
+    def _block(self, g, action):
+        self.last_action[g, self.whose_action[g]] = action
+        self._next_player_action(g)
+
+    def _block_fa(self, g):
+        self._block(g, BLOCK_FA)
+
+    def _block_assassinate(self, g):
+        self._block(g, BLOCK_ASSASSINATE)
+
+    def _block_steal(self, g):
+        self._block(g, BLOCK_STEAL)
+
+    # Challenge:
+    # Check if opp_player has the required card
+    # If they do, curr_player loses a card
+    # If they don't, opp_player loses a card
+    # Each handler splits g into games where the challenge failed (has)
+    # and games where it succeeded (bluff)
+
+    def _challenge(self, g, action, card_val):
+        c, o = self._players(g)
+        self.last_action[g, c] = action
+        has = self._has_face_down_card(g, o, card_val)
+        return g[has], g[~has]
+
+    def _challenge_failed(self, g, card_val):
+        c, _ = self._players(g)
+        self.lost_challenge[g, c] = True
+        # Replace the revealed card
+        self._challenge_fail_replace_card(g, card_val)
+
+    def _challenge_succeeded(self, g):
+        # opp_player must lose a card
+        _, o = self._players(g)
+        self.lost_challenge[g, o] = True
+        self._next_player_action(g)
+
+    def _challenge_fa_block(self, g):
+        has, bluff = self._challenge(g, CHALLENGE_FA_BLOCK, DUKE)
+        # curr_player must lose a card. It is still their action
+        self._challenge_failed(has, DUKE)
+        # Block failed, so complete the action
+        self._add_coins(bluff, self.whose_action[bluff], 2)
+        self._challenge_succeeded(bluff)
+
+    def _challenge_tax(self, g):
+        has, bluff = self._challenge(g, CHALLENGE_TAX, DUKE)
+        self._challenge_failed(has, DUKE)
+        # Complete the action
+        self._add_coins(has, 1 - self.whose_action[has], 3)
+        self._challenge_succeeded(bluff)
+
+    def _challenge_exchange(self, g):
+        has, bluff = self._challenge(g, CHALLENGE_EXCHANGE, AMBASSADOR)
+        self._challenge_failed(has, AMBASSADOR)
+        # Complete the action.
+        # curr_player loses a card after the exchange is returned
+        self._next_player_action(has)
+        self._draw_exchange_cards(has)
+        self._challenge_succeeded(bluff)
+
+    def _challenge_assassinate(self, g):
+        has, bluff = self._challenge(g, CHALLENGE_ASSASSINATE, ASSASSIN)
+        # curr_player loses the game
+        # Lose 1 card for assassination
+        # and 1 card for losing challenge
+        self._lose_all_cards(has, self.whose_action[has])
+        # Coins spent are returned in this one case
+        self._add_coins(bluff, 1 - self.whose_action[bluff], 3)
+        self._challenge_succeeded(bluff)
+
+    def _challenge_assassinate_block(self, g):
+        has, bluff = self._challenge(g, CHALLENGE_ASSASSINATE_BLOCK, CONTESSA)
+        self._challenge_failed(has, CONTESSA)
+        # opp_player loses the game
+        # Lose 1 card for assassination
+        # and 1 card for losing challenge
+        self._lose_all_cards(bluff, 1 - self.whose_action[bluff])
+
+    def _challenge_steal(self, g):
+        has, bluff = self._challenge(g, CHALLENGE_STEAL, CAPTAIN)
+        self._challenge_failed(has, CAPTAIN)
+        # Complete the action
+        c = self.whose_action[has]
+        self._steal_coins(has, 1 - c, c)
+        self._challenge_succeeded(bluff)
+
+    def _challenge_steal_block(self, g):
+        captain, rest = self._challenge(g, CHALLENGE_STEAL_BLOCK, CAPTAIN)
+        self._challenge_failed(captain, CAPTAIN)
+        amb = self._has_face_down_card(rest, 1 - self.whose_action[rest], AMBASSADOR)
+        ambassador, bluff = rest[amb], rest[~amb]
+        self._challenge_failed(ambassador, AMBASSADOR)
+        # Block failed, so complete the action
+        c = self.whose_action[bluff]
+        self._steal_coins(bluff, c, 1 - c)
+        self._challenge_succeeded(bluff)
+
+    def _exchange_return(self, g, action, slots):
+        c, o = self._players(g)
+        self.last_action[g, c] = action
+        for slot in slots:
+            np.add.at(self.deck, (g, self.cards[g, c, slot]), 1)
+            self.cards[g, c, slot] = NONE
+            self.face_up[g, c, slot] = NONE
+        self._sort_cards(g, c)
+
+        # opp may still need to choose a card to lose
+        lost = self.lost_challenge[g, o]
+        self._next_player_action(g[lost])
+        self._next_player_turn(g[~lost])
+
+    def _exchange_return_12(self, g):
+        self._exchange_return(g, EXCHANGE_RETURN_12, [0, 1])
+
+    def _exchange_return_13(self, g):
+        self._exchange_return(g, EXCHANGE_RETURN_13, [0, 2])
+
+    def _exchange_return_14(self, g):
+        self._exchange_return(g, EXCHANGE_RETURN_14, [0, 3])
+
+    def _exchange_return_23(self, g):
+        self._exchange_return(g, EXCHANGE_RETURN_23, [1, 2])
+
+    def _exchange_return_24(self, g):
+        self._exchange_return(g, EXCHANGE_RETURN_24, [1, 3])
+
+    def _exchange_return_34(self, g):
+        self._exchange_return(g, EXCHANGE_RETURN_34, [2, 3])
@@ -1,6 +1,5 @@
 import gym
 import numpy as np
-from random import shuffle
 import logging
 
 logging.basicConfig()
@@ -49,28 +48,182 @@ EXCHANGE_RETURN_23          = 29
 EXCHANGE_RETURN_24          = 30
 EXCHANGE_RETURN_34          = 31
 
+NUM_ACTIONS = EXCHANGE_RETURN_34 + 1
+
+# Turn phases, used to look up the valid actions
+PHASE_TURN_BEGIN       = 0 # Beginning of curr_player's turn
+PHASE_LOSE_CARD        = 1 # curr_player lost a challenge and must choose a card to lose
+PHASE_RESPOND          = 2 # opp_player's turn. curr_player can block or challenge
+PHASE_EXCHANGE_RETURN  = 3 # curr_player's exchange. Choose which cards to return
+PHASE_RESPOND_TO_BLOCK = 4 # curr_player's turn. opp_player blocked their action
+
+def get_coins_bucket(coins, opp_coins):
+    '''
+    The valid actions only depend on coins through these thresholds:
+    curr_player coins < 3, < 7, < 10, >= 10 and whether opp_player has any coins
+    '''
+    if coins < 3:
+        b = 0
+    elif coins < 7:
+        b = 1
+    elif coins < 10:
+        b = 2
+    else:
+        b = 3
+    return b * 2 + int(opp_coins > 0)
+
+def _get_valid_actions(phase, coins_bucket, opp_last_action, face_up):
+    '''
+    Valid actions of curr_player as a list
+
+    phase:           One of the PHASE_ values
+    coins_bucket:    From get_coins_bucket
+    opp_last_action: opp_player's last action (-1 - 31)
+    face_up:         Is card 1 face up * 2 + Is card 2 face up
+    '''
+    coins = [0, 3, 7, 10][coins_bucket // 2]
+    opp_has_coins = coins_bucket % 2
+    card_1_down = not face_up & 2
+    card_2_down = not face_up & 1
+
+    def valid_lose_card_options():
+        valid = []
+        if card_1_down:
+            # Card is still in play. Can choose to give it up.
+            valid += [LOSE_CARD_1]
+        if card_2_down:
+            # Card is still in play. Can choose to give it up.
+            valid += [LOSE_CARD_2]
+        return valid
+
+    if phase == PHASE_TURN_BEGIN:
+        if coins >= 10:
+            return [COUP]
+
+        valid = [INCOME, FOREIGN_AID, TAX, EXCHANGE]
+        if coins >= 3:
+            valid.append(ASSASSINATE)
+        if coins >= 7:
+            valid.append(COUP)
+        if opp_has_coins:
+            valid.append(STEAL)
+        return valid
+
+    elif phase == PHASE_LOSE_CARD:
+        return valid_lose_card_options()
+
+    elif phase == PHASE_RESPOND:
+        if opp_last_action == FOREIGN_AID:
+            return [PASS_FA, BLOCK_FA]
+        elif opp_last_action == TAX:
+            return [PASS_TAX, CHALLENGE_TAX]
+        elif opp_last_action == EXCHANGE:
+            return [PASS_EXCHANGE, CHALLENGE_EXCHANGE]
+        elif opp_last_action == STEAL:
+            return [PASS_STEAL, BLOCK_STEAL, CHALLENGE_STEAL]
+        elif opp_last_action in [ASSASSINATE, COUP]:
+            valid = valid_lose_card_options()
+            if opp_last_action == ASSASSINATE:
+                valid += [BLOCK_ASSASSINATE, CHALLENGE_ASSASSINATE]
+            return valid
+
+    elif phase == PHASE_EXCHANGE_RETURN:
+        # Cards 3 and 4 were just drawn, so they are always face down
+        valid = [EXCHANGE_RETURN_34]
+        if card_1_down:
+            valid += [EXCHANGE_RETURN_13, EXCHANGE_RETURN_14]
+        if card_2_down:
+            valid += [EXCHANGE_RETURN_23, EXCHANGE_RETURN_24]
+        if card_1_down and card_2_down:
+            valid += [EXCHANGE_RETURN_12]
+        return valid
+
+    elif phase == PHASE_RESPOND_TO_BLOCK:
+        if opp_last_action == BLOCK_FA:
+            return [PASS_FA_BLOCK, CHALLENGE_FA_BLOCK]
+        elif opp_last_action == BLOCK_ASSASSINATE:
+            return [PASS_ASSASSINATE_BLOCK, CHALLENGE_ASSASSINATE_BLOCK]
+        elif opp_last_action == BLOCK_STEAL:
+            return [PASS_STEAL_BLOCK, CHALLENGE_STEAL_BLOCK]
+
+    # Not a reachable combination
+    return []
+
+def get_valid_action_index(phase, coins_bucket, opp_last_action, face_up):
+    '''
+    Flat index into VALID_ACTION_TABLE.
+    Works on ints or numpy arrays of each argument.
+    '''
+    return ((phase * 8 + coins_bucket) * 33 + opp_last_action + 1) * 4 + face_up
+
+def _build_valid_action_table():
+    '''
+    Precompute the valid actions for every
+    (phase, coins bucket, opp last action, face up pattern)
+    as a 32-bit mask, with bit i set if action i is valid
+    '''
+    table = np.zeros((5, 8, 33, 4), dtype=np.uint32)
+    for phase, bucket, la, fu in np.ndindex(table.shape):
+        for a in _get_valid_actions(phase, bucket, la - 1, fu):
+            table[phase, bucket, la, fu] |= 1 << a
+    return table
+
+# Valid action bitmasks, indexed by get_valid_action_index
+VALID_ACTION_TABLE = _build_valid_action_table()
+# Same table as bool arrays with one column per action
+VALID_ACTION_ARRAYS = ((VALID_ACTION_TABLE.reshape(-1, 1) >> np.arange(NUM_ACTIONS, dtype=np.uint32)) & 1).astype(bool)
+VALID_ACTION_ARRAYS.flags.writeable = False
+# Tuple of valid actions, and read-only bool array, for each bitmask
+VALID_ACTIONS_BY_MASK = {}
+VALID_ACTION_ARRAY_BY_MASK = {}
+for _m, _arr in zip(VALID_ACTION_TABLE.ravel().tolist(), VALID_ACTION_ARRAYS):
+    VALID_ACTIONS_BY_MASK[_m] = tuple(a for a in range(NUM_ACTIONS) if _m >> a & 1)
+    VALID_ACTION_ARRAY_BY_MASK[_m] = _arr
+# Scalar lookups are faster on a list than a numpy array
+_VALID_ACTION_LIST = VALID_ACTION_TABLE.ravel().tolist()
+# Valid actions in the order Game.get_valid_actions has always listed them, by the same index
+_VALID_ACTIONS_IN_ORDER = [tuple(_get_valid_actions(phase, bucket, la - 1, fu))
+                           for phase, bucket, la, fu in np.ndindex(VALID_ACTION_TABLE.shape)]
+_COINS_BUCKET = [[get_coins_bucket(c, o) for o in range(13)] for c in range(13)]
+
 class Card:
+    '''
+    Cards are stored as int codes: card value * 2 + is face up.
+    Sorting the codes sorts by card value, then face down before face up.
+    '''
     names = ['Assassin',
              'Ambassador',
              'Captain',
              'Contessa',
              'Duke']
-    def __init__(self, val, is_face_up=False):
-        self.val = val
-        self.is_face_up = is_face_up
 
-    def get_name(self):
-        return Card.names[self.val]
+    @staticmethod
+    def get_name(code):
+        return Card.names[code >> 1]
 
-    def __lt__(self, other):
-        return (self.val < other.val or
-                (self.val == other.val and self.is_face_up < other.is_face_up))
+# Padded observation tuples (card values, is face up) for each hand of card codes
+_HAND_OBS = {}
+
+def _get_hand_obs(cards):
+    obs = _HAND_OBS.get(cards)
+    if obs is None:
+        if len(cards) not in [2, 4]:
+            raise RuntimeError('Number of cards in hand must be 2 or 4')
+        pad = (NONE,) * (4 - len(cards))
+        obs = (tuple(c >> 1 for c in cards) + pad,
+               tuple(c & 1 for c in cards) + pad)
+        _HAND_OBS[cards] = obs
+    return obs
 
 class Player:
+    __slots__ = ('id', 'is_human', 'cards', 'coins', 'last_action',
+                 'lost_challenge', 'num_face_up', 'obs_cards', 'obs_face_up')
+
     def __init__(self, id, is_human=False):
         self.id = id
         self.is_human = is_human
-        self.cards = []
+        # Tuple of card codes. See Card.
+        self.cards = ()
         self.coins = 2
         self.last_action = NONE
 
@@ -78,8 +231,16 @@ class Player:
         # and must choose which card to lose
         self.lost_challenge = False
 
-    def add_card(self, card):
-        self.cards.append(card)
+        # Kept up to date whenever the cards change
+        self.num_face_up = 0
+        self.obs_cards = None
+        self.obs_face_up = None
+
+    def add_card(self, card_val):
+        '''
+        Add a face down card to the end of the hand, without sorting
+        '''
+        self._set_cards(self.cards + (card_val * 2,))
 
     def add_coins(self, num):
         self.coins += num
@@ -88,11 +249,15 @@ class Player:
         self.coins -= num
 
     def has_face_down_card(self, card_val):
-        for i in range(len(self.cards)):
-            c = self.cards[i]
-            if c.val == card_val and not c.is_face_up:
-                return True
-        return False
+        return card_val * 2 in self.cards
+
+    def reveal_card(self, index):
+        '''
+        Turn a card face up and resort
+        '''
+        cards = list(self.cards)
+        cards[index] |= 1
+        self._set_cards(tuple(sorted(cards)))
 
     def get_obs(self, text=False):
         '''
@@ -109,30 +274,38 @@ class Player:
             Last action         (-1 - 31)
         '''
         if text:
-            c = [(self.cards[i].get_name(), int(self.cards[i].is_face_up)) for i in range(len(self.cards))]
+            c = [(Card.get_name(x), x & 1) for x in self.cards]
             la = CoupEnv.actions[self.last_action]
         else:
-            c = [(self.cards[i].val, int(self.cards[i].is_face_up)) for i in range(len(self.cards))]
+            c = [(x >> 1, x & 1) for x in self.cards]
             la = self.last_action
         return (c,
                 self.coins,
                 la)
 
+    def _set_cards(self, cards):
+        self.cards = cards
+        self.num_face_up = sum([c & 1 for c in cards])
+        if len(cards) in [2, 4]:
+            self.obs_cards, self.obs_face_up = _get_hand_obs(cards)
+
     def _sort_cards(self):
         '''
         Always keep the cards sorted in alphabetical order.
         Since get_obs is run on each iter, decrease the amount of
         sorts we need by only sorting when cards are exchanged or lost.
         '''
-        self.cards.sort()
+        self._set_cards(tuple(sorted(self.cards)))
 
     def render(self):
+        if not logger.isEnabledFor(logging.INFO):
+            return
         text = f'P{self.id + 1}: '
         for c in self.cards:
-            text += f'{c.get_name()} '
+            text += f'{Card.get_name(c)} '
         text += '| '
         for c in self.cards:
-            text += f'{c.is_face_up} '
+            text += f'{bool(c & 1)} '
         text += '| '
         text += f'{self.coins} | {"_" if self.last_action == NONE else CoupEnv.actions[self.last_action]}'
         logger.info(text)
@@ -143,15 +316,21 @@ class Game:
     2 player Coup game
     Can have any combination of human and cpu players
     '''
-    def __init__(self, num_human_players=0, p_first_turn=0):
+    __slots__ = ('players', 'deck', 'whose_turn', 'whose_action',
+                 'turn_count', 'is_turn_begin', 'game_over', 'rng')
+
+    def __init__(self, num_human_players=0, p_first_turn=0, rng=None):
         '''
         num_human_players: Number of human players in the 2-player game
         p_first_turn:      Which player goes first, 0-indexed
+        rng:               Numpy Generator for shuffling the deck. Default is a new unseeded one.
         '''
+        self.rng = rng if rng is not None else np.random.default_rng()
         self.players = [Player(i, True) for i in range(num_human_players)]
         self.players += [Player(i+num_human_players, False) for i in range(2-num_human_players)]
 
-        self.deck = [Card(i) for _ in range(3) for i in range(len(Card.names))]
+        # Card values (0 - 4). Cards are always face down in the deck
+        self.deck = [i for _ in range(3) for i in range(len(Card.names))]
         self.shuffle_deck()
         self.deal_cards()
 
@@ -173,6 +352,57 @@ class Game:
             # In a 2 player game, the player going first starts with 1 coin instead of 2
             self.players[p_first_turn].coins = 1
 
+    def snapshot(self):
+        '''
+        Immutable copy of the game state, as a flat tuple
+        Restoring it with restore() undoes every action taken since.
+        Much cheaper than a deep copy, since only the deck needs copying.
+        The rng is not included.
+        '''
+        p1, p2 = self.players
+        return (tuple(self.deck), self.whose_turn, self.whose_action, self.turn_count,
+                self.is_turn_begin, self.game_over,
+                p1.cards, p1.coins, p1.last_action, p1.lost_challenge,
+                p1.num_face_up, p1.obs_cards, p1.obs_face_up,
+                p2.cards, p2.coins, p2.last_action, p2.lost_challenge,
+                p2.num_face_up, p2.obs_cards, p2.obs_face_up)
+
+    def restore(self, snapshot):
+        '''
+        Set the game state to a snapshot from snapshot() of this or any other game
+        '''
+        p1, p2 = self.players
+        (deck, self.whose_turn, self.whose_action, self.turn_count,
+         self.is_turn_begin, self.game_over,
+         p1.cards, p1.coins, p1.last_action, p1.lost_challenge,
+         p1.num_face_up, p1.obs_cards, p1.obs_face_up,
+         p2.cards, p2.coins, p2.last_action, p2.lost_challenge,
+         p2.num_face_up, p2.obs_cards, p2.obs_face_up) = snapshot
+        self.deck = list(deck)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, rng=None):
+        '''
+        New cpu vs cpu game in the state of a snapshot
+
+        rng: Numpy Generator for shuffling the deck. Default is a new unseeded one.
+        '''
+        game = cls.__new__(cls)
+        game.rng = rng if rng is not None else np.random.default_rng()
+        game.players = [Player(0), Player(1)]
+        game.restore(snapshot)
+        return game
+
+    def do_action(self, action):
+        '''
+        Take an action by number, like CoupEnv.step without building the observation
+
+        Returns the snapshot from before the action, to undo it with restore()
+        '''
+        undo = self.snapshot()
+        getattr(self, CoupEnv.actions[action])()
+        return undo
+
     def get_obs(self, p2_view=False, text=False):
         '''
         Return the current state of the game
@@ -208,7 +438,23 @@ class Game:
                 p1[2], p2[2], # Last action
                 self.whose_action)
 
+    def get_flat_obs(self, p2_view=False):
+        '''
+        Return the current state of the game as the flat
+        CoupEnv observation tuple, built from each player's cached hand
+        '''
+        if p2_view:
+            p1, p2 = self.players[1], self.players[0]
+        else:
+            p1, p2 = self.players
+        return (p1.obs_cards + p2.obs_cards +
+                p1.obs_face_up + p2.obs_face_up +
+                (p1.coins, p2.coins, p1.last_action, p2.last_action, self.whose_action))
+
     def render(self):
+        # Skip building the text when it wouldn't be logged
+        if not logger.isEnabledFor(logging.INFO):
+            return
         logger.info(f'Turn {self.turn_count}')
         logger.info('Player: Cards | IsCardFaceUp | Coins | LastAction')
         for p in self.players:
@@ -218,7 +464,7 @@ class Game:
         return self.deck.pop(index)
 
     def shuffle_deck(self):
-        shuffle(self.deck)
+        self.rng.shuffle(self.deck)
 
     def deal_cards(self):
         for _ in range(2):
@@ -253,91 +499,58 @@ class Game:
     def get_opp_player(self):
         return self.players[1 - self.whose_action]
 
-    def get_valid_actions(self):
+    def get_phase(self):
+        '''
+        Get which part of the turn curr_player is choosing an action for
+        '''
         curr_player = self.get_curr_action_player()
-        opp_player = self.get_opp_player()
-
-        def valid_lose_card_options():
-            valid = []
-            if not curr_player.cards[0].is_face_up:
-                # Card is still in play. Can choose to give it up.
-                valid += [LOSE_CARD_1]
-            if not curr_player.cards[1].is_face_up:
-                # Card is still in play. Can choose to give it up.
-                valid += [LOSE_CARD_2]
-            return valid
-
-
         if self.is_turn_begin:
-            # It's the beginning of curr_player's turn
-
-            if curr_player.coins >= 10:
-                return [COUP]
-
-            valid = [INCOME, FOREIGN_AID, TAX, EXCHANGE]
-            if curr_player.coins >= 3:
-                valid.append(ASSASSINATE)
-            if curr_player.coins >= 7:
-                valid.append(COUP)
-            if opp_player.coins > 0:
-                valid.append(STEAL)
-            
-            return valid
-
+            return PHASE_TURN_BEGIN
         elif curr_player.lost_challenge:
-            return valid_lose_card_options()
-
+            return PHASE_LOSE_CARD
         elif self.whose_turn != self.whose_action:
             # It is opp_player's turn, and curr_player can
             # choose to block or challenge for certain actions
-
-            if opp_player.last_action == FOREIGN_AID:
-                return [PASS_FA, BLOCK_FA]
-            elif opp_player.last_action == TAX:
-                return [PASS_TAX, CHALLENGE_TAX]
-            elif opp_player.last_action == EXCHANGE:
-                return [PASS_EXCHANGE, CHALLENGE_EXCHANGE]
-            elif opp_player.last_action == STEAL:
-                return [PASS_STEAL, BLOCK_STEAL, CHALLENGE_STEAL]
-            elif opp_player.last_action in [ASSASSINATE, COUP]:
-                valid = valid_lose_card_options()
-
-                if opp_player.last_action == ASSASSINATE:
-                    valid += [BLOCK_ASSASSINATE, CHALLENGE_ASSASSINATE]
-
-                return valid
-            else:
-                raise RuntimeError('Invalid action progression')
-
+            return PHASE_RESPOND
         elif curr_player.last_action == EXCHANGE:
             # It is curr_player's turn, and opp_player has approved the exchange
-
             if len(curr_player.cards) < 4:
                 raise RuntimeError('Player mid-exchange should have 4 cards including any eliminated')
-            
-            valid = [EXCHANGE_RETURN_34]
-            if not curr_player.cards[0].is_face_up:
-                valid += [EXCHANGE_RETURN_13, EXCHANGE_RETURN_14]
-            if not curr_player.cards[1].is_face_up:
-                valid += [EXCHANGE_RETURN_23, EXCHANGE_RETURN_24]
-            if (not curr_player.cards[0].is_face_up and
-                not curr_player.cards[1].is_face_up):
-                valid += [EXCHANGE_RETURN_12]
+            return PHASE_EXCHANGE_RETURN
+        else:
+            # It is curr_player's turn and opp_player wants to block their move
+            return PHASE_RESPOND_TO_BLOCK
 
-            return valid
+    def _get_valid_action_index(self):
+        '''
+        Index of the current state in VALID_ACTION_TABLE, raveled
+        '''
+        curr_player = self.get_curr_action_player()
+        opp_player = self.get_opp_player()
 
-        elif opp_player.last_action == BLOCK_FA:
-            # It is curr_player's turn and opp_player wants to block their move
-            return [PASS_FA_BLOCK, CHALLENGE_FA_BLOCK]
-        elif opp_player.last_action == BLOCK_ASSASSINATE:
-            # It is curr_player's turn and opp_player wants to block their move
-            return [PASS_ASSASSINATE_BLOCK, CHALLENGE_ASSASSINATE_BLOCK]
-        elif opp_player.last_action == BLOCK_STEAL:
-            # It is curr_player's turn and opp_player wants to block their move
-            return [PASS_STEAL_BLOCK, CHALLENGE_STEAL_BLOCK]
-        
-        else:
+        i = get_valid_action_index(
+            self.get_phase(),
+            _COINS_BUCKET[curr_player.coins][opp_player.coins],
+            opp_player.last_action,
+            (curr_player.cards[0] & 1) * 2 + (curr_player.cards[1] & 1))
+
+        if not _VALID_ACTION_LIST[i]:
             raise RuntimeError('Invalid action progression')
+        return i
+
+    def get_valid_action_mask(self):
+        '''
+        Get the valid actions as an int, with bit i set if action i is valid.
+        Looked up from the precomputed VALID_ACTION_TABLE.
+        '''
+        return _VALID_ACTION_LIST[self._get_valid_action_index()]
+
+    def get_valid_actions(self):
+        '''
+        Get the valid actions as a list, in the same order as always,
+        e.g. steal after assassinate and coup. VALID_ACTIONS_BY_MASK is sorted instead.
+        '''
+        return list(_VALID_ACTIONS_IN_ORDER[self._get_valid_action_index()])
 
 
     def income(self):
@@ -398,10 +611,11 @@ class Game:
 
     def _exchange_return(self, lst):
         curr_player = self.get_curr_action_player()
+        cards = list(curr_player.cards)
         for ind in sorted(lst, reverse=True):
-            self.deck.append(curr_player.cards.pop(ind))
+            self.deck.append(cards.pop(ind) >> 1)
         self.shuffle_deck()
-        curr_player._sort_cards()
+        curr_player._set_cards(tuple(sorted(cards)))
 
         if self.get_opp_player().lost_challenge:
             # opp still needs to choose a card to lose
@@ -573,8 +787,7 @@ class Game:
             # curr_player loses the game
             # Lose 1 card for assassination
             # and 1 card for losing challenge
-            curr_player.cards[0].is_face_up = True
-            curr_player.cards[1].is_face_up = True
+            curr_player._set_cards(tuple(c | 1 for c in curr_player.cards))
             self.game_over = True
             logger.info('Game Over')
         else:
@@ -601,8 +814,7 @@ class Game:
             # opp_player loses the game
             # Lose 1 card for assassination
             # and 1 card for losing challenge
-            opp_player.cards[0].is_face_up = True
-            opp_player.cards[1].is_face_up = True
+            opp_player._set_cards(tuple(c | 1 for c in opp_player.cards))
             self.game_over = True
             logger.info('Game Over')
 
@@ -658,30 +870,29 @@ class Game:
     def _challenge_fail_replace_card(self, card_val):
         # If the challenged player actually had the correct card,
         # shuffle it into the deck and give them a new card
-        logger.info(f'Showing and replacing card {Card.names[card_val]}')
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'Showing and replacing card {Card.names[card_val]}')
         p = self.get_opp_player()
-        for i in range(len(p.cards)):
-            c = p.cards[i]
-            if c.val == card_val and not c.is_face_up:
-                self.deck.append(c)
-                self.shuffle_deck()
-                p.cards[i] = self.draw_card()
-                p._sort_cards()
-                return
+        if p.has_face_down_card(card_val):
+            self.deck.append(card_val)
+            self.shuffle_deck()
+            cards = list(p.cards)
+            cards[cards.index(card_val * 2)] = self.draw_card() * 2
+            p._set_cards(tuple(sorted(cards)))
+            return
 
         raise RuntimeError(f'Tried to replace card {Card.names[card_val]} that was not in player\'s hand')
 
     def _lose_card(self, card_ind):
         curr_player = self.get_curr_action_player()
-        if curr_player.cards[card_ind].is_face_up:
+        if curr_player.cards[card_ind] & 1:
             raise RuntimeError(f'Cannot lose a card that is already face up')
 
-        curr_player.cards[card_ind].is_face_up = True
+        curr_player.reveal_card(card_ind)
         curr_player.lost_challenge = False
-        curr_player._sort_cards()
 
         # Check if the player has no cards remaining
-        self.game_over = not (False in [x.is_face_up for x in curr_player.cards])
+        self.game_over = curr_player.num_face_up == len(curr_player.cards)
 
         if self.game_over:
             logger.info('Game Over')
@@ -698,6 +909,36 @@ class Game:
 
 
 
+# Game reused by transition()
+_scratch_game = None
+
+def transition(state, action, rng):
+    '''
+    The state after taking an action, without changing any game
+
+    state:  Game snapshot, from Game.snapshot()
+    action: Action number. Must be valid in the state
+    rng:    Numpy Generator for shuffling the deck, if the action shuffles it
+
+    Returns the next state as a snapshot
+    '''
+    global _scratch_game
+    if _scratch_game is None:
+        _scratch_game = Game.from_snapshot(state, rng)
+    else:
+        _scratch_game.restore(state)
+    _scratch_game.rng = rng
+    getattr(_scratch_game, CoupEnv.actions[action])()
+    return _scratch_game.snapshot()
+
+# Index of fields in a Game snapshot
+SNAPSHOT_WHOSE_TURN = 1
+SNAPSHOT_WHOSE_ACTION = 2
+SNAPSHOT_GAME_OVER = 5
+# Start of each player's fields, in the same order as P1's: cards, coins, last action,
+# lost challenge, num face up, obs cards, obs face up
+SNAPSHOT_PLAYER = (6, 13)
+
 class CoupEnv(gym.Env):
     '''
     Gym env wrapper for a 2p Coup game
@@ -740,14 +981,22 @@ class CoupEnv(gym.Env):
         31: 'exchange_return_34'  # return cards 3,4
     }
 
-    def __init__(self, num_human_players=0, p_first_turn=0):
+    def __init__(self, num_human_players=0, p_first_turn=0, record_file=None, record_block=4096):
         '''
         num_human_players: Number of human players in the 2-player game
         p_first_turn:      Which player goes first, 0-indexed
+        record_file:       Path of a trajectory file to append every action to. See trajectory.py
+        record_block:      Number of actions buffered before writing them to record_file
         '''
         self.num_human_players = num_human_players
         self.p_first_turn = p_first_turn
         self.game = None
+        self.rng = np.random.default_rng()
+
+        self.recorder = None
+        if record_file is not None:
+            from gym_coup.envs.trajectory import TrajectoryWriter
+            self.recorder = TrajectoryWriter(record_file, record_block)
 
         self.action_space = gym.spaces.Discrete(len(self.actions))
 
@@ -790,18 +1039,26 @@ class CoupEnv(gym.Env):
         # Who takes this action
         whose_a = self.game.whose_action
 
+        recording = self.recorder is not None
+        if recording:
+            prev_obs = self.game.get_flat_obs(p2_view=whose_a == 1)
+            prev_mask = self.game.get_valid_action_mask()
+
+        p1, p2 = self.game.players
         # Num face up cards of each player before the action
-        num_cards_1 = [len([1 for c in p.cards if c.is_face_up]) for p in self.game.players]
+        num_cards_1 = [p1.num_face_up, p2.num_face_up]
 
         getattr(self.game, action)()
 
         # Get the observation from the perspective of
         # the player who just took the action
         obs = self.get_obs(whose_a == 1)
-        logger.debug(f'Observation: {obs}')
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f'Observation: {obs}')
 
         # Num face up cards of each player after the action
-        num_cards_2 = [len([1 for c in p.cards if c.is_face_up]) for p in self.game.players]
+        num_cards_2 = [p1.num_face_up, p2.num_face_up]
 
         if 2 in num_cards_2 and not self.game.game_over:
             raise RuntimeError('Game over was not set when it should be')
@@ -814,12 +1071,46 @@ class CoupEnv(gym.Env):
         reward += -1 * dif_curr
         # +1 if your opp loses a card
         reward += 1 * dif_opp
-        logger.debug(f'Reward: {reward}')
+        if debug:
+            logger.debug(f'Reward: {reward}')
+
+        if recording:
+            self.recorder.add(whose_a, action, reward, self.game.game_over, prev_mask, prev_obs)
 
         return (obs, reward, self.game.game_over, dict())
 
-    def reset(self):
-        self.game = Game(self.num_human_players, self.p_first_turn)
+    def seed(self, seed=None):
+        '''
+        Seed the random number generator for all following games
+
+        seed: Int, numpy SeedSequence, or None for fresh entropy from the OS
+        '''
+        self.rng = np.random.default_rng(seed)
+        return [seed]
+
+    def reset(self, seed=None):
+        '''
+        Start a new game
+
+        seed: Seed the env first, so this and following games can be replayed. See seed()
+        '''
+        if seed is not None:
+            self.seed(seed)
+        if self.recorder is not None:
+            # Each recorded game shuffles with its own seed, so it can be replayed on its own
+            game_seed = int(self.rng.integers(2**63))
+            self.recorder.begin_episode(game_seed)
+            self.game = Game(self.num_human_players, self.p_first_turn, np.random.default_rng(game_seed))
+        else:
+            self.game = Game(self.num_human_players, self.p_first_turn, self.rng)
+
+    def close(self):
+        '''
+        Write any recorded actions still buffered, and close the record file
+        '''
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
     def render(self, mode='human'):
         if self.game is not None:
@@ -833,12 +1124,28 @@ class CoupEnv(gym.Env):
             return None
 
         a = self.game.get_valid_actions()
-        logger.debug(f'Valid actions: {[self.actions[x] for x in a]}')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Valid actions: {[self.actions[x] for x in a]}')
         if text:
             return [self.actions[x] for x in a]
         else:
             return a
 
+    def get_valid_action_mask(self, bitmask=False):
+        '''
+        Get the valid actions without building a list
+
+        bitmask: If True, return an int with bit i set if action i is valid.
+                 Otherwise return a read-only bool array with one element per action.
+        '''
+        if self.game is None:
+            return None
+
+        mask = self.game.get_valid_action_mask()
+        if bitmask:
+            return mask
+        return VALID_ACTION_ARRAY_BY_MASK[mask]
+
     def get_obs(self, p2_view=False, text=False):
         '''
         Return the current state of the environment
@@ -871,6 +1178,9 @@ class CoupEnv(gym.Env):
         Note: many observations will never occur in game
               ex: All 4 cards are the same. Both players have all cards face up.
         '''
+        if not text:
+            return self.game.get_flat_obs(p2_view=p2_view)
+
         p1cards, p2cards, p1coins, p2coins, p1la, p2la, wa = self.game.get_obs(p2_view=p2_view, text=text)
 
         obs = []
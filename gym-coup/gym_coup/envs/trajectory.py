@@ -0,0 +1,192 @@
+import os
+import numpy as np
+from gym_coup.envs.coup_env import Game, CoupEnv
+
+# Fixed width record of one action in a game, packed without padding
+RECORD_DTYPE = np.dtype([
+    ('episode', '<u8'),    # Episode id, counting up from 0 in each file
+    ('step', '<u4'),       # Action number in the episode, from 0
+    ('player', 'i1'),      # Player taking the action, 0 or 1
+    ('action', 'i1'),      # Action number
+    ('reward', 'i1'),      # Reward to the player for the action
+    ('done', '?'),         # Whether the action ended the game
+    ('valid_mask', '<u4'), # Bitmask of the valid actions, see CoupEnv.get_valid_action_mask
+    ('obs', 'i1', (21,)),  # Observation the action was chosen from, from the player's view
+    ('seed', '<u8'),       # Seed of the episode's deck shuffles
+])
+
+# File header: magic, format version, record size
+_MAGIC = b'COUPTRJ\x00'
+_VERSION = 1
+HEADER_SIZE = 16
+
+_ACTION_NUMBERS = {name: a for a, name in CoupEnv.actions.items()}
+
+def _make_header():
+    return _MAGIC + np.array([_VERSION, RECORD_DTYPE.itemsize], dtype='<u4').tobytes()
+
+def _check_header(header, filename):
+    if len(header) < HEADER_SIZE or header[:8] != _MAGIC:
+        raise ValueError(f'{filename} is not a Coup trajectory file')
+    version, itemsize = np.frombuffer(header[8:HEADER_SIZE], dtype='<u4')
+    if version != _VERSION or itemsize != RECORD_DTYPE.itemsize:
+        raise ValueError(f'{filename} has trajectory format version {version}, expected {_VERSION}')
+
+class TrajectoryWriter:
+    '''
+    Append-only binary log of every action in a series of games
+
+    Records are RECORD_DTYPE, buffered and written a block at a time.
+    Appending to an existing file continues its episode ids.
+    Only one writer should append to a file at a time.
+    '''
+    def __init__(self, filename, block_size=4096):
+        '''
+        filename:   Path of the file to append to. Created if it doesn't exist
+        block_size: Number of records buffered before writing them
+        '''
+        self.filename = filename
+        self.block_size = block_size
+        self.buffer = []
+
+        self.file = open(filename, 'a+b')
+        self.file.seek(0)
+        header = self.file.read(HEADER_SIZE)
+        if not header:
+            self.file.write(_make_header())
+            self.next_episode = 0
+        else:
+            _check_header(header, filename)
+            # Drop a partly written record at the end, from a writer that was killed
+            size = os.path.getsize(filename)
+            num_records = (size - HEADER_SIZE) // RECORD_DTYPE.itemsize
+            end = HEADER_SIZE + num_records * RECORD_DTYPE.itemsize
+            if end != size:
+                self.file.truncate(end)
+            self.next_episode = 0
+            if num_records:
+                self.file.seek(end - RECORD_DTYPE.itemsize)
+                last = np.frombuffer(self.file.read(RECORD_DTYPE.itemsize), dtype=RECORD_DTYPE)
+                self.next_episode = int(last['episode'][0]) + 1
+        self.file.seek(0, os.SEEK_END)
+
+        self.episode = None
+        self.seed = 0
+        self.step = 0
+
+    def begin_episode(self, seed):
+        '''
+        Start recording a new game
+
+        seed: Int seed of the game's deck shuffles
+        '''
+        self.episode = self.next_episode
+        self.next_episode += 1
+        self.seed = seed
+        self.step = 0
+
+    def add(self, player, action, reward, done, valid_mask, obs):
+        '''
+        Record an action in the current game
+
+        action: Action number or name
+        obs:    Observation the action was chosen from, from the player's view
+        '''
+        if isinstance(action, str):
+            action = _ACTION_NUMBERS[action]
+        self.buffer.append((self.episode, self.step, player, action, reward, done, valid_mask, obs, self.seed))
+        self.step += 1
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered records to the file
+        '''
+        if self.buffer:
+            self.file.write(np.array(self.buffer, dtype=RECORD_DTYPE).tobytes())
+            self.buffer.clear()
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TrajectoryReader:
+    '''
+    Read a trajectory file written by TrajectoryWriter, as NumPy structured arrays
+    The records are memory mapped, so files larger than memory can be streamed.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            _check_header(f.read(HEADER_SIZE), filename)
+        num_records = (os.path.getsize(filename) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        if num_records:
+            self.records = np.memmap(filename, dtype=RECORD_DTYPE, mode='r',
+                                     offset=HEADER_SIZE, shape=(num_records,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def iter_chunks(self, chunk_size=1 << 20):
+        '''
+        Stream the records in order
+
+        chunk_size: Max number of records in each chunk
+
+        Yields read-only structured arrays of RECORD_DTYPE
+        '''
+        for start in range(0, len(self.records), chunk_size):
+            yield self.records[start:start + chunk_size]
+
+    def iter_episodes(self, chunk_size=1 << 20, complete_only=True):
+        '''
+        Stream the records one game at a time
+
+        chunk_size:    Number of records read at once
+        complete_only: Skip games without a final record, e.g. when the env
+                       was closed mid-game or the writer was killed
+
+        Yields structured arrays of RECORD_DTYPE, one game each
+        '''
+        carry = None
+        for chunk in self.iter_chunks(chunk_size):
+            if carry is not None:
+                chunk = np.concatenate([carry, chunk])
+            # Start of each game in the chunk
+            starts = np.flatnonzero(np.diff(chunk['episode'])) + 1
+            bounds = [0] + starts.tolist()
+            for s, e in zip(bounds[:-1], bounds[1:]):
+                if not complete_only or chunk['done'][e - 1]:
+                    yield chunk[s:e]
+            # The last game may continue in the next chunk
+            carry = chunk[bounds[-1]:]
+        if carry is not None and len(carry) and (not complete_only or carry['done'][-1]):
+            yield carry
+
+def replay_episode(records):
+    '''
+    Simulate a recorded game again from its seed and actions,
+    checking each observation against the recording
+
+    records: Structured array of RECORD_DTYPE for one game, from its first action
+
+    Returns the Game in its final state
+    '''
+    game = Game(0, int(records['player'][0]), np.random.default_rng(int(records['seed'][0])))
+    for r in records:
+        obs = game.get_flat_obs(p2_view=r['player'] == 1)
+        if obs != tuple(r['obs'].tolist()):
+            raise ValueError(f'Episode {r["episode"]} step {r["step"]} does not match the recorded observation')
+        getattr(game, CoupEnv.actions[int(r['action'])])()
+    return game
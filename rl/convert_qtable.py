@@ -0,0 +1,24 @@
+import argparse
+from coup_rl.qtable import QTable
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert an agent file between dense, sparse, and compact Q-table storage, or compressed and uncompressed files')
+    parser.add_argument('src', help='Agent file to convert')
+    parser.add_argument('dst', help='File to save the converted agent to')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--sparse', action='store_true', help='Only store visited states')
+    group.add_argument('--compact', action='store_true', help='Only store reachable states')
+    group.add_argument('--dense', action='store_true', help='Store the full table, readable by older versions')
+    parser.add_argument('-u', '--uncompressed', action='store_true', help='Save without compression, so a dense table can be memory mapped')
+    args = parser.parse_args()
+
+    if args.sparse:
+        sparse = True
+    elif args.dense:
+        sparse = False
+    else:
+        sparse = None
+
+    qtable = QTable()
+    qtable.load(args.src, sparse=sparse, compact=args.compact)
+    qtable.save(args.dst, compress=not args.uncompressed)
\ No newline at end of file
@@ -1,5 +1,16 @@
 from coup_rl.human_v_agent import Human_v_Agent
 from coup_rl.self_play import SelfPlay
+from coup_rl.parallel_self_play import ParallelSelfPlay
+from coup_rl.actor_learner import ActorLearner
+from coup_rl.batch_self_play import BatchSelfPlay
 from coup_rl.qtable import QTable
+from coup_rl.sparse_table import SparseTable
+from coup_rl.compact_table import CompactTable
 from coup_rl.agent import Agent
+from coup_rl.metrics import TrainingMetrics
+from coup_rl.replay import ReplayBuffer
+from coup_rl.ismcts import ISMCTSAgent
+from coup_rl.offline import fitted_q_iteration
+from coup_rl.evaluate import evaluate_match, round_robin
+from coup_rl.solver import StateSpace, solve_qtable
 from coup_rl.utils import get_num_changed, has_converged
\ No newline at end of file
@@ -0,0 +1,254 @@
+import time
+import logging
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import gym
+import gym_coup
+from coup_rl.qtable import QTable
+from coup_rl.agent import Agent
+from coup_rl.self_play import SelfPlay, play_game
+from coup_rl.parallel_self_play import WORKER_ERROR, get_worker_message
+from coup_rl.utils import TRANSITION_DTYPE
+
+logging.basicConfig()
+logger = logging.getLogger('coup_rl')
+
+# Message from an actor that it switched to the snapshot of a version: (HOLDING, actor, version).
+# The version is None once the actor is done reading snapshots
+HOLDING = 'holding'
+
+class ActorLearner(SelfPlay):
+    '''
+    Self-play training split into actor processes and a single learner
+
+    Actors play games with a read-only snapshot of the QTable, and send
+    the transitions they see to the learner in batches. This process is
+    the learner, and the only one that writes the QTable. It applies each
+    batch with QTable.update_batch, and periodically copies the table into
+    a new snapshot for the actors.
+
+    Snapshots are double buffered in shared memory. Actors switch to the
+    latest snapshot between games, and tell the learner which version they hold.
+    The learner only writes the other buffer once every actor holds the
+    latest version, so no actor ever reads a snapshot while it is written.
+    An actor that has sent k * sync_interval batches waits for version k
+    before its next game, so the snapshots it plays with don't depend on
+    how fast the learner runs.
+    '''
+    def __init__(self,
+                 filepath,
+                 learning_rate=None,
+                 discount_factor=None,
+                 epsilon=None,
+                 log_level=None,
+                 sparse=False,
+                 dtype=None,
+                 full_checkpoint=10,
+                 actors=None,
+                 batch_size=4096,
+                 sync_interval=10,
+                 seed=None):
+        '''
+        filepath:        Path for file ending in .npz
+        learning_rate:   Float (0, 1]
+        discount_factor: Float [0, 1]
+        epsilon:         Float [0, 1]
+        log_level:       coup_rl log level
+        sparse:          Store the learner's QTable sparsely. Snapshots are always dense.
+        dtype:           Numpy float dtype of the Q-values
+        full_checkpoint: Save a full file every this many checkpoints, and deltas between
+        actors:          Number of actor processes. Default is the number of CPUs
+        batch_size:      Min number of transitions an actor sends at once
+        sync_interval:   Number of batches the learner applies between snapshots
+        seed:            Int seed. Each actor gets independent streams spawned from it.
+                         With 1 actor, a run can be replayed exactly.
+                         With more, the order batches arrive in still varies.
+
+        Must supply lr, df, eps when creating new table.
+        Otherwise, supplying them replaces params in existing file.
+        '''
+        super().__init__(filepath,
+                         learning_rate=learning_rate,
+                         discount_factor=discount_factor,
+                         epsilon=epsilon,
+                         log_level=log_level,
+                         sparse=sparse,
+                         dtype=dtype,
+                         full_checkpoint=full_checkpoint,
+                         seed=seed)
+        self.actors = actors or mp.cpu_count()
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self.log_level = log_level
+
+    def train(self, episodes, checkpoint, conv_eps):
+        '''
+        episodes:   Number of episodes to run
+        checkpoint: Number of episodes to save a new agent file after
+        conv_eps:   Convergence epsilon. Max difference for convergence
+
+        Actors only send transitions at the end of a game, so the learner
+        always has whole episodes applied. A checkpoint is saved once at least
+        that many episodes are applied, and named with the checkpoint boundary,
+        like single process training. It can include a few episodes past it,
+        from the rest of the batch that crossed it.
+        '''
+        shape = self.qtable.table.shape
+        dtype = self.qtable.dtype
+        snapshot_size = int(np.prod(shape)) * dtype.itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(2 * snapshot_size, 1))
+        snapshots = np.ndarray((2,) + shape, dtype=dtype, buffer=shm.buf)
+        self.broadcast(snapshots[0])
+
+        ctx = mp.get_context('spawn')
+        version = ctx.Value('q', 0, lock=False)
+        stop = ctx.Event()
+        batches = ctx.Queue(maxsize=4 * self.actors)
+        params = [self.qtable.learning_rate, self.qtable.discount_factor, self.qtable.epsilon]
+        procs = []
+        for i, actor_seed in enumerate(self.seed_sequence.spawn(self.actors)):
+            # Split the episodes as evenly as possible
+            quota = episodes // self.actors + (i < episodes % self.actors)
+            procs.append(ctx.Process(target=_actor,
+                                     args=(i, shm.name, shape, dtype, params, version, stop, batches,
+                                           quota, self.batch_size, self.sync_interval, self.log_level, actor_seed)))
+        try:
+            for p in procs:
+                p.start()
+
+            applied = 0
+            num_batches = 0
+            next_ckpt = min(checkpoint, episodes)
+            running = len(procs)
+            converged = False
+            # Snapshot version each actor is reading, None once it is done
+            holding = [0] * len(procs)
+            while running:
+                msg = get_worker_message(batches, procs)
+                if msg is None:
+                    running -= 1
+                    continue
+                if msg[0] == HOLDING:
+                    holding[msg[1]] = msg[2]
+                elif not converged:
+                    num_eps, transitions = msg
+                    self.qtable.update_batch(transitions)
+                    applied += num_eps
+                    num_batches += 1
+                if converged:
+                    # Drain what the actors sent before they stopped
+                    continue
+
+                # The next buffer is free once no actor holds the version before the current one
+                if (num_batches >= (version.value + 1) * self.sync_interval and
+                    all([v is None or v == version.value for v in holding])):
+                    self.broadcast(snapshots[(version.value + 1) % 2])
+                    version.value += 1
+
+                if msg[0] == HOLDING:
+                    continue
+
+                if applied >= next_ckpt:
+                    # Name it with the last boundary crossed, if a batch crossed several
+                    ckpt = episodes if applied >= episodes else applied // checkpoint * checkpoint
+                    converged = self.save_checkpoint(ckpt, episodes, conv_eps)
+                    next_ckpt = min((applied // checkpoint + 1) * checkpoint, episodes)
+                    if converged:
+                        stop.set()
+
+            for p in procs:
+                p.join()
+        finally:
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+            del snapshots
+            shm.close()
+            shm.unlink()
+
+    def broadcast(self, snapshot):
+        '''
+        Copy the learner's QTable into a snapshot buffer
+
+        snapshot: Dense array with the shape and dtype of the QTable
+        '''
+        if self.qtable.is_sparse:
+            # States are never removed, so only the allocated rows need writing
+            flat = snapshot.reshape(-1, snapshot.shape[-1])
+            states, rows = self.qtable.table.get_states_and_rows()
+            flat[states] = rows
+        else:
+            snapshot[...] = self.qtable.table
+
+def _actor(index, shm_name, shape, dtype, params, version, stop, batches,
+           episodes, batch_size, sync_interval, log_level, seed):
+    '''
+    Actor process for ActorLearner
+    Plays episodes with the latest snapshot, sends (num episodes, transitions) to batches,
+    (HOLDING, index, version) whenever it switches snapshots, then None when done
+    '''
+    if log_level is not None:
+        logger.setLevel(log_level)
+
+    try:
+        _run_actor(index, shm_name, shape, dtype, params, version, stop, batches,
+                   episodes, batch_size, sync_interval, seed)
+    except Exception:
+        # Let the learner fail fast instead of waiting for this actor's batches
+        batches.put((WORKER_ERROR, traceback.format_exc()))
+        raise
+
+def _run_actor(index, shm_name, shape, dtype, params, version, stop, batches,
+               episodes, batch_size, sync_interval, seed):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    snapshots = np.ndarray((2,) + shape, dtype=dtype, buffer=shm.buf)
+    snapshots.flags.writeable = False
+    qtable = QTable(learning_rate=params[0], discount_factor=params[1], epsilon=params[2])
+    try:
+        env_seed, p1_seed, p2_seed = seed.spawn(3)
+        env = gym.make('coup-v0')
+        env.seed(env_seed)
+        transitions = []
+        p1 = Agent(1, env, qtable, transitions=transitions, rng=np.random.default_rng(p1_seed))
+        p2 = Agent(2, env, qtable, transitions=transitions, rng=np.random.default_rng(p2_seed))
+
+        curr_version = None
+        def switch_snapshot():
+            nonlocal curr_version
+            if version.value != curr_version:
+                curr_version = version.value
+                qtable.table = snapshots[curr_version % 2]
+                batches.put((HOLDING, index, curr_version))
+
+        num_eps = 0
+        num_batches = 0
+        for ep in range(episodes):
+            if stop.is_set():
+                break
+            switch_snapshot()
+
+            env.reset()
+            play_game(env, p1, p2, render=False)
+            num_eps += 1
+
+            if len(transitions) >= batch_size or ep == episodes - 1:
+                batches.put((num_eps, np.array(transitions, dtype=TRANSITION_DTYPE)))
+                transitions.clear()
+                num_eps = 0
+                num_batches += 1
+                if num_batches % sync_interval == 0 and ep < episodes - 1:
+                    # Wait for the snapshot with these batches in it. Keep switching meanwhile,
+                    # since the learner may need every actor on the latest version to write it
+                    while version.value < num_batches // sync_interval and not stop.is_set():
+                        switch_snapshot()
+                        time.sleep(0.001)
+        qtable.table = None
+        batches.put((HOLDING, index, None))
+        batches.put(None)
+    finally:
+        # Drop the views into shared memory before closing it
+        qtable.table = None
+        del snapshots
+        shm.close()
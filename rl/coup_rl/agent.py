@@ -1,16 +1,34 @@
-import random
+import time
 import logging
-from coup_rl.utils import convert_obs_to_q_index
+import numpy as np
+from gym_coup.envs.coup_env import (VALID_ACTIONS_BY_MASK, VALID_ACTION_TABLE, PHASE_TURN_BEGIN, NONE,
+                                    get_coins_bucket, get_valid_action_index)
+from coup_rl.utils import convert_obs_to_state_offset, get_exchange_state_offsets, STORED_ACTIONS_MASK
 
 logging.basicConfig()
 logger = logging.getLogger('coup_rl')
 
+# Valid actions stored in the QTable (< 26) for each valid action mask
+_STORED_ACTIONS_BY_MASK = {m: np.array([a for a in acts if a < 26]) for m, acts in VALID_ACTIONS_BY_MASK.items()}
+# Valid exchange returns (action - 26) for each valid action mask
+_EXCHANGE_RETURNS_BY_MASK = {m: np.array([a - 26 for a in acts if a >= 26]) for m, acts in VALID_ACTIONS_BY_MASK.items()}
+# Valid beginning of turn actions for each number of coins and opponent coins
+_TURN_BEGIN_ACTIONS = [[np.array(VALID_ACTIONS_BY_MASK[int(VALID_ACTION_TABLE.flat[
+                            get_valid_action_index(PHASE_TURN_BEGIN, get_coins_bucket(c, o), NONE, 0)])])
+                        for o in range(13)] for c in range(13)]
+
 class Agent:
-    def __init__(self, id, env, qtable):
+    def __init__(self, id, env, qtable, transitions=None, metrics=None, rng=None):
         '''
-        id:     Agent id (1 or 2)
-        env:    gym-coup env
-        qtable: QTable object with table, learning params
+        id:          Agent id (1 or 2)
+        env:         gym-coup env
+        qtable:      QTable object with table, learning params
+        transitions: List to append transitions to instead of updating the QTable.
+                     Each is (state, action, reward, next state, next valid mask, done).
+                     See utils.TRANSITION_DTYPE
+        metrics:     TrainingMetrics to record steps and timings to
+        rng:         Numpy Generator for exploration. Default is a new unseeded one.
+                     Give each agent its own, e.g. from SeedSequence.spawn
         '''
         self.id = id
         self.env = env
@@ -18,32 +36,42 @@ class Agent:
         self.learning_rate = self.qtable.learning_rate
         self.discount_factor = self.qtable.discount_factor
         self.epsilon = self.qtable.epsilon
+        self.transitions = transitions
+        self.metrics = metrics
 
-        # State-action tuple from the last step that was at the beginning of turn
+        # (State offset, action) from the last step that was stored in the QTable
         self.prev_state_action = None
         # Reward accumulated since last beginning-of-turn
         self.reward = 0
 
-        random.seed()
+        self.rng = rng if rng is not None else np.random.default_rng()
 
     def step(self):
         '''
         Take one action in the env
         '''
-        valid_actions = self.env.get_valid_actions()
+        timed = self.metrics is not None
+        if timed:
+            t = time.perf_counter()
+
+        # Tuple of valid actions, precomputed for each mask
+        mask = self.env.get_valid_action_mask(bitmask=True)
+        valid_actions = VALID_ACTIONS_BY_MASK[mask]
         is_p2 = self.id == 2
         obs = self.env.get_obs(p2_view=is_p2)
-        state = convert_obs_to_q_index(obs)
+        state = convert_obs_to_state_offset(obs)
         q_max = None
 
-        if random.random() < self.epsilon:
+        if self.rng.random() < self.epsilon:
             # Exploration
-            action = random.choice(valid_actions)
+            action = valid_actions[self.rng.integers(len(valid_actions))]
         else:
             # Exploitation
-            action, q_max = self.get_best_action(state, valid_actions, obs)
+            action, q_max = self.get_best_action(state, mask, obs)
 
-        state_action = tuple(state + [action])
+        state_action = (state, action)
+        if timed:
+            t = self.metrics.add_time('lookup', t)
 
         # If not an exchange return
         if action < 26:
@@ -51,21 +79,33 @@ class Agent:
                 # On first turn
                 self.prev_state_action = state_action
             # prev_state_action will always have action < 26
+            elif self.transitions is not None:
+                # Leave the update to whoever consumes the transition
+                self.add_transition(state, mask & STORED_ACTIONS_MASK, False)
+                self.prev_state_action = state_action
             else:
                 if q_max is None:
                     # Random choice was selected above
                     # Get Q value for best action from new state
-                    _, q_max = self.get_best_action(state, valid_actions, obs)
+                    _, q_max = self.get_best_action(state, mask, obs)
 
                 self.update_q_value(q_max)
                 # Store state and action that's about to be taken
                 self.prev_state_action = state_action
 
+        if timed:
+            t = self.metrics.add_time('update', t)
+
         # Take action
-        logger.debug(f'P{self.id}: {self.env.actions[action]}')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'P{self.id}: {self.env.actions[action]}')
         obs, reward, done, info = self.env.step(action)
         self.reward += reward
 
+        if timed:
+            self.metrics.add_time('env', t)
+            self.metrics.add_step(action)
+
         return obs, reward, done, info
 
     def update_q_value(self, q_max):
@@ -76,91 +116,65 @@ class Agent:
         q_max: Double, max Q-value from new state
         '''
         # Get Q value for previous state-action
-        q_old = self.qtable.get(self.prev_state_action)
+        state, action = self.prev_state_action
+        q_old = self.qtable.get_value(state, action)
 
         # Q Learning algorithm
         q_new = q_old + self.learning_rate * (self.reward + self.discount_factor * q_max - q_old)
-        self.qtable.set(self.prev_state_action, q_new)
-        logger.debug(f'Updated Q-value for {self.prev_state_action} to {q_new}')
+        self.qtable.set_value(state, action, q_new)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Updated Q-value for {self.prev_state_action} to {q_new}')
 
         self.reward = 0
 
-    def get_best_action(self, state, actions, obs):
+    def add_transition(self, next_state, next_mask, done):
+        '''
+        Record the previous state-action, the reward since, and the new (current) state
+        instead of updating the Q-value
+
+        next_state: Current state as a flat QTable state offset
+        next_mask:  Bitmask of the valid actions in next_state that are stored in the QTable
+        done:       Whether the game is over
+        '''
+        state, action = self.prev_state_action
+        self.transitions.append((state, action, self.reward, next_state, next_mask, done))
+        self.reward = 0
+
+    def end_game(self):
+        '''
+        Final update once the game is over, with no future value
+        The next game then starts fresh, so its first action isn't treated
+        as following the last action of this one
+        '''
+        if self.prev_state_action is not None:
+            if self.transitions is not None:
+                self.add_transition(0, 0, True)
+            else:
+                self.update_q_value(0)
+        self.prev_state_action = None
+        self.reward = 0
+
+    def get_best_action(self, state, mask, obs):
         '''
         Get the best action from the current state, and its Q-value
 
-        state: Current state in QTable index format
-        actions: List of valid actions (integers)
+        state: Current state as a flat QTable state offset
+        mask: Valid actions bitmask, from CoupEnv.get_valid_action_mask
         obs: Current state in original observation format
         '''
+        actions = VALID_ACTIONS_BY_MASK[mask]
         if actions[0] < 26:
             # Actions stored in QTable
-
-            if len(actions) == 1:
-                # No need for other calculations, do the only action
-                action = actions[0]
-                q_max = self.qtable.get(tuple(state + [action]))
-            else:
-                possible_state_actions = [tuple(state + [a]) for a in actions]
-                state_action, q_max = self.qtable.get_max_ind(possible_state_actions)
-                # Best action from this state
-                action = state_action[-1]
+            action, q_max = self.qtable.get_best_action(state, _STORED_ACTIONS_BY_MASK[mask])
         else:
             # Actions not stored in QTable
             # Exchange Return
-            # Get best Q values of state after each possible exchange return
-
-            # Get states after each possible exchange return
-            # Then for each new state, get all possible actions
-            # Each element of next_state_actions will be a list of state-actions for a single new state
-            next_state_actions = []
-            for a in actions:
-                cards_remove = self.env.actions[a].split('_')[-1]
-                # List of ints of indexes of cards to keep
-                cards_keep = [i for i in range(4) if str(i+1) not in cards_remove]
-
-                next_obs = list(obs)
-                # Replace cards
-                next_obs[0] = next_obs[cards_keep[0]]
-                next_obs[1] = next_obs[cards_keep[1]]
-                next_obs[2] = next_obs[3] = -1
-                # Replace is card face up
-                next_obs[8] = next_obs[8+cards_keep[0]]
-                next_obs[9] = next_obs[8+cards_keep[1]]
-                next_obs[10] = next_obs[11] = -1
-
-                next_st = convert_obs_to_q_index(next_obs)
-                next_state_actions.append(next_st)
-
-            # Each possible state-action pair
-            # All states will have same actions since
-            # they have same number of coins
-            curr_player_coins = obs[16]
-            opp_player_coins = obs[17]
-            valid = []
-            if curr_player_coins >= 10:
-                # Coup
-                valid = [2]
-            else:
-                # Income FA Tax Exchange
-                valid = [0, 1, 3, 5]
-                if curr_player_coins >= 3:
-                    # Assassinate
-                    valid.append(4)
-                if curr_player_coins >= 7:
-                    # Coup
-                    valid.append(2)
-                if opp_player_coins > 0:
-                    # Steal
-                    valid.append(6)
-
-            next_state_actions = [[next_st + [a] for a in valid] for next_st in next_state_actions]
-
-            # Get best action for each new state
-            q_vals = [[self.qtable.get(tuple(x)) for x in lst] for lst in next_state_actions]
-            q_vals = [max(x) for x in q_vals]
-            ind = q_vals.index(max(q_vals))
-            action = actions[ind]
+            # Value each return by the best beginning of turn action
+            # in the state after it, with a single gather from the table.
+            # All states will have the same actions since they have the same number of coins
+            next_states = get_exchange_state_offsets(obs)[_EXCHANGE_RETURNS_BY_MASK[mask]]
+            q_vals = self.qtable.get_values(next_states, _TURN_BEGIN_ACTIONS[obs[16]][obs[17]]).max(axis=1)
+            action = actions[q_vals.argmax()]
             # This is an estimate, so not a true Q-value. Leave empty.
             q_max = None
 
@@ -0,0 +1,153 @@
+import logging
+import numpy as np
+from gym_coup.envs.batch_coup_env import BatchCoupEnv
+from coup_rl.self_play import SelfPlay
+from coup_rl.evaluate import get_batch_greedy_actions
+from coup_rl.utils import convert_obs_to_state_offsets, STORED_ACTIONS_MASK, TRANSITION_DTYPE
+
+logging.basicConfig()
+logger = logging.getLogger('coup_rl')
+
+class BatchSelfPlay(SelfPlay):
+    '''
+    Self-play training of many games at once in a BatchCoupEnv
+
+    Every step, both players of every game choose epsilon-greedy actions
+    with one vectorized lookup, and the transitions of the step are applied
+    with QTable.update_batch. These are the same transitions an Agent
+    records, but a state-action seen several times in one step is moved
+    toward the mean of its targets, like ActorLearner's batches.
+    '''
+    def __init__(self,
+                 filepath,
+                 learning_rate=None,
+                 discount_factor=None,
+                 epsilon=None,
+                 log_level=None,
+                 sparse=False,
+                 dtype=None,
+                 full_checkpoint=10,
+                 compact=False,
+                 num_envs=1024,
+                 seed=None):
+        '''
+        filepath:        Path for file ending in .npz
+        learning_rate:   Float (0, 1]
+        discount_factor: Float [0, 1]
+        epsilon:         Float [0, 1]
+        log_level:       coup_rl log level
+        sparse:          Store the QTable sparsely, only allocating visited states
+        dtype:           Numpy float dtype of the Q-values
+        full_checkpoint: Save a full file every this many checkpoints, and deltas between
+        compact:         Store only the reachable states of the QTable
+        num_envs:        Number of games played at once
+        seed:            Int seed to replay a training run exactly. None for fresh entropy.
+
+        Must supply lr, df, eps when creating new table.
+        Otherwise, supplying them replaces params in existing file.
+        '''
+        super().__init__(filepath,
+                         learning_rate=learning_rate,
+                         discount_factor=discount_factor,
+                         epsilon=epsilon,
+                         log_level=log_level,
+                         sparse=sparse,
+                         dtype=dtype,
+                         full_checkpoint=full_checkpoint,
+                         seed=seed,
+                         headless=True,
+                         compact=compact)
+        self.num_envs = num_envs
+        env_seed, rng_seed = self.seed_sequence.spawn(2)
+        self.batch_env = BatchCoupEnv(num_envs=num_envs)
+        self.batch_env.seed(env_seed)
+        self.rng = np.random.default_rng(rng_seed)
+
+    def train(self, episodes, checkpoint, conv_eps):
+        '''
+        episodes:   Number of episodes to run
+        checkpoint: Number of episodes to save a new agent file after
+        conv_eps:   Convergence epsilon. Max difference for convergence
+
+        A checkpoint is saved once at least that many games have finished, and named
+        with the checkpoint boundary. It also has the updates of the games still in play.
+        '''
+        env = self.batch_env
+        env.reset()
+        n = self.num_envs
+        games = np.arange(n)
+        action_bits = np.uint32(1) << np.arange(32, dtype=np.uint32)
+
+        # Last stored state-action of each player in each game, and the reward since it
+        has_prev = np.zeros((n, 2), dtype=bool)
+        prev_state = np.zeros((n, 2), dtype=np.int64)
+        prev_action = np.zeros((n, 2), dtype=np.int64)
+        reward = np.zeros((n, 2))
+
+        finished = 0
+        next_ckpt = min(checkpoint, episodes)
+        converged = False
+        try:
+            while finished < episodes and not converged:
+                whose = env.whose_action.astype(np.int64)
+                obs = env.get_obs(whose == 1)
+                masks = env.get_valid_action_mask()
+
+                # Epsilon-greedy, with a uniformly random valid action when exploring
+                actions = get_batch_greedy_actions(self.qtable, obs, masks)
+                explore = np.flatnonzero(self.rng.random(n) < self.qtable.epsilon)
+                if len(explore):
+                    actions[explore] = np.where(masks[explore], self.rng.random((len(explore), masks.shape[1])), -1).argmax(axis=1)
+
+                # Stored actions end the player's previous transition and start a new one
+                stored = np.flatnonzero(actions < 26)
+                p = whose[stored]
+                states = convert_obs_to_state_offsets(obs[stored])
+                cont = has_prev[stored, p]
+                g = stored[cont]
+                next_masks = (masks[g].astype(np.uint32) * action_bits).sum(axis=1) & STORED_ACTIONS_MASK
+                transitions = [self.get_transitions(prev_state[g, p[cont]], prev_action[g, p[cont]],
+                                                    reward[g, p[cont]], states[cont], next_masks, False)]
+                reward[g, p[cont]] = 0
+                has_prev[stored, p] = True
+                prev_state[stored, p] = states
+                prev_action[stored, p] = actions[stored]
+
+                _, rewards, dones, _ = env.step(actions)
+                # The other player gets feedback for what happened too
+                reward[games, whose] += rewards
+                reward[games, 1 - whose] -= rewards
+
+                # Final transition of each player of finished games, with no future value
+                done = np.flatnonzero(dones)
+                if len(done):
+                    for q in (0, 1):
+                        g = done[has_prev[done, q]]
+                        transitions.append(self.get_transitions(prev_state[g, q], prev_action[g, q],
+                                                                reward[g, q], 0, 0, True))
+                    has_prev[done] = False
+                    reward[done] = 0
+                self.qtable.update_batch(np.concatenate(transitions))
+
+                finished += len(done)
+                if finished >= next_ckpt:
+                    # Name it with the last boundary crossed, if a step crossed several
+                    ckpt = episodes if finished >= episodes else finished // checkpoint * checkpoint
+                    converged = self.save_checkpoint(ckpt, episodes, conv_eps)
+                    next_ckpt = min((finished // checkpoint + 1) * checkpoint, episodes)
+        finally:
+            self.env.close()
+
+    @staticmethod
+    def get_transitions(states, actions, rewards, next_states, next_masks, done):
+        '''
+        Structured array of utils.TRANSITION_DTYPE from arrays of each field
+        '''
+        t = np.zeros(len(states), dtype=TRANSITION_DTYPE)
+        t['state'] = states
+        t['action'] = actions
+        t['reward'] = rewards
+        t['next_state'] = next_states
+        t['next_mask'] = next_masks
+        t['done'] = done
+        return t
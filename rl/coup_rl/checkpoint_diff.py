@@ -0,0 +1,237 @@
+import os
+import re
+import zipfile
+import numpy as np
+from coup_rl.qtable import _memmap_npz_member, check_delta_base
+from coup_rl.utils import get_decision_masks, get_greedy_actions
+
+# Names of the QTable dimensions, for the per dimension breakdown
+DIM_NAMES = ['cards', 'opp_cards', 'face_up', 'opp_face_up', 'coins', 'opp_coins', 'action']
+
+# Checkpoints saved by SelfPlay end in the 10 digit number of episodes
+CHECKPOINT_RE = re.compile(r'^(.*?)(\d{10})\.npz$')
+
+def _read_npy_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+def _get_chain(filename):
+    '''
+    Follow a delta file back to the last full file
+
+    Returns (full file, list of delta files from oldest to newest)
+    '''
+    deltas = []
+    while True:
+        with np.load(filename) as data:
+            if 'delta_cells' not in data:
+                return filename, deltas[::-1]
+            base = os.path.join(os.path.dirname(filename), str(data.get('base')))
+            check_delta_base(filename, data, base)
+        deltas.append(filename)
+        filename = base
+
+def _get_delta_cells(deltas):
+    '''
+    Cells set by a chain of delta files, with the value from the newest delta
+
+    Returns (flat cell indices, values), sorted by cell
+    '''
+    if not deltas:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    cells = []
+    vals = []
+    for filename in deltas:
+        with np.load(filename) as data:
+            cells.append(data.get('delta_cells'))
+            vals.append(data.get('delta_values'))
+    # Newest first, so np.unique keeps the last value set
+    cells = np.concatenate(cells[::-1])
+    vals = np.concatenate(vals[::-1])
+    cells, first = np.unique(cells, return_index=True)
+    return cells, vals[first]
+
+class SavedTableReader:
+    '''
+    Read a saved QTable a chunk of states at a time, without loading it all into memory
+
+    Works with every format QTable.save and save_delta write:
+    uncompressed dense tables are memory mapped, compressed dense tables are
+    decompressed as a stream, sparse tables fill in their rows, and delta
+    files are applied on top of the full file they are based on.
+    '''
+    def __init__(self, filename):
+        '''
+        filename: Path of a saved QTable
+        '''
+        self.filename = filename
+        full, deltas = _get_chain(filename)
+        self._full = full
+        self._delta_cells, self._delta_vals = _get_delta_cells(deltas)
+
+        self._sparse = None
+        with np.load(full) as data:
+            if 'qtable' not in data:
+                self.shape = tuple(data.get('qtable_shape'))
+                states = data.get('qtable_states')
+                order = np.argsort(states)
+                self._sparse = (states[order], data.get('qtable_rows')[order])
+                self.dtype = self._sparse[1].dtype
+        if self._sparse is None:
+            with zipfile.ZipFile(full) as zf:
+                with zf.open('qtable.npy') as f:
+                    self.shape, fortran_order, self.dtype = _read_npy_header(f)
+            if fortran_order:
+                raise ValueError(f'{full} is saved in Fortran order')
+        self.shape = tuple([int(x) for x in self.shape])
+        self.num_actions = self.shape[-1]
+        self.num_states = int(np.prod(self.shape[:-1]))
+
+    def iter_chunks(self, chunk_states=16384):
+        '''
+        Yield (start state, rows) for consecutive chunks of flat state indices
+        rows: Array (chunk states, num actions) of the action values
+        '''
+        if self._sparse is not None:
+            chunks = self._iter_sparse(chunk_states)
+        else:
+            table = _memmap_npz_member(self._full, 'qtable', 'r')
+            if table is not None:
+                table = table.reshape(-1, self.num_actions)
+                chunks = ((s, np.array(table[s:s + chunk_states]))
+                          for s in range(0, self.num_states, chunk_states))
+            else:
+                chunks = self._iter_compressed(chunk_states)
+
+        for start, rows in chunks:
+            if len(self._delta_cells):
+                first = start * self.num_actions
+                last = first + rows.size
+                lo, hi = np.searchsorted(self._delta_cells, [first, last])
+                rows.reshape(-1)[self._delta_cells[lo:hi] - first] = self._delta_vals[lo:hi]
+            yield start, rows
+
+    def _iter_compressed(self, chunk_states):
+        row_bytes = self.num_actions * self.dtype.itemsize
+        with zipfile.ZipFile(self._full) as zf:
+            with zf.open('qtable.npy') as f:
+                _read_npy_header(f)
+                for start in range(0, self.num_states, chunk_states):
+                    n = min(chunk_states, self.num_states - start)
+                    buf = f.read(n * row_bytes)
+                    rows = np.frombuffer(buf, dtype=self.dtype).reshape(n, self.num_actions).copy()
+                    yield start, rows
+
+    def _iter_sparse(self, chunk_states):
+        states, vals = self._sparse
+        for start in range(0, self.num_states, chunk_states):
+            n = min(chunk_states, self.num_states - start)
+            rows = np.zeros((n, self.num_actions), dtype=self.dtype)
+            lo, hi = np.searchsorted(states, [start, start + n])
+            rows[states[lo:hi] - start] = vals[lo:hi]
+            yield start, rows
+
+def diff_saved_tables(filename1, filename2, chunk_states=16384):
+    '''
+    Compare two saved QTables in one pass over both, a chunk of states at a time,
+    so memory use doesn't depend on the size of the tables
+
+    chunk_states: Number of states to compare at once
+
+    Returns dict with:
+        num_cells:        Number of cells in each table
+        num_changed:      Number of cells with different values
+        mean_abs_diff:    Mean absolute difference over all cells
+        max_abs_diff:     Max absolute difference
+        nonzero1:         Number of nonzero cells in file 1
+        nonzero2:         Number of nonzero cells in file 2
+        greedy_decisions: Number of decisions in states visited by either table.
+                          See utils.get_decision_masks
+        greedy_changed:   Number of those decisions with a different greedy action
+        by_dim:           Dict of dimension name -> int array, the number of changed cells
+                          at each index of that dimension. See DIM_NAMES
+    '''
+    reader1 = SavedTableReader(filename1)
+    reader2 = SavedTableReader(filename2)
+    if reader1.shape != reader2.shape:
+        raise ValueError(f'Tables have different shapes {reader1.shape} and {reader2.shape}')
+    shape = reader1.shape
+
+    decision_masks = get_decision_masks(shape[-1])
+    num_decisions = decision_masks.any(axis=-1).sum(axis=-1)
+
+    num_changed = 0
+    sum_abs_diff = 0.0
+    max_abs_diff = 0.0
+    nonzero = [0, 0]
+    greedy_decisions = 0
+    greedy_changed = 0
+    by_dim = [np.zeros(n, dtype=np.int64) for n in shape]
+    for (start, rows1), (_, rows2) in zip(reader1.iter_chunks(chunk_states),
+                                          reader2.iter_chunks(chunk_states)):
+        abs_diff = np.absolute(rows1.astype(np.float64) - rows2)
+        sum_abs_diff += abs_diff.sum()
+        if abs_diff.size:
+            max_abs_diff = max(max_abs_diff, abs_diff.max())
+        nonzero[0] += np.count_nonzero(rows1)
+        nonzero[1] += np.count_nonzero(rows2)
+
+        changed_rows, changed_actions = np.nonzero(rows1 != rows2)
+        num_changed += len(changed_rows)
+        if len(changed_rows):
+            cells = np.unravel_index(start + changed_rows, shape[:-1]) + (changed_actions,)
+            for counts, index, n in zip(by_dim, cells, shape):
+                counts += np.bincount(index, minlength=n)
+
+        # Greedy actions can only differ in states with a changed row
+        visited = np.flatnonzero(rows1.any(axis=1) | rows2.any(axis=1))
+        _, _, fu, _, c1, c2 = np.unravel_index(start + visited, shape[:-1])
+        greedy_decisions += num_decisions[fu, c1, c2].sum()
+        changed = np.unique(changed_rows)
+        if len(changed):
+            greedy1 = get_greedy_actions(start + changed, rows1[changed], shape)
+            greedy2 = get_greedy_actions(start + changed, rows2[changed], shape)
+            greedy_changed += np.count_nonzero(greedy1 != greedy2)
+
+    num_cells = int(np.prod(shape))
+    return {'num_cells': num_cells,
+            'num_changed': int(num_changed),
+            'mean_abs_diff': sum_abs_diff / max(num_cells, 1),
+            'max_abs_diff': float(max_abs_diff),
+            'nonzero1': int(nonzero[0]),
+            'nonzero2': int(nonzero[1]),
+            'greedy_decisions': int(greedy_decisions),
+            'greedy_changed': int(greedy_changed),
+            'by_dim': dict(zip(DIM_NAMES, by_dim))}
+
+def find_checkpoints(directory, prefix=None):
+    '''
+    Checkpoints saved by SelfPlay in a directory, in order of episodes
+
+    prefix: Only include files starting with this, like 'agent_'.
+            None to include all, which must be from a single training run.
+
+    Returns list of (episodes, path)
+    '''
+    checkpoints = []
+    for name in os.listdir(directory):
+        match = CHECKPOINT_RE.match(name)
+        if match is None or (prefix is not None and match.group(1) != prefix):
+            continue
+        checkpoints.append((int(match.group(2)), os.path.join(directory, name)))
+    return sorted(checkpoints)
+
+def diff_checkpoints(directory, prefix=None, chunk_states=16384):
+    '''
+    Compare each checkpoint in a directory to the one before it
+
+    Returns list of (episodes, stats), with stats from diff_saved_tables
+    for the checkpoint with that many episodes against the previous one
+    '''
+    checkpoints = find_checkpoints(directory, prefix)
+    series = []
+    for (_, prev), (ep, cur) in zip(checkpoints, checkpoints[1:]):
+        series.append((ep, diff_saved_tables(prev, cur, chunk_states)))
+    return series
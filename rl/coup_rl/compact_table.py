@@ -0,0 +1,221 @@
+import functools
+import numpy as np
+
+# Shape of the QTable states get_reachable_states knows the rules for
+_REACHABLE_SHAPE = (15, 15, 4, 4, 13, 13)
+
+@functools.lru_cache(maxsize=None)
+def get_reachable_states(shape=_REACHABLE_SHAPE):
+    '''
+    Flat indices of every QTable state a player can be choosing an action in, sorted
+
+    A hand holds at most 3 of a card between both players, like the deck.
+    The player acting and their opponent each still have a card face down,
+    and with 2 of the same card only the 2nd can be face up, since cards are sorted.
+    Any number of coins 0 - 12 is reachable.
+    This is the same set of states as enumerating every game with solver.StateSpace.
+
+    shape: State dimensions of the QTable, without the actions
+
+    Returns read-only int64 array. Cached, since it is the same for every table.
+    '''
+    shape = tuple(shape)
+    if shape != _REACHABLE_SHAPE:
+        raise ValueError(f'Reachable states are only known for the shape {_REACHABLE_SHAPE}, not {shape}')
+
+    # Hands in the order of their index in the QTable
+    hands = [(c1, c2) for c1 in range(5) for c2 in range(c1, 5)]
+    cards = np.zeros(shape[:4], dtype=bool)
+    for h1, (a, b) in enumerate(hands):
+        for h2, (c, d) in enumerate(hands):
+            vals = [a, b, c, d]
+            if max([vals.count(v) for v in vals]) > 3:
+                continue
+            # Face up patterns: 0 none, 1 2nd card, 2 1st card, 3 both (out of the game)
+            for f1 in range(2 if a == b else 3):
+                for f2 in range(2 if c == d else 3):
+                    cards[h1, h2, f1, f2] = True
+    mask = np.broadcast_to(cards[..., None, None], shape)
+    states = np.flatnonzero(mask)
+    states.flags.writeable = False
+    return states
+
+class CompactTable:
+    '''
+    Q-Table storage with a row of action values only for the states that can be reached
+    Less than half of the states in the full table are, see get_reachable_states.
+    Rows are packed in order of their flat state index, and an index array
+    maps each flat state index to its row, so lookups are a single gather.
+    Unreachable states read as 0, and can't be written.
+
+    Supports the same tuple indexing of single cells as a numpy array.
+    '''
+    def __init__(self, shape, dtype=np.float64, states=None):
+        '''
+        shape:  Tuple of ints for dimensions of table. Last is the actions.
+        dtype:  Numpy dtype of the Q-values
+        states: Sorted int array of the flat state indices to store.
+                Default get_reachable_states
+        '''
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.num_actions = self.shape[-1]
+        self.num_states = int(np.prod(self.shape[:-1]))
+        if states is None:
+            states = get_reachable_states(self.shape[:-1])
+        self.states = np.asarray(states, dtype=np.int64)
+
+        # Flat state index -> row. States without a row go to the last row, which stays 0
+        self.index = np.full(self.num_states, len(self.states), dtype=np.int32)
+        self.index[self.states] = np.arange(len(self.states), dtype=np.int32)
+        self.rows = np.zeros((len(self.states) + 1, self.num_actions), dtype=self.dtype)
+        # Indexes to Python ints, which are faster one at a time than numpy scalars
+        self._index_view = memoryview(self.index)
+
+        # Row-major strides of the state dimensions
+        self._strides = [int(np.prod(self.shape[i+1:-1])) for i in range(len(self.shape) - 1)]
+
+        self._zero_row = np.zeros(self.num_actions, dtype=self.dtype)
+        self._zero_row.flags.writeable = False
+
+    def get_state_index(self, state):
+        '''
+        Flat index of a state, the table index without the action
+        '''
+        return sum([i * s for i, s in zip(state, self._strides)])
+
+    def get_row(self, state_ind):
+        '''
+        Action values of a flat state index. Read-only if unreachable.
+        '''
+        i = self._index_view[state_ind]
+        if i == len(self.states):
+            return self._zero_row
+        return self.rows[i]
+
+    def get_row_for_write(self, state_ind):
+        '''
+        Action values of a flat state index
+        '''
+        i = self._index_view[state_ind]
+        if i == len(self.states):
+            raise ValueError(f'State {state_ind} is not reachable, so has no row in the CompactTable')
+        return self.rows[i]
+
+    def get_row_indices(self, state_inds, write=False):
+        '''
+        Rows of many flat state indices
+        Unreachable states get the last row, which is 0.
+
+        write: Raise ValueError if any state is unreachable, to not write the last row
+        '''
+        inds = self.index[state_inds]
+        if write and np.any(inds == len(self.states)):
+            bad = np.asarray(state_inds)[inds == len(self.states)]
+            raise ValueError(f'States {bad[:10].tolist()} are not reachable, so have no row in the CompactTable')
+        return inds
+
+    def get_cell_indices(self, cells, write=False):
+        '''
+        Indices into the flattened rows of many flat cell indices (state index * num actions + action)
+        '''
+        state_inds, actions = np.divmod(cells, self.num_actions)
+        return self.get_row_indices(state_inds, write).astype(np.int64) * self.num_actions + actions
+
+    def get_rows(self, state_inds):
+        '''
+        Action values of many flat state indices as a (n, num_actions) array
+        '''
+        return self.rows[self.index[state_inds]]
+
+    def __getitem__(self, ind_tpl):
+        return self.get_row(self.get_state_index(ind_tpl[:-1]))[ind_tpl[-1]]
+
+    def __setitem__(self, ind_tpl, val):
+        self.get_row_for_write(self.get_state_index(ind_tpl[:-1]))[ind_tpl[-1]] = val
+
+    def astype(self, dtype):
+        '''
+        Return a copy with the Q-values cast to another dtype
+        '''
+        table = CompactTable(self.shape, dtype, self.states)
+        table.rows[...] = self.rows
+        return table
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.index.nbytes
+
+    def get_states_and_rows(self):
+        '''
+        All rows as arrays
+        Returns (flat state indices (n,), action values (n, num_actions))
+        '''
+        return self.states, self.rows[:-1]
+
+    def count_nonzero(self):
+        return np.count_nonzero(self.rows)
+
+    def to_dense(self):
+        '''
+        Return the full table as a numpy array
+        '''
+        arr = np.zeros(self.shape, dtype=self.dtype)
+        arr.reshape(-1, self.num_actions)[self.states] = self.rows[:-1]
+        return arr
+
+    @classmethod
+    def from_states_and_rows(cls, shape, states, rows, compact_states=None):
+        '''
+        states, rows:   Rows to set, each in compact_states
+        compact_states: States to store. Default get_reachable_states
+        '''
+        table = cls(shape, rows.dtype, compact_states)
+        table.rows[table.get_row_indices(states, write=True)] = rows
+        return table
+
+    @classmethod
+    def from_dense(cls, arr, states=None):
+        '''
+        Create from a full numpy array
+        Raises ValueError if a state that isn't stored has a nonzero value.
+
+        states: States to store. Default get_reachable_states
+        '''
+        table = cls(arr.shape, arr.dtype, states)
+        flat = arr.reshape(-1, table.num_actions)
+        unstored = table.index == len(table.states)
+        if flat[unstored].any():
+            raise ValueError('Table has nonzero values in states that are not reachable')
+        table.rows[:-1] = flat[table.states]
+        return table
+
+    def _aligned_rows(self, other):
+        '''
+        Rows of both tables for every state, with the values of other
+        in states this doesn't store as a separate array
+        '''
+        if isinstance(other, CompactTable) and np.array_equal(self.states, other.states):
+            return self.rows, other.rows, np.zeros((0, self.num_actions))
+        if not isinstance(other, np.ndarray):
+            other = other.to_dense()
+        flat = other.reshape(-1, self.num_actions)
+        unstored = self.index == len(self.states)
+        return self.rows[:-1], flat[self.states], flat[unstored]
+
+    def num_changed(self, other):
+        '''
+        Number of cells with different values from another table
+        '''
+        a, b, rest = self._aligned_rows(other)
+        return np.sum(a != b) + np.count_nonzero(rest)
+
+    def max_abs_diff(self, other):
+        '''
+        Largest absolute difference of any cell from another table
+        '''
+        a, b, rest = self._aligned_rows(other)
+        m = np.amax(np.absolute(a - b)) if a.size else 0.0
+        if rest.size:
+            m = max(m, np.amax(np.absolute(rest)))
+        return m
@@ -0,0 +1,232 @@
+import logging
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from gym_coup.envs.batch_coup_env import BatchCoupEnv
+from gym_coup.envs.coup_env import (VALID_ACTION_ARRAYS, PHASE_TURN_BEGIN, NONE,
+                                    get_coins_bucket, get_valid_action_index)
+from coup_rl.qtable import QTable
+from coup_rl.utils import convert_obs_to_state_offsets, get_batch_exchange_state_offsets
+
+logging.basicConfig()
+logger = logging.getLogger('coup_rl')
+
+# Valid beginning of turn actions for each number of coins and opponent coins
+_TURN_BEGIN_MASK = np.array([[VALID_ACTION_ARRAYS[get_valid_action_index(PHASE_TURN_BEGIN, get_coins_bucket(c, o), NONE, 0)][:26]
+                              for o in range(13)] for c in range(13)])
+
+def load_read_only(filename):
+    '''
+    Load a QTable that can't be modified
+    A dense table in an uncompressed file is memory mapped, so processes share it.
+    '''
+    qtable = QTable()
+    qtable.load(filename, mmap_mode='r')
+    if qtable.is_compact:
+        qtable.table.rows.flags.writeable = False
+    elif not qtable.is_sparse:
+        qtable.table.flags.writeable = False
+    return qtable
+
+def get_batch_greedy_actions(qtable, obs, masks):
+    '''
+    Greedy action of an agent in many games at once, the same as Agent with epsilon 0
+    Ties go to the lowest action.
+
+    qtable: QTable of the agent
+    obs:    Int array (n, 21) of observations from the agent's view
+    masks:  Bool array (n, 32) of valid actions
+
+    Returns int array (n,) of actions
+    '''
+    states = convert_obs_to_state_offsets(obs)
+    actions = np.empty(len(obs), dtype=np.int64)
+
+    # Exchange returns aren't stored in the QTable
+    exchange = masks[:, 26:].any(axis=1)
+    normal = ~exchange
+    if normal.any():
+        actions[normal], _ = qtable.get_best_actions(states[normal], masks[normal])
+    if exchange.any():
+        # Value each return by the best beginning of turn action in the state after it
+        ex_obs = obs[exchange]
+        next_states = get_batch_exchange_state_offsets(ex_obs)
+        rows = qtable.get_rows(next_states.reshape(-1)).reshape(next_states.shape + (-1,))
+        begin = _TURN_BEGIN_MASK[ex_obs[:, 16], ex_obs[:, 17]]
+        q_vals = np.where(begin[:, None, :], rows, -np.inf).max(axis=2)
+        q_vals = np.where(masks[exchange, 26:], q_vals, -np.inf)
+        actions[exchange] = 26 + q_vals.argmax(axis=1)
+    return actions
+
+def play_match(qtable_a, qtable_b, games, num_envs=1024, seed=None, max_turns=200):
+    '''
+    Play greedy games between 2 agents in a BatchCoupEnv
+    Agent A is P1 (first to act) in every other env, and P2 in the rest.
+
+    qtable_a, qtable_b: QTables of the agents
+    games:              Number of games to play
+    num_envs:           Number of games to play at once
+    seed:               Seed for the env
+    max_turns:          Games still going after this many turns are a draw.
+                        Greedy agents can repeat the same moves forever,
+                        e.g. Foreign Aid that is always blocked.
+
+    Returns (wins of A, draws, games) as int arrays of 2, indexed by A's seat (0 for P1)
+    '''
+    env = BatchCoupEnv(num_envs=max(min(num_envs, games), 1))
+    env.reset(seed=seed)
+    n = env.num_envs
+    # Every env plays a fixed number of games, so quick games aren't overrepresented
+    quota = games // n + (np.arange(n) < games % n)
+    played = np.zeros(n, dtype=np.int64)
+    a_seat = np.arange(n) % 2
+
+    wins = np.zeros(2, dtype=np.int64)
+    draws = np.zeros(2, dtype=np.int64)
+    totals = np.zeros(2, dtype=np.int64)
+    while (played < quota).any():
+        whose = env.whose_action.copy()
+        obs = env.get_obs(whose == 1)
+        masks = env.get_valid_action_mask()
+
+        actions = np.empty(n, dtype=np.int64)
+        a_turn = whose == a_seat
+        for qtable, turn in [(qtable_a, a_turn), (qtable_b, ~a_turn)]:
+            if turn.any():
+                actions[turn] = get_batch_greedy_actions(qtable, obs[turn], masks[turn])
+
+        obs, _, dones, _ = env.step(actions)
+
+        # Games finished by envs that haven't played their quota
+        done = np.flatnonzero(dones & (played < quota))
+        if len(done):
+            # The obs is the final state from the view of the player who acted.
+            # The winner is whoever still has a card face down.
+            actor = whose[done]
+            actor_won = (obs[done, 8] == 0) | (obs[done, 9] == 0)
+            winner = np.where(actor_won, actor, 1 - actor)
+            seat = a_seat[done]
+            np.add.at(wins, seat, winner == seat)
+            np.add.at(totals, seat, 1)
+            played[done] += 1
+
+        draw = np.flatnonzero((env.turn_count > max_turns) & (played < quota))
+        if len(draw):
+            np.add.at(draws, a_seat[draw], 1)
+            np.add.at(totals, a_seat[draw], 1)
+            played[draw] += 1
+            env.reset(indices=draw)
+    return wins, draws, totals
+
+def _play_match_files(file_a, file_b, games, num_envs, seed, max_turns):
+    return play_match(load_read_only(file_a), load_read_only(file_b), games, num_envs, seed, max_turns)
+
+def evaluate_match(file_a, file_b, games, workers=None, num_envs=1024, seed=None, max_turns=200):
+    '''
+    Play greedy games between 2 saved agents, split across processes
+    Neither agent's table is modified.
+
+    file_a, file_b: Agent files
+    games:          Number of games to play
+    workers:        Number of processes. Default is the number of CPUs
+    num_envs:       Number of games each process plays at once
+    seed:           Int or SeedSequence. Each process gets an independent stream spawned from it.
+    max_turns:      Games still going after this many turns are a draw
+
+    Returns dict with:
+        wins, draws, games: Int arrays of 2, indexed by A's seat (0 for P1)
+        win_rate:           Win rate of A, counting a draw as half a win
+        interval:           95% Wilson confidence interval of the win rate of A
+    '''
+    workers = workers or mp.cpu_count()
+    workers = max(min(workers, games), 1)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = seed.spawn(workers)
+    counts = [games // workers + (i < games % workers) for i in range(workers)]
+
+    if workers == 1:
+        results = [_play_match_files(file_a, file_b, games, num_envs, seeds[0], max_turns)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn')) as executor:
+            futures = [executor.submit(_play_match_files, file_a, file_b, n, num_envs, s, max_turns)
+                       for n, s in zip(counts, seeds)]
+            results = [f.result() for f in futures]
+
+    wins = sum([w for w, _, _ in results])
+    draws = sum([d for _, d, _ in results])
+    totals = sum([t for _, _, t in results])
+    score = wins.sum() + 0.5 * draws.sum()
+    return {'wins': wins,
+            'draws': draws,
+            'games': totals,
+            'win_rate': score / max(totals.sum(), 1),
+            'interval': wilson_interval(score, totals.sum())}
+
+def round_robin(files, games, workers=None, num_envs=1024, seed=None, max_turns=200):
+    '''
+    Play every pair of saved agents against each other
+
+    files: Agent files
+    games: Number of games per pair
+    Others are the same as evaluate_match
+
+    Returns (wins, elo)
+        wins: Float array (n, n). wins[i, j] is the number of games agent i won against agent j,
+              counting a draw as half a win
+        elo:  Float array (n,) of Elo ratings, averaging 1500
+    '''
+    n = len(files)
+    seeds = np.random.SeedSequence(seed).spawn(n * n)
+    wins = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            logger.info(f'{files[i]} vs {files[j]}')
+            result = evaluate_match(files[i], files[j], games, workers, num_envs, seeds[i * n + j], max_turns)
+            wins[i, j] = result['wins'].sum() + 0.5 * result['draws'].sum()
+            wins[j, i] = result['games'].sum() - wins[i, j]
+    return wins, get_elo_ratings(wins)
+
+def wilson_interval(wins, games, z=1.96):
+    '''
+    Wilson score confidence interval of a win rate
+    Default z gives a 95% interval
+
+    Returns (low, high)
+    '''
+    if games == 0:
+        return (0.0, 1.0)
+    p = wins / games
+    denom = 1 + z**2 / games
+    center = (p + z**2 / (2 * games)) / denom
+    half = z * np.sqrt(p * (1 - p) / games + z**2 / (4 * games**2)) / denom
+    return (center - half, center + half)
+
+def get_elo_ratings(wins, iterations=1000):
+    '''
+    Elo ratings that best fit pairwise results (Bradley-Terry model)
+
+    wins: Array (n, n). wins[i, j] is the number of games i won against j
+
+    Returns float array (n,) of ratings, averaging 1500
+    '''
+    wins = np.asarray(wins, dtype=np.float64)
+    games = wins + wins.T
+    # Half a win and loss against each opponent played,
+    # so an agent that never won or never lost still gets a finite rating
+    wins = wins + 0.5 * (games > 0)
+    games = wins + wins.T
+
+    strength = np.ones(len(wins))
+    for _ in range(iterations):
+        denom = (games / (strength[:, None] + strength[None, :])).sum(axis=1)
+        new = np.where(denom > 0, wins.sum(axis=1) / np.where(denom > 0, denom, 1), 1)
+        # Ratings are relative, so keep the geometric mean at 1
+        new /= np.exp(np.log(new).mean())
+        if np.allclose(new, strength, rtol=1e-10, atol=0):
+            strength = new
+            break
+        strength = new
+
+    elo = 400 * np.log10(strength)
+    return elo - elo.mean() + 1500
@@ -4,6 +4,7 @@ import gym
 import gym_coup
 from coup_rl.qtable import QTable
 from coup_rl.agent import Agent
+from coup_rl.ismcts import ISMCTSAgent
 
 logging.basicConfig()
 logger = logging.getLogger('coup_rl')
@@ -16,7 +17,10 @@ class Human_v_Agent:
                  learning_rate=None,
                  discount_factor=None,
                  epsilon=None,
-                 log_level=None):
+                 log_level=None,
+                 search_time=None,
+                 search_workers=1,
+                 record_file=None):
         '''
         p_first_turn:    Which player goes first, 0-indexed
         filepath:        Path for file ending in .npz
@@ -25,12 +29,19 @@ class Human_v_Agent:
         discount_factor: Used for creating new QTable. Float [0, 1]
         epsilon:         Used for creating new QTable. Float [0, 1]
         log_level:       coup_rl log level
+        search_time:     Seconds for the agent to search each move with ISMCTS,
+                         using the QTable as its prior. None to play the QTable's action.
+                         The search doesn't update the QTable, so can't be used when training.
+        search_workers:  Number of processes the agent searches each move with
+        record_file:     Path of a trajectory file to append the game to
         '''
+        if search_time is not None and is_training:
+            raise ValueError('The search agent does not learn, so cannot be trained')
         self.filepath = filepath
         self.is_training = is_training
 
         # Make the gym env
-        self.env = gym.make('coup-v0', num_human_players=1, p_first_turn=p_first_turn)
+        self.env = gym.make('coup-v0', num_human_players=1, p_first_turn=p_first_turn, record_file=record_file)
         self.env.reset()
 
         if log_level is not None:
@@ -47,15 +58,25 @@ class Human_v_Agent:
             # Create new Q Table
             shape = (15, 15, 4, 4, 13, 13, self.env.action_space.n - 7)
             self.qtable = QTable(shape, learning_rate, discount_factor, epsilon)
+            self.qtable_loaded = False
         else:
             # Try to load existing Q Table
             try:
                 self.qtable = QTable()
-                self.qtable.load(self.filepath)
+                # Map uncompressed files copy-on-write, so the agent starts without reading
+                # the whole table, and can still update it in memory
+                self.qtable.load(self.filepath, mmap_mode='c')
+                self.qtable_loaded = True
             except FileNotFoundError:
                 raise RuntimeError('Agent file does not exist, and not enough information was provided to create a new agent')
 
-        self.agent = Agent(2, self.env, self.qtable)
+        if search_time is not None:
+            # Workers load the saved agent themselves, or share a new one in memory
+            qtable_file = self.filepath if self.qtable_loaded else None
+            self.agent = ISMCTSAgent(2, self.env, self.qtable, time_budget=search_time,
+                                     workers=search_workers, qtable_file=qtable_file)
+        else:
+            self.agent = Agent(2, self.env, self.qtable)
 
     def step(self, action):
         '''
@@ -76,7 +97,10 @@ class Human_v_Agent:
 
         if done:
             # Do a final update now that the game is over
-            self.agent.update_q_value(0)
+            self.agent.end_game()
+            if isinstance(self.agent, ISMCTSAgent):
+                self.agent.close()
+            self.env.close()
             # and save the agent if training
             if self.is_training:
                 self.save_agent()
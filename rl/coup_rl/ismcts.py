@@ -0,0 +1,441 @@
+import math
+import time
+import logging
+import traceback
+import multiprocessing as mp
+from collections import OrderedDict
+import numpy as np
+from gym_coup.envs.coup_env import (CoupEnv, Game, VALID_ACTIONS_BY_MASK, VALID_ACTION_TABLE, PHASE_TURN_BEGIN, NONE,
+                                    get_coins_bucket, get_valid_action_index)
+from coup_rl.qtable import QTable
+from coup_rl.utils import convert_obs_to_state_offset, get_exchange_state_offsets
+
+logging.basicConfig()
+logger = logging.getLogger('coup_rl')
+
+# Valid beginning of turn actions for each number of coins and opponent coins
+_TURN_BEGIN_ACTIONS = [[np.array(VALID_ACTIONS_BY_MASK[int(VALID_ACTION_TABLE.flat[
+                            get_valid_action_index(PHASE_TURN_BEGIN, get_coins_bucket(c, o), NONE, 0)])])
+                        for o in range(13)] for c in range(13)]
+
+class Node:
+    '''
+    Search statistics of an information set, for the player choosing an action in it
+    '''
+    __slots__ = ('actions', 'prior', 'visits', 'n', 'w')
+
+    def __init__(self, actions, prior):
+        '''
+        actions: Tuple of the valid actions
+        prior:   List of the prior probability of each action
+        '''
+        self.actions = actions
+        self.prior = prior
+        # Number of times the node was visited
+        self.visits = 0
+        # Number of times each action was taken, and the total value of its results
+        # to the player choosing, +1 for a win and -1 for a loss
+        self.n = [0] * len(actions)
+        self.w = [0.0] * len(actions)
+
+class TranspositionTable:
+    '''
+    Bounded map of information set key -> Node
+    Once full, the least recently used node is evicted, except the pinned node,
+    which is the root of the current search.
+    Games that reach the same information set by different moves share its node.
+    '''
+    def __init__(self, max_nodes=200000):
+        self.max_nodes = max_nodes
+        self.nodes = OrderedDict()
+        self.pinned_key = None
+        self.pinned_node = None
+
+    def __len__(self):
+        return len(self.nodes) + (self.pinned_node is not None)
+
+    def get(self, key):
+        if key == self.pinned_key:
+            return self.pinned_node
+        node = self.nodes.get(key)
+        if node is not None:
+            self.nodes.move_to_end(key)
+        return node
+
+    def add(self, key, node):
+        self.nodes[key] = node
+        if len(self.nodes) > max(self.max_nodes - 1, 0):
+            self.nodes.popitem(last=False)
+
+    def pin(self, key, node):
+        '''
+        Keep a node until another is pinned, however many nodes are added
+        The previously pinned node goes back to being evicted normally.
+        '''
+        if key == self.pinned_key:
+            return
+        if self.pinned_node is not None:
+            self.add(self.pinned_key, self.pinned_node)
+        self.nodes.pop(key, None)
+        self.pinned_key = key
+        self.pinned_node = node
+
+    def clear(self):
+        self.nodes.clear()
+        self.pinned_key = None
+        self.pinned_node = None
+
+def get_info_key(game, player, see_opponent_cards=True):
+    '''
+    Key of the information set a player is in: everything about the game they can see
+
+    The deck order is never seen. The turn count is left out,
+    so the same position on different turns shares statistics.
+    The valid actions are part of it, so they are the same in every game of the set.
+
+    game:               Game
+    player:             0 or 1, the player whose view it is
+    see_opponent_cards: Whether the player sees the opponent's face down cards, as in the observation
+    '''
+    key = (game.whose_turn, game.whose_action, game.is_turn_begin, game.get_valid_action_mask())
+    for i, p in enumerate(game.players):
+        cards = p.cards
+        if i != player and not see_opponent_cards:
+            # Only the face up cards, and how many are face down
+            cards = (len(cards),) + tuple([c for c in cards if c & 1])
+        key += (cards, p.coins, p.last_action, p.lost_challenge)
+    return key
+
+def determinize(game, snapshot, player, see_opponent_cards=True):
+    '''
+    Restore a game to a full state the player can't tell apart from a snapshot
+
+    The deck is shuffled, and without see_opponent_cards the opponent's face down
+    cards are dealt again from the cards the player hasn't seen.
+
+    game:     Game to restore the sampled state into. Its rng does the sampling
+    snapshot: Game snapshot, from Game.snapshot()
+    player:   0 or 1, the player whose view it is
+    '''
+    game.restore(snapshot)
+    rng = game.rng
+    opp = game.players[1 - player]
+    unseen = list(game.deck)
+    hidden = [c >> 1 for c in opp.cards if not c & 1]
+    if not see_opponent_cards:
+        unseen += hidden
+    rng.shuffle(unseen)
+    if not see_opponent_cards and hidden:
+        face_up = [c for c in opp.cards if c & 1]
+        dealt = [v * 2 for v in unseen[:len(hidden)]]
+        unseen = unseen[len(hidden):]
+        opp._set_cards(tuple(sorted(face_up + dealt)))
+    game.deck = unseen
+
+def get_action_values(qtable, game, actions):
+    '''
+    Q-values of the valid actions for the player choosing, from their view
+    Exchange returns aren't stored, so are valued by the best beginning of turn
+    action in the state after them, like Agent.
+
+    Returns float array of the value of each action
+    '''
+    obs = game.get_flat_obs(p2_view=game.whose_action == 1)
+    if actions[0] < 26:
+        return qtable.get_row(convert_obs_to_state_offset(obs))[list(actions)]
+    next_states = get_exchange_state_offsets(obs)[[a - 26 for a in actions]]
+    return qtable.get_values(next_states, _TURN_BEGIN_ACTIONS[obs[16]][obs[17]]).max(axis=1)
+
+def get_winner(game):
+    '''
+    Player with a card still face down, once the game is over
+    '''
+    p = game.players[0]
+    return 0 if p.num_face_up < len(p.cards) else 1
+
+def _new_node(game, actions, qtable, temperature):
+    '''
+    Node with a prior of the softmax of the QTable's values of the actions
+    '''
+    q = get_action_values(qtable, game, actions) / temperature
+    p = np.exp(q - q.max())
+    return Node(actions, (p / p.sum()).tolist())
+
+def _select(node, exploration):
+    '''
+    Index of the action with the highest PUCT score, ties going to the lowest
+    '''
+    sqrt_visits = math.sqrt(node.visits + 1)
+    best = -math.inf
+    for i in range(len(node.actions)):
+        n = node.n[i]
+        q = node.w[i] / n if n else 0.0
+        u = q + exploration * node.prior[i] * sqrt_visits / (1 + n)
+        if u > best:
+            best = u
+            choice = i
+    return choice
+
+def search(snapshot, player, qtable, rng, time_budget=1.0, iterations=None, tt=None,
+           exploration=1.0, temperature=1.0, rollout_epsilon=0.1, max_turns=200,
+           see_opponent_cards=True):
+    '''
+    Information set Monte Carlo tree search from a player's view of a game
+
+    Each iteration samples a full state the player can't tell apart from the real one
+    (see determinize), descends the tree choosing actions by PUCT, adds one node,
+    then plays the game out with the QTable's epsilon-greedy actions.
+    Nodes are information sets (see get_info_key) from the searching player's view,
+    and are kept in a transposition table. The root is pinned there, so it is never evicted.
+
+    snapshot:        Game snapshot, from Game.snapshot(). The game must not be over
+    player:          0 or 1, the player to choose an action for. Must be choosing in the snapshot
+    qtable:          QTable for the prior over actions and the rollout policy
+    rng:             Numpy Generator
+    time_budget:     Max seconds to search
+    iterations:      Max number of iterations. None for only the time budget
+    tt:              TranspositionTable to reuse between searches. Default a new one
+    exploration:     PUCT exploration constant
+    temperature:     Softmax temperature of the prior over the Q-values
+    rollout_epsilon: Ratio of random actions in rollouts
+    max_turns:       Playouts still going this many turns after the root are a draw
+    see_opponent_cards: Whether the player sees the opponent's face down cards
+
+    Returns (valid actions at the root, number of visits of each)
+    '''
+    if tt is None:
+        tt = TranspositionTable()
+    game = Game.from_snapshot(snapshot, rng)
+    if game.game_over:
+        raise ValueError('Cannot search from a game that is over')
+    last_turn = game.turn_count + max_turns
+
+    # Expand the root first, so it exists however the iterations end
+    key = get_info_key(game, player, see_opponent_cards)
+    root = tt.get(key)
+    if root is None:
+        root = _new_node(game, VALID_ACTIONS_BY_MASK[key[3]], qtable, temperature)
+    tt.pin(key, root)
+
+    deadline = time.perf_counter() + time_budget
+    it = 0
+    while iterations is None or it < iterations:
+        if time.perf_counter() >= deadline and it > 0:
+            break
+        it += 1
+        determinize(game, snapshot, player, see_opponent_cards)
+
+        # Selection and expansion. The root always takes an action,
+        # and the turn limit only applies below it
+        choice = _select(root, exploration)
+        path = [(root, choice, game.whose_action)]
+        getattr(game, CoupEnv.actions[root.actions[choice]])()
+        while not game.game_over and game.turn_count <= last_turn:
+            key = get_info_key(game, player, see_opponent_cards)
+            node = tt.get(key)
+            expanded = node is None
+            if expanded:
+                node = _new_node(game, VALID_ACTIONS_BY_MASK[key[3]], qtable, temperature)
+                tt.add(key, node)
+
+            choice = _select(node, exploration)
+            path.append((node, choice, game.whose_action))
+            getattr(game, CoupEnv.actions[node.actions[choice]])()
+            if expanded:
+                break
+
+        # Rollout
+        while not game.game_over and game.turn_count <= last_turn:
+            actions = VALID_ACTIONS_BY_MASK[game.get_valid_action_mask()]
+            if len(actions) == 1:
+                a = actions[0]
+            elif rng.random() < rollout_epsilon:
+                a = actions[rng.integers(len(actions))]
+            else:
+                a = actions[get_action_values(qtable, game, actions).argmax()]
+            getattr(game, CoupEnv.actions[a])()
+
+        # Backpropagation
+        winner = get_winner(game) if game.game_over else None
+        for node, i, actor in path:
+            node.visits += 1
+            node.n[i] += 1
+            if winner is not None:
+                node.w[i] += 1.0 if winner == actor else -1.0
+
+    logger.debug(f'ISMCTS: {it} iterations, {len(tt)} nodes')
+    return root.actions, root.n
+
+def _search_worker(index, source, max_nodes, tasks, results, log_level):
+    '''
+    Root-parallel search process for ISMCTSAgent
+    Keeps its own transposition table for the whole game, searches each
+    (snapshot, player, seed, new_game, kwargs) from tasks until it gets None,
+    and puts (index, actions, visits) in results
+    '''
+    try:
+        _run_search_worker(index, source, max_nodes, tasks, results, log_level)
+    except Exception:
+        # Let the agent fail fast instead of waiting for this worker's search
+        from coup_rl.parallel_self_play import WORKER_ERROR
+        results.put((WORKER_ERROR, traceback.format_exc()))
+        raise
+
+def _run_search_worker(index, source, max_nodes, tasks, results, log_level):
+    if log_level is not None:
+        logger.setLevel(log_level)
+
+    shm = None
+    if isinstance(source, str):
+        from coup_rl.evaluate import load_read_only
+        qtable = load_read_only(source)
+    else:
+        qtable = QTable()
+        shm = qtable.attach_shared_memory(*source)
+    try:
+        tt = TranspositionTable(max_nodes)
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            snapshot, player, seed, new_game, kwargs = task
+            if new_game:
+                tt.clear()
+            actions, visits = search(snapshot, player, qtable, np.random.default_rng(seed), tt=tt, **kwargs)
+            results.put((index, actions, visits))
+    finally:
+        if shm is not None:
+            # Drop the view into shared memory before closing it
+            qtable.table = None
+            shm.close()
+
+class ISMCTSAgent:
+    '''
+    Agent that chooses each action by information set Monte Carlo tree search,
+    using a QTable as the prior and rollout policy. It doesn't update the QTable.
+
+    Has the same step(), reward and end_game() as Agent, so it can play
+    in self-play and against humans.
+    '''
+    def __init__(self, id, env, qtable, time_budget=1.0, iterations=None, max_nodes=200000,
+                 exploration=1.0, temperature=1.0, rollout_epsilon=0.1, max_turns=200,
+                 see_opponent_cards=True, workers=1, qtable_file=None, rng=None):
+        '''
+        id:          Agent id (1 or 2)
+        env:         gym-coup env
+        qtable:      QTable for the prior over actions and the rollout policy
+        time_budget: Max seconds to search each move
+        iterations:  Max number of iterations each move, for each worker. None for only the time budget
+        max_nodes:   Max number of nodes kept in the transposition table, for each worker
+        exploration, temperature, rollout_epsilon, max_turns, see_opponent_cards: See search
+        workers:     Number of processes searching each move from the same root.
+                     Their visit counts are added together to choose the action.
+        qtable_file: Agent file the workers load the QTable from read-only.
+                     Default with workers > 1 is to move the QTable into shared memory,
+                     so the workers see it change while it is trained. It must be dense.
+                     Call close() when done to move it back.
+        rng:         Numpy Generator. Default is a new unseeded one.
+        '''
+        self.id = id
+        self.env = env
+        self.qtable = qtable
+        self.time_budget = time_budget
+        self.iterations = iterations
+        self.search_kwargs = dict(exploration=exploration, temperature=temperature,
+                                  rollout_epsilon=rollout_epsilon, max_turns=max_turns,
+                                  see_opponent_cards=see_opponent_cards)
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.reward = 0
+
+        self.tt = TranspositionTable(max_nodes)
+        self.workers = workers
+        # One long-lived process per worker, each with its own task queue,
+        # so every worker gets every search and keeps its table for the whole game
+        self.procs = []
+        self.tasks = []
+        self.results = None
+        self.shm = None
+        if workers > 1:
+            if qtable_file is not None:
+                source = qtable_file
+            else:
+                self.shm = qtable.move_to_shared_memory()
+                source = (self.shm.name, qtable.table.shape, qtable.table.dtype)
+            ctx = mp.get_context('spawn')
+            self.results = ctx.Queue()
+            for i in range(workers):
+                tasks = ctx.Queue()
+                p = ctx.Process(target=_search_worker,
+                                args=(i, source, max_nodes, tasks, self.results, logger.level),
+                                daemon=True)
+                p.start()
+                self.tasks.append(tasks)
+                self.procs.append(p)
+        # Whether the workers' transposition tables are from a previous game
+        self._new_game = True
+
+    def step(self):
+        '''
+        Take one action in the env
+        '''
+        actions = VALID_ACTIONS_BY_MASK[self.env.get_valid_action_mask(bitmask=True)]
+        if len(actions) == 1:
+            action = actions[0]
+        else:
+            action = self.search()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'P{self.id}: {self.env.actions[action]}')
+        obs, reward, done, info = self.env.step(action)
+        self.reward += reward
+        return obs, reward, done, info
+
+    def search(self):
+        '''
+        Search from the current state of the env
+
+        Returns the most visited action, ties going to the lowest
+        '''
+        snapshot = self.env.game.snapshot()
+        player = self.id - 1
+        if not self.procs:
+            actions, visits = search(snapshot, player, self.qtable, self.rng, self.time_budget,
+                                     self.iterations, self.tt, **self.search_kwargs)
+        else:
+            from coup_rl.parallel_self_play import get_worker_message
+            seeds = self.rng.integers(2**63, size=self.workers).tolist()
+            kwargs = dict(self.search_kwargs, time_budget=self.time_budget, iterations=self.iterations)
+            for tasks, seed in zip(self.tasks, seeds):
+                tasks.put((snapshot, player, seed, self._new_game, kwargs))
+            self._new_game = False
+            visits = 0
+            for _ in self.procs:
+                _, actions, v = get_worker_message(self.results, self.procs)
+                visits = visits + np.array(v)
+        return actions[int(np.argmax(visits))]
+
+    def end_game(self):
+        '''
+        Forget the search statistics of the finished game
+        '''
+        self.reward = 0
+        self.tt.clear()
+        self._new_game = True
+
+    def close(self):
+        '''
+        Stop the worker processes, and move the QTable back out of shared memory
+        '''
+        for tasks in self.tasks:
+            tasks.put(None)
+        for p in self.procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self.procs = []
+        self.tasks = []
+        if self.shm is not None:
+            self.qtable.table = self.qtable.table.copy()
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
@@ -0,0 +1,126 @@
+import csv
+import json
+import time
+import logging
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger('coup_rl')
+
+class TrainingMetrics:
+    '''
+    Episode statistics collected during training,
+    written as a row to a .csv or .jsonl file every interval episodes
+
+    Each row covers the episodes since the last row:
+        Episodes and steps per second, mean game length,
+        win rate of each player, count of each action,
+        and seconds spent stepping the env, looking up Q-values and updating them.
+    '''
+    def __init__(self, action_names, filename=None, interval=1000):
+        '''
+        action_names: List of action names, indexed by action
+        filename:     Path of a .csv or .jsonl file to write to. None to only log.
+        interval:     Number of episodes between rows
+        '''
+        self.action_names = action_names
+        self.filename = filename
+        self.interval = interval
+        self.total_episodes = 0
+
+        self._file = None
+        self._writer = None
+        if filename is not None:
+            self._file = open(filename, 'w', newline='')
+            if filename.endswith('.csv'):
+                self._writer = csv.DictWriter(self._file, fieldnames=self.get_fieldnames())
+                self._writer.writeheader()
+        self.reset()
+
+    def get_fieldnames(self):
+        return (['episode', 'eps_per_sec', 'steps_per_sec', 'mean_game_length',
+                 'p1_win_rate', 'p2_win_rate', 'env_time', 'lookup_time', 'update_time', 'other_time'] +
+                ['action_' + a for a in self.action_names])
+
+    def reset(self):
+        '''
+        Start a new interval
+        '''
+        self.episodes = 0
+        self.steps = 0
+        self.wins = [0, 0]
+        self.action_counts = np.zeros(len(self.action_names), dtype=np.int64)
+        self.times = {'env': 0.0, 'lookup': 0.0, 'update': 0.0}
+        self.start = time.perf_counter()
+
+    def add_time(self, name, start):
+        '''
+        Add the time since start to a timer
+
+        name:  'env', 'lookup' or 'update'
+        start: time.perf_counter() at the start
+
+        Returns the current time.perf_counter(), to start the next timer
+        '''
+        now = time.perf_counter()
+        self.times[name] += now - start
+        return now
+
+    def add_step(self, action):
+        self.steps += 1
+        self.action_counts[action] += 1
+
+    def end_episode(self, env):
+        '''
+        Record the result of a finished game, and write a row if the interval is over
+
+        env: gym-coup env with the game over
+        '''
+        players = env.game.players
+        # The winner is the player with a card left face down
+        winner = 0 if players[0].num_face_up < len(players[0].cards) else 1
+        self.wins[winner] += 1
+        self.episodes += 1
+        self.total_episodes += 1
+        if self.episodes >= self.interval:
+            self.write()
+
+    def write(self):
+        '''
+        Write a row for the episodes since the last row, and start a new interval
+        '''
+        if self.episodes == 0:
+            return
+        elapsed = time.perf_counter() - self.start
+        row = {'episode': self.total_episodes,
+               'eps_per_sec': self.episodes / elapsed,
+               'steps_per_sec': self.steps / elapsed,
+               'mean_game_length': self.steps / self.episodes,
+               'p1_win_rate': self.wins[0] / self.episodes,
+               'p2_win_rate': self.wins[1] / self.episodes,
+               'env_time': self.times['env'],
+               'lookup_time': self.times['lookup'],
+               'update_time': self.times['update'],
+               'other_time': elapsed - sum(self.times.values())}
+        logger.info(f'Episode {row["episode"]}: {row["eps_per_sec"]:.1f} eps/s, '
+                    f'{row["steps_per_sec"]:.1f} steps/s, mean length {row["mean_game_length"]:.1f}, '
+                    f'P1 win rate {row["p1_win_rate"]:.3f}')
+        for a, n in zip(self.action_names, self.action_counts.tolist()):
+            row['action_' + a] = n
+
+        if self._writer is not None:
+            self._writer.writerow(row)
+        elif self._file is not None:
+            self._file.write(json.dumps(row) + '\n')
+        if self._file is not None:
+            self._file.flush()
+        self.reset()
+
+    def close(self):
+        '''
+        Write any partial interval and close the file
+        '''
+        self.write()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,159 @@
+import os
+import logging
+import tempfile
+import numpy as np
+from gym_coup.envs.trajectory import TrajectoryReader
+from coup_rl.utils import convert_obs_to_state_offsets, STORED_ACTIONS_MASK, TRANSITION_DTYPE
+
+logging.basicConfig()
+logger = logging.getLogger('coup_rl')
+
+def get_record_transitions(records):
+    '''
+    Q-learning transitions of both players from recorded games, the same ones an Agent
+    records while playing: one for each action stored in the QTable, ending at the
+    player's next stored action or the end of the game.
+    The reward is everything the player received in between, less what the opponent received.
+
+    records: Structured array of gym_coup trajectory records, of whole games in order
+
+    Returns structured array of utils.TRANSITION_DTYPE
+    '''
+    if len(records) == 0:
+        return np.zeros(0, dtype=TRANSITION_DTYPE)
+    player = records['player']
+    action = records['action']
+    states = convert_obs_to_state_offsets(records['obs'])
+
+    # First record of each game, and the first record after it
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(records['episode'])) + 1, [len(records)]])
+    game = np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+    game_start = bounds[:-1][game]
+    game_end = bounds[1:][game]
+
+    out = []
+    for p in (0, 1):
+        # Total reward to p before each record
+        reward = np.where(player == p, records['reward'], -records['reward']).astype(np.float64)
+        before = np.concatenate([[0], np.cumsum(reward)])
+
+        d = np.flatnonzero((player == p) & (action < 26))
+        if len(d) == 0:
+            continue
+        same_game = game[d[:-1]] == game[d[1:]]
+        has_next = np.append(same_game, False)
+        is_first = np.insert(~same_game, 0, True)
+        next_d = np.append(d[1:], 0)
+
+        # The first transition of a game also gets any reward from before it
+        start = np.where(is_first, game_start[d], d)
+        stop = np.where(has_next, next_d, game_end[d])
+
+        t = np.zeros(len(d), dtype=TRANSITION_DTYPE)
+        t['state'] = states[d]
+        t['action'] = action[d]
+        t['reward'] = before[stop] - before[start]
+        t['next_state'] = np.where(has_next, states[next_d], 0)
+        t['next_mask'] = np.where(has_next, records['valid_mask'][next_d] & STORED_ACTIONS_MASK, 0)
+        t['done'] = ~has_next
+        out.append(t)
+    return np.concatenate(out)
+
+def iter_file_transitions(filenames, chunk_size=1 << 20):
+    '''
+    Stream the transitions of every finished game in trajectory files
+
+    filenames:  List of trajectory file paths
+    chunk_size: Number of records read at once
+
+    Yields structured arrays of utils.TRANSITION_DTYPE
+    '''
+    for filename in filenames:
+        carry = None
+        for chunk in TrajectoryReader(filename).iter_chunks(chunk_size):
+            if carry is not None:
+                chunk = np.concatenate([carry, chunk])
+            # Keep the last game for the next chunk, since it may continue there
+            last_start = np.flatnonzero(np.diff(chunk['episode']))
+            last_start = last_start[-1] + 1 if len(last_start) else 0
+            carry = chunk[last_start:]
+            chunk = chunk[:last_start]
+            yield get_record_transitions(chunk[_get_finished(chunk)])
+        if carry is not None:
+            yield get_record_transitions(carry[_get_finished(carry)])
+
+def _get_finished(records):
+    '''
+    Mask of the records of games that have their final record
+    '''
+    return np.isin(records['episode'], records['episode'][records['done']])
+
+def fitted_q_iteration(qtable, filenames, tol=1e-6, max_iters=200, chunk_size=1 << 20, transitions_file=None):
+    '''
+    Batch Q-learning from recorded games, without playing any
+
+    Each sweep sets every state-action in the data to the mean of its targets,
+    reward + discount * max Q-value of the next state, all from the table before the sweep.
+    This repeats until no value changes by more than tol.
+    State-actions not in the data keep their values, so an existing agent can be fine tuned.
+
+    The transitions are written to a file once, then each sweep streams them in chunks,
+    so memory use is a few tables' worth however much data there is.
+
+    qtable:     QTable to update in place. Its discount factor is used
+    filenames:  List of trajectory file paths, see gym_coup.envs.trajectory
+    tol:        Stop when no value changes by more than this
+    max_iters:  Max number of sweeps
+    chunk_size: Number of records or transitions processed at once
+    transitions_file: Path to write the transitions to. Default a temporary file, deleted after
+
+    Returns the number of sweeps run
+    '''
+    num_actions = qtable.table.shape[-1]
+    num_cells = int(np.prod(qtable.table.shape))
+
+    if transitions_file is None:
+        fd, path = tempfile.mkstemp(suffix='.transitions')
+        os.close(fd)
+    else:
+        path = transitions_file
+    try:
+        # Number of transitions of each state-action, which is the same every sweep
+        counts = np.zeros(num_cells, dtype=np.int64)
+        num_transitions = 0
+        with open(path, 'wb') as f:
+            for t in iter_file_transitions(filenames, chunk_size):
+                f.write(t.tobytes())
+                counts += np.bincount(t['state'].astype(np.int64) * num_actions + t['action'], minlength=num_cells)
+                num_transitions += len(t)
+        cells = np.flatnonzero(counts)
+        counts = counts[cells]
+        logger.info(f'{num_transitions} transitions of {len(cells)} state-actions')
+        if num_transitions == 0:
+            return 0
+        transitions = np.memmap(path, dtype=TRANSITION_DTYPE, mode='r', shape=(num_transitions,))
+
+        for it in range(1, max_iters + 1):
+            sums = np.zeros(num_cells)
+            for start in range(0, num_transitions, chunk_size):
+                t = transitions[start:start + chunk_size]
+                targets = t['reward'].astype(np.float64)
+                live = np.flatnonzero(~t['done'] & (t['next_mask'] != 0))
+                if len(live):
+                    rows = qtable.get_rows(t['next_state'][live].astype(np.int64))
+                    valid = (t['next_mask'][live, None] >> np.arange(num_actions, dtype=np.uint32)) & 1
+                    targets[live] += qtable.discount_factor * np.where(valid.astype(bool), rows, -np.inf).max(axis=1)
+                sums += np.bincount(t['state'].astype(np.int64) * num_actions + t['action'],
+                                    weights=targets, minlength=num_cells)
+
+            q_new = sums[cells] / counts
+            change = np.amax(np.absolute(q_new - qtable.get_cells(cells)))
+            qtable.set_cells(cells, q_new)
+            logger.info(f'Sweep {it}: max change {change}')
+            if change <= tol:
+                break
+        del transitions
+        return it
+    finally:
+        if transitions_file is None:
+            os.remove(path)
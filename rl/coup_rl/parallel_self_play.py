@@ -0,0 +1,212 @@
+import logging
+import queue
+import traceback
+import multiprocessing as mp
+import numpy as np
+import gym
+import gym_coup
+from coup_rl.qtable import QTable
+from coup_rl.agent import Agent
+from coup_rl.self_play import SelfPlay, play_game
+
+logging.basicConfig()
+logger = logging.getLogger('coup_rl')
+
+# First element of a message from a worker process that failed, followed by its traceback
+WORKER_ERROR = 'error'
+
+def get_worker_message(messages, procs, timeout=1.0):
+    '''
+    Wait for the next message from worker processes,
+    raising instead of waiting forever if one of them failed
+
+    messages: Queue the workers put messages in
+    procs:    The worker processes
+    timeout:  Seconds between checks that the workers are still running
+
+    Raises RuntimeError if a worker sent WORKER_ERROR, exited with an error
+    (including being killed), or they all exited without sending another message
+    '''
+    while True:
+        # Checked before every message, since the other workers can keep sending
+        # after one dies with work outstanding
+        for p in procs:
+            if p.exitcode not in (None, 0):
+                raise RuntimeError(f'Worker process {p.name} exited with code {p.exitcode}')
+        try:
+            msg = messages.get(timeout=timeout)
+        except queue.Empty:
+            if all([p.exitcode is not None for p in procs]):
+                raise RuntimeError('All worker processes exited before sending every result')
+            continue
+        if isinstance(msg, tuple) and msg and isinstance(msg[0], str) and msg[0] == WORKER_ERROR:
+            raise RuntimeError(f'Worker process failed:\n{msg[1]}')
+        return msg
+
+class ParallelSelfPlay(SelfPlay):
+    '''
+    Self-play training with several worker processes
+
+    The QTable is moved into shared memory, and each worker plays its own
+    games with two Agents that update it in place without locks (Hogwild).
+    This process is the coordinator. It hands out episodes in chunks,
+    saves checkpoints and checks for convergence.
+    '''
+    def __init__(self,
+                 filepath,
+                 learning_rate=None,
+                 discount_factor=None,
+                 epsilon=None,
+                 log_level=None,
+                 dtype=None,
+                 workers=None,
+                 chunk=100,
+                 seed=None):
+        '''
+        filepath:        Path for file ending in .npz
+        learning_rate:   Float (0, 1]
+        discount_factor: Float [0, 1]
+        epsilon:         Float [0, 1]
+        log_level:       coup_rl log level
+        dtype:           Numpy float dtype of the Q-values
+        workers:         Number of worker processes. Default is the number of CPUs
+        chunk:           Max number of episodes a worker runs before reporting back
+        seed:            Int seed. Each worker gets independent streams spawned from it.
+                         The order of updates between workers still varies between runs.
+
+        Must supply lr, df, eps when creating new table.
+        Otherwise, supplying them replaces params in existing file.
+        The table must be dense to be shared.
+        Checkpoints are always full files, since the workers' updates aren't tracked.
+        '''
+        super().__init__(filepath,
+                         learning_rate=learning_rate,
+                         discount_factor=discount_factor,
+                         epsilon=epsilon,
+                         log_level=log_level,
+                         dtype=dtype,
+                         full_checkpoint=1,
+                         seed=seed)
+        self.workers = workers or mp.cpu_count()
+        self.chunk = chunk
+        self.log_level = log_level
+
+    def train(self, episodes, checkpoint, conv_eps):
+        '''
+        episodes:   Number of episodes to run
+        checkpoint: Number of episodes to save a new agent file after
+        conv_eps:   Convergence epsilon. Max difference for convergence
+
+        Workers keep updating the table while a checkpoint is copied,
+        so a checkpoint can include some updates from episodes after it.
+        '''
+        # Chunks of episodes that never cross a checkpoint
+        # Each is (checkpoint index, number of episodes)
+        chunks = []
+        ckpt_eps = list(range(checkpoint, episodes, checkpoint)) + [episodes]
+        start = 0
+        for i, end in enumerate(ckpt_eps):
+            for c in range(start, end, self.chunk):
+                chunks.append((i, min(self.chunk, end - c)))
+            start = end
+
+        shm = self.qtable.move_to_shared_memory()
+        ctx = mp.get_context('spawn')
+        tasks = ctx.Queue()
+        results = ctx.Queue()
+        procs = [ctx.Process(target=_worker,
+                             args=(shm.name,
+                                   self.qtable.table.shape,
+                                   self.qtable.table.dtype,
+                                   [self.qtable.learning_rate, self.qtable.discount_factor, self.qtable.epsilon],
+                                   tasks,
+                                   results,
+                                   self.log_level,
+                                   worker_seed))
+                 for worker_seed in self.seed_sequence.spawn(self.workers)]
+        try:
+            for p in procs:
+                p.start()
+
+            # Episodes left to finish before each checkpoint
+            remaining = [0] * len(ckpt_eps)
+            for i, n in chunks:
+                remaining[i] += n
+
+            next_chunk = 0
+            next_ckpt = 0
+            outstanding = 0
+            converged = False
+            while next_ckpt < len(ckpt_eps) and not converged:
+                # Keep every worker busy, without queueing so much
+                # that stopping at convergence is delayed
+                while outstanding < 2 * self.workers and next_chunk < len(chunks):
+                    tasks.put(chunks[next_chunk])
+                    next_chunk += 1
+                    outstanding += 1
+
+                i, n = get_worker_message(results, procs)
+                outstanding -= 1
+                remaining[i] -= n
+
+                # Checkpoints are saved in order, once all of their episodes are done
+                while next_ckpt < len(ckpt_eps) and remaining[next_ckpt] == 0 and not converged:
+                    snapshot = QTable(learning_rate=self.qtable.learning_rate,
+                                      discount_factor=self.qtable.discount_factor,
+                                      epsilon=self.qtable.epsilon)
+                    snapshot.table = self.qtable.table.copy()
+                    converged = self.save_checkpoint(ckpt_eps[next_ckpt], episodes, conv_eps, snapshot)
+                    next_ckpt += 1
+
+            for _ in procs:
+                tasks.put(None)
+            for p in procs:
+                p.join()
+        finally:
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+            # Move the table back out of shared memory before freeing it
+            self.qtable.table = self.qtable.table.copy()
+            shm.close()
+            shm.unlink()
+
+def _worker(shm_name, shape, dtype, params, tasks, results, log_level, seed):
+    '''
+    Worker process for ParallelSelfPlay
+    Runs chunks of episodes from tasks until it gets None,
+    and puts each finished chunk in results
+    '''
+    try:
+        _run_worker(shm_name, shape, dtype, params, tasks, results, log_level, seed)
+    except Exception:
+        # Let the coordinator fail fast instead of waiting for this worker's results
+        results.put((WORKER_ERROR, traceback.format_exc()))
+        raise
+
+def _run_worker(shm_name, shape, dtype, params, tasks, results, log_level, seed):
+    if log_level is not None:
+        logger.setLevel(log_level)
+
+    qtable = QTable(learning_rate=params[0], discount_factor=params[1], epsilon=params[2])
+    shm = qtable.attach_shared_memory(shm_name, shape, dtype)
+    try:
+        env_seed, p1_seed, p2_seed = seed.spawn(3)
+        env = gym.make('coup-v0')
+        env.seed(env_seed)
+        p1 = Agent(1, env, qtable, rng=np.random.default_rng(p1_seed))
+        p2 = Agent(2, env, qtable, rng=np.random.default_rng(p2_seed))
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            _, n = task
+            for _ in range(n):
+                env.reset()
+                play_game(env, p1, p2, render=False)
+            results.put(task)
+    finally:
+        # Drop the view into shared memory before closing it
+        qtable.table = None
+        shm.close()
@@ -1,5 +1,12 @@
+import os
+import struct
+import zlib
+import zipfile
 import numpy as np
 import logging
+from multiprocessing import shared_memory
+from coup_rl.sparse_table import SparseTable
+from coup_rl.compact_table import CompactTable
 
 logging.basicConfig()
 logger = logging.getLogger('coup_rl')
@@ -12,12 +19,19 @@ class QTable:
         Learning rate
         Discount factor
         Epsilon (e-greedy exploration)
+
+    The table is either a dense numpy array,
+    a SparseTable that only allocates visited states,
+    or a CompactTable that only stores reachable states.
     '''
     def __init__(self,
                  shape=None,
                  learning_rate=None,
                  discount_factor=None,
-                 epsilon=None):
+                 epsilon=None,
+                 sparse=False,
+                 dtype=np.float64,
+                 compact=False):
         '''
         Create a new QTable
         Either supply all args or none.
@@ -28,36 +42,383 @@ class QTable:
         learning_rate:   Float (0, 1]
         discount_factor: Float [0, 1]
         epsilon:         Float [0, 1]
+        sparse:          Whether to only allocate visited states
+        dtype:           Numpy float dtype of the Q-values. Kept through save and load.
+        compact:         Whether to only store reachable states
         '''
+        if sparse and compact:
+            raise ValueError('A QTable can be sparse or compact, not both')
         self.table = None
+        # Flat cell index -> value at the last checkpoint, for cells set since then
+        # None when not tracking changes. See track_changes()
+        self._changes = None
+        # Number of delta files applied on top of a full file by load()
+        self.delta_depth = 0
+        # Whether save() compresses by default. Kept from the file given to load()
+        self.compress = True
         self.learning_rate = learning_rate
         self.discount_factor = discount_factor
         self.epsilon = epsilon
 
         if shape is not None:
             # Create a new QTable
-            self.table = np.zeros(shape)
+            if sparse:
+                self.table = SparseTable(shape, dtype)
+            elif compact:
+                self.table = CompactTable(shape, dtype)
+            else:
+                self.table = np.zeros(shape, dtype=dtype)
+
+    @property
+    def table(self):
+        return self._table
+
+    @table.setter
+    def table(self, table):
+        if isinstance(table, np.ndarray) and not table.flags.c_contiguous:
+            table = np.ascontiguousarray(table)
+        self._table = table
+        # 2D view of a dense table with one row of action values per flat state index
+        if isinstance(table, np.ndarray):
+            self._rows = table.reshape(-1, table.shape[-1])
+        else:
+            self._rows = None
+
+    @property
+    def is_sparse(self):
+        return isinstance(self.table, SparseTable)
+
+    @property
+    def is_compact(self):
+        return isinstance(self.table, CompactTable)
+
+    @property
+    def dtype(self):
+        return self.table.dtype
+
+    def astype(self, dtype):
+        '''
+        Convert the Q-values to another dtype
+        '''
+        if self.table.dtype != np.dtype(dtype):
+            self.table = self.table.astype(dtype)
 
-    def load(self, filename):
+    def to_sparse(self):
+        '''
+        Convert the table to sparse storage
+        '''
+        if self.is_compact:
+            self.to_dense()
+        if not self.is_sparse:
+            self.table = SparseTable.from_dense(self.table)
+
+    def to_compact(self):
+        '''
+        Convert the table to compact storage
+        Raises ValueError if an unreachable state has a nonzero value.
+        '''
+        if self.is_sparse:
+            self.to_dense()
+        if not self.is_compact:
+            self.table = CompactTable.from_dense(self.table)
+
+    def to_dense(self):
+        '''
+        Convert the table to a dense numpy array
+        '''
+        if self._rows is None:
+            self.table = self.table.to_dense()
+
+    def move_to_shared_memory(self):
+        '''
+        Move a dense table into shared memory, so other processes
+        can read and update it in place with attach_shared_memory()
+
+        Returns the SharedMemory block. The caller must close() and unlink() it when done.
+        '''
+        if self._rows is None:
+            raise RuntimeError('Only dense QTables can be shared between processes')
+
+        shm = shared_memory.SharedMemory(create=True, size=max(self.table.nbytes, 1))
+        table = np.ndarray(self.table.shape, dtype=self.table.dtype, buffer=shm.buf)
+        table[...] = self.table
+        self.table = table
+        return shm
+
+    def attach_shared_memory(self, name, shape, dtype):
+        '''
+        Use a table created by move_to_shared_memory() in another process
+
+        name:  Name of the SharedMemory block
+        shape: Shape of the table
+        dtype: Numpy dtype of the table
+
+        Returns the SharedMemory block. The caller must close() it when done.
+        '''
+        shm = shared_memory.SharedMemory(name=name)
+        self.table = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return shm
+
+    @property
+    def is_tracking_changes(self):
+        return self._changes is not None
+
+    def track_changes(self):
+        '''
+        Start tracking which cells are set, and their values before the first set.
+        Saving the table resets the tracked changes, so they are always since the last save.
+        '''
+        self._changes = {}
+
+    def get_changes(self):
+        '''
+        Cells set since the last save, or since tracking started
+
+        Returns (flat cell indices, old values, new values), sorted by cell.
+        Cells set back to their old value are included.
+        '''
+        cells = np.fromiter(sorted(self._changes.keys()), dtype=np.int64, count=len(self._changes))
+        old = np.array([self._changes[c] for c in cells.tolist()], dtype=self.dtype)
+        new = self.get_cells(cells)
+        return cells, old, new
+
+    def get_cells(self, cells):
+        '''
+        Values of cells by flat cell index (state offset * num actions + action)
+        '''
+        if self.is_compact:
+            return self._table.rows.reshape(-1)[self._table.get_cell_indices(cells)]
+        if self._rows is None:
+            num_actions = self.table.num_actions
+            return np.array([self._table.get_row(c // num_actions)[c % num_actions] for c in cells.tolist()],
+                            dtype=self.dtype)
+        return self._rows.reshape(-1)[cells]
+
+    def set_cells(self, cells, vals):
+        '''
+        Set cells by flat cell index (state offset * num actions + action)
+        Not tracked as changes
+        '''
+        if self.is_compact:
+            self._table.rows.reshape(-1)[self._table.get_cell_indices(cells, write=True)] = vals
+        elif self._rows is None:
+            num_actions = self.table.num_actions
+            for c, v in zip(cells.tolist(), vals):
+                self._table.get_row_for_write(c // num_actions)[c % num_actions] = v
+        else:
+            self._rows.reshape(-1)[cells] = vals
+
+    def _track(self, state_offset, action):
+        cell = state_offset * self.table.shape[-1] + action
+        if cell not in self._changes:
+            self._changes[cell] = self.get_row(state_offset)[action]
+
+    def load(self, filename, sparse=None, dtype=None, mmap_mode=None, compact=False):
         '''
         Load QTable and parameters from a file
+        A delta file is loaded by loading the file it is based on,
+        back to the last full file, and applying each delta.
+
+        sparse:    True or False to convert the table to that storage.
+                   None to keep the storage the file was saved with.
+        dtype:     Numpy dtype to convert the Q-values to.
+                   None to keep the dtype the file was saved with.
+        mmap_mode: None to read the table into memory.
+                   'r' to map a dense table from an uncompressed file read-only,
+                   or 'c' to map it copy-on-write, so writes are kept in memory only.
+                   Processes mapping the same file share its pages.
+                   Compressed files, and converting with sparse or dtype, read it into memory instead.
+        compact:   True to convert the table to compact storage
         '''
         with np.load(filename) as data:
-            self.table = data.get('qtable')
+            self.compress = _is_compressed(filename)
+            if 'delta_cells' in data:
+                # Base is saved relative to the delta file
+                base = os.path.join(os.path.dirname(filename), str(data.get('base')))
+                check_delta_base(filename, data, base)
+                # Deltas are written into the base table, so only map it copy-on-write
+                self.load(base, mmap_mode='c' if mmap_mode else None)
+                self.set_cells(data.get('delta_cells'), data.get('delta_values'))
+                self.delta_depth += 1
+            elif 'qtable' in data:
+                table = None
+                if mmap_mode is not None and not sparse and not compact:
+                    table = _memmap_npz_member(filename, 'qtable', mmap_mode)
+                if table is None:
+                    table = data.get('qtable')
+                self.table = table
+                self.delta_depth = 0
+            elif 'qtable_compact' in data:
+                self.table = CompactTable.from_states_and_rows(tuple(data.get('qtable_shape')),
+                                                               data.get('qtable_states'),
+                                                               data.get('qtable_rows'),
+                                                               data.get('qtable_states'))
+                self.delta_depth = 0
+            else:
+                self.table = SparseTable.from_states_and_rows(tuple(data.get('qtable_shape')),
+                                                              data.get('qtable_states'),
+                                                              data.get('qtable_rows'))
+                self.delta_depth = 0
             params = data.get('params')
             self.learning_rate = params[0]
             self.discount_factor = params[1]
             self.epsilon = params[2]
             logger.debug(f'Loaded QTable, LR {self.learning_rate}, DF {self.discount_factor}, Eps {self.epsilon}')
 
-    def save(self, filename):
+        if sparse:
+            self.to_sparse()
+        elif compact:
+            self.to_compact()
+        elif sparse is not None:
+            self.to_dense()
+        if dtype is not None:
+            self.astype(dtype)
+
+    def save(self, filename, compress=None):
         '''
         Save QTable and parameters to a file
+        A sparse table is saved as its allocated states and rows,
+        and a compact table as all of its states and rows.
+        Tools that read sparse files can read compact files the same way.
+        The Q-values are saved with the table's dtype.
+
+        compress: Whether to compress the file. An uncompressed file is larger,
+                  but a dense table in it can be memory mapped by load().
+                  None to use the same as the last file loaded, or compress a new table.
         '''
         logger.debug(f'Saving QTable to {filename}')
+        if compress is None:
+            compress = self.compress
+        savez = np.savez_compressed if compress else np.savez
+        params = [self.learning_rate, self.discount_factor, self.epsilon]
+        if self.is_tracking_changes:
+            self._changes = {}
+        self.delta_depth = 0
+        if self.is_sparse:
+            states, rows = self.table.get_states_and_rows()
+            savez(filename,
+                  qtable_shape=self.table.shape,
+                  qtable_states=states,
+                  qtable_rows=rows,
+                  params=params)
+        elif self.is_compact:
+            states, rows = self.table.get_states_and_rows()
+            savez(filename,
+                  qtable_shape=self.table.shape,
+                  qtable_states=states,
+                  qtable_rows=rows,
+                  qtable_compact=True,
+                  params=params)
+        else:
+            savez(filename,
+                  qtable=self.table,
+                  params=params)
+
+    def save_delta(self, filename, base):
+        '''
+        Save only the cells that changed since the last save, and parameters, to a file
+        Must be tracking changes. See track_changes()
+
+        filename: Path for file ending in .npz
+        base:     Path of the last saved file, full or delta, that this delta applies to.
+                  Its size and checksum are saved, so load() can tell if it was replaced.
+        '''
+        logger.debug(f'Saving QTable delta to {filename}')
+        cells, old, new = self.get_changes()
+        changed = old != new
         np.savez_compressed(filename,
-                            qtable=self.table,
+                            delta_cells=cells[changed],
+                            delta_values=new[changed],
+                            base=os.path.relpath(base, os.path.dirname(filename) or '.'),
+                            base_size=os.path.getsize(base),
+                            base_crc32=_get_file_crc32(base),
                             params=[self.learning_rate, self.discount_factor, self.epsilon])
+        self._changes = {}
+        self.delta_depth += 1
+
+    def get_row(self, state_offset):
+        '''
+        Get the action values of a state as a contiguous view into the table.
+        For a sparse table, a state that was never written is a read-only row of 0s,
+        and for a compact table, so is an unreachable state.
+
+        state_offset: Int, flat index of the state. See utils.convert_obs_to_state_offset
+        '''
+        if self._rows is None:
+            return self._table.get_row(state_offset)
+        return self._rows[state_offset]
+
+    def get_value(self, state_offset, action):
+        '''
+        Get the value of a single state-action
+
+        state_offset: Int, flat index of the state
+        action:       Int, action number
+        '''
+        return self.get_row(state_offset)[action]
+
+    def set_value(self, state_offset, action, val):
+        '''
+        Set the value of a single state-action
+
+        state_offset: Int, flat index of the state
+        action:       Int, action number
+        val:          Float value to set the table cell to
+        '''
+        if self._changes is not None:
+            self._track(state_offset, action)
+        if self._rows is None:
+            self._table.get_row_for_write(state_offset)[action] = val
+        else:
+            self._rows[state_offset, action] = val
+
+    def update_batch(self, transitions):
+        '''
+        Apply the Q-learning update for a batch of transitions at once
+
+        transitions: Structured array of utils.TRANSITION_DTYPE
+
+        Targets come from the table before the batch. A state-action that is
+        in the batch k times moves toward the mean of its targets as much as
+        k updates with the same target would: 1 - (1 - LR)^k of the way.
+        The result only depends on the transitions, not on their order.
+        '''
+        if len(transitions) == 0:
+            return
+        num_actions = self.table.shape[-1]
+
+        # Max Q-value over the stored valid actions of each next state
+        targets = transitions['reward'].astype(np.float64)
+        live = np.flatnonzero(~transitions['done'] & (transitions['next_mask'] != 0))
+        if len(live):
+            rows = self.get_rows(transitions['next_state'][live].astype(np.int64))
+            valid = (transitions['next_mask'][live, None] >> np.arange(num_actions, dtype=np.uint32)) & 1
+            q_max = np.where(valid.astype(bool), rows, -np.inf).max(axis=1)
+            targets[live] += self.discount_factor * q_max
+
+        cells = transitions['state'].astype(np.int64) * num_actions + transitions['action']
+        cells, inverse, counts = np.unique(cells, return_inverse=True, return_counts=True)
+        if self._changes is not None:
+            for cell, q_old in zip(cells.tolist(), self.get_cells(cells)):
+                if cell not in self._changes:
+                    self._changes[cell] = q_old
+        mean_targets = np.bincount(inverse, weights=targets) / counts
+        step = 1 - (1 - self.learning_rate) ** counts
+
+        if self.is_compact:
+            flat = self._table.rows.reshape(-1)
+            index = self._table.get_cell_indices(cells, write=True)
+            q_old = flat[index]
+            flat[index] = q_old + step * (mean_targets - q_old)
+        elif self._rows is None:
+            for cell, t, k in zip(cells.tolist(), mean_targets, step):
+                row = self._table.get_row_for_write(cell // num_actions)
+                a = cell % num_actions
+                row[a] += k * (t - row[a])
+        else:
+            flat = self._rows.reshape(-1)
+            q_old = flat[cells]
+            flat[cells] = q_old + step * (mean_targets - q_old)
 
     def set(self, ind_tpl, val):
         '''
@@ -69,6 +430,8 @@ class QTable:
         if not isinstance(ind_tpl, tuple):
             raise TypeError('QTable must be indexed with tuple')
 
+        if self._changes is not None:
+            self._track(int(np.ravel_multi_index(ind_tpl[:-1], self.table.shape[:-1])), ind_tpl[-1])
         self.table[ind_tpl] = val
 
 
@@ -90,9 +453,156 @@ class QTable:
 
         ind_tpls: List of tuples, each for a single cell in the table
         '''
-        qvals = [self.get(x) for x in ind_tpls]
-        index, max_val = -1, -10
-        for i in range(len(qvals)):
-            if qvals[i] > max_val:
-                index, max_val = i, qvals[i]
-        return ind_tpls[index], max_val
\ No newline at end of file
+        if self._rows is None:
+            qvals = np.array([self.table[x] for x in ind_tpls])
+        else:
+            qvals = self.table[tuple(np.array(ind_tpls).T)]
+        index = qvals.argmax()
+        return ind_tpls[index], qvals[index]
+
+    def get_best_action(self, state_offset, mask, rng=None):
+        '''
+        Get the valid action with the largest Q-value in a state, and the Q-value itself
+
+        state_offset: Int, flat index of the state
+        mask:         Bool array of valid actions. Actions past the end of the table are ignored.
+                      Or an int array of the valid actions, all stored in the table.
+        rng:          Numpy Generator to break ties randomly.
+                      If None, ties go to the lowest action.
+        '''
+        row = self.get_row(state_offset)
+        if mask.dtype == bool:
+            actions = np.flatnonzero(mask[:len(row)])
+        else:
+            actions = mask
+        if len(actions) == 0:
+            raise ValueError('None of the valid actions are stored in the QTable')
+
+        qvals = row[actions]
+        if rng is None:
+            i = qvals.argmax()
+        else:
+            ties = np.flatnonzero(qvals == qvals.max())
+            i = ties[0] if len(ties) == 1 else rng.choice(ties)
+        return int(actions[i]), qvals[i]
+
+    def get_rows(self, state_offsets):
+        '''
+        Get the action values of many states as a (n, num actions) array
+
+        state_offsets: Int array of flat state indices
+        '''
+        if self.is_compact:
+            return self._table.get_rows(state_offsets)
+        if self._rows is None:
+            if len(state_offsets) == 0:
+                return np.zeros((0, self.table.num_actions), dtype=self.dtype)
+            return np.stack([self._table.get_row(s) for s in state_offsets.tolist()])
+        return self._rows[state_offsets]
+
+    def get_values(self, state_offsets, actions):
+        '''
+        Get the values of the same actions in many states as a (n states, n actions) array,
+        in a single gather from the table
+
+        state_offsets: Int array of flat state indices
+        actions:       Int array of actions
+        '''
+        if self.is_compact:
+            return self._table.rows[self._table.get_row_indices(state_offsets)[:, None], actions]
+        if self._rows is None:
+            return self.get_rows(state_offsets)[:, actions]
+        return self._rows[state_offsets[:, None], actions]
+
+    def get_best_actions(self, state_offsets, masks, rng=None):
+        '''
+        Batched get_best_action for many states at once
+
+        state_offsets: Int array (n,) of flat state indices
+        masks:         Bool array (n, >= num actions) of valid actions.
+                       Actions past the end of the table are ignored.
+        rng:           Numpy Generator to break ties randomly.
+                       If None, ties go to the lowest action.
+
+        Returns (actions, qvals), each (n,).
+        States with no valid action in the table get action -1 and Q-value 0.
+        '''
+        rows = self.get_rows(state_offsets)
+        masks = masks[:, :rows.shape[1]]
+        qvals = np.where(masks, rows, -np.inf)
+        if rng is None:
+            actions = qvals.argmax(axis=1)
+        else:
+            ties = qvals == qvals.max(axis=1, keepdims=True)
+            actions = np.where(ties, rng.random(ties.shape), -1).argmax(axis=1)
+
+        best = rows[np.arange(len(rows)), actions]
+        none_valid = ~masks.any(axis=1)
+        actions[none_valid] = -1
+        best[none_valid] = 0
+        return actions, best
+
+def _get_file_crc32(filename, chunk_size=1 << 20):
+    crc = 0
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+def check_delta_base(filename, data, base):
+    '''
+    Raise ValueError if the base of a delta file isn't the file it was saved on,
+    e.g. because training was resumed from an earlier checkpoint and overwrote it.
+    Deltas saved without a checksum aren't checked.
+
+    filename: Path of the delta file
+    data:     The delta file, opened with np.load
+    base:     Path of its base file
+    '''
+    if 'base_crc32' not in data:
+        return
+    if (os.path.getsize(base) != int(data.get('base_size')) or
+        _get_file_crc32(base) != int(data.get('base_crc32'))):
+        raise ValueError(f'{base} has changed since the delta {filename} was saved on it')
+
+def _is_compressed(filename):
+    '''
+    Whether any member of an .npz file is compressed
+    '''
+    with zipfile.ZipFile(filename) as zf:
+        return any([info.compress_type != zipfile.ZIP_STORED for info in zf.infolist()])
+
+def _memmap_npz_member(filename, name, mode):
+    '''
+    Memory map an array saved uncompressed in an .npz file
+
+    filename: Path of the .npz file
+    name:     Name of the array in the file
+    mode:     np.memmap mode
+
+    Returns None if the array is compressed.
+    '''
+    with zipfile.ZipFile(filename) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(filename, 'rb') as f:
+        # The data follows the local file header, whose name and extra field
+        # lengths can differ from the central directory's
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
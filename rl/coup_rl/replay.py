@@ -0,0 +1,76 @@
+import numpy as np
+from coup_rl.utils import TRANSITION_DTYPE
+
+class ReplayBuffer:
+    '''
+    Experience replay for Q-learning
+    A fixed size ring buffer of transitions, preallocated as a structured array
+    of utils.TRANSITION_DTYPE. Once full, the oldest transitions are overwritten.
+
+    Minibatches sampled from it are applied with QTable.update_batch,
+    so each transition can be used many times, a whole batch per numpy call.
+    '''
+    def __init__(self, capacity, rng=None):
+        '''
+        capacity: Max number of transitions kept
+        rng:      Numpy Generator for sampling. Default is a new unseeded one.
+        '''
+        if capacity < 1:
+            raise ValueError('Replay buffer capacity must be at least 1')
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=TRANSITION_DTYPE)
+        # Index the next transition is written to
+        self.pos = 0
+        self.size = 0
+        # Total number of transitions ever added
+        self.num_added = 0
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def __len__(self):
+        return self.size
+
+    def add(self, transitions):
+        '''
+        Add transitions, overwriting the oldest once full
+
+        transitions: Structured array of TRANSITION_DTYPE,
+                     or a list of tuples in its field order, like Agent.transitions
+        '''
+        if not isinstance(transitions, np.ndarray):
+            transitions = np.array(transitions, dtype=TRANSITION_DTYPE)
+        n = len(transitions)
+        if n == 0:
+            return
+        if n > self.capacity:
+            # Only the newest would be kept
+            transitions = transitions[-self.capacity:]
+            self.num_added += n - self.capacity
+            n = self.capacity
+
+        first = min(n, self.capacity - self.pos)
+        self.buffer[self.pos:self.pos + first] = transitions[:first]
+        self.buffer[:n - first] = transitions[first:]
+        self.pos = (self.pos + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        self.num_added += n
+
+    def sample(self, batch_size):
+        '''
+        Uniformly sample transitions, with replacement
+
+        Returns structured array (batch_size,) of TRANSITION_DTYPE
+        '''
+        if self.size == 0:
+            raise ValueError('Cannot sample from an empty replay buffer')
+        return self.buffer[self.rng.integers(self.size, size=batch_size)]
+
+    def replay(self, qtable, batch_size, num_batches):
+        '''
+        Apply minibatches of sampled transitions to a QTable, one update_batch each
+
+        qtable:      QTable to update
+        batch_size:  Number of transitions per minibatch
+        num_batches: Number of minibatches
+        '''
+        for _ in range(num_batches):
+            qtable.update_batch(self.sample(batch_size))
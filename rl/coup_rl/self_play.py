@@ -1,9 +1,16 @@
 import logging
+import os
 import re
+import time
+import numpy as np
 import gym
 import gym_coup
+from gym_coup.envs.coup_env import NUM_ACTIONS
 from coup_rl.qtable import QTable
 from coup_rl.agent import Agent
+from coup_rl.ismcts import ISMCTSAgent
+from coup_rl.metrics import TrainingMetrics
+from coup_rl.replay import ReplayBuffer
 from coup_rl.utils import get_num_changed, has_converged
 
 logging.basicConfig()
@@ -15,13 +22,51 @@ class SelfPlay:
                  learning_rate=None,
                  discount_factor=None,
                  epsilon=None,
-                 log_level=None):
+                 log_level=None,
+                 sparse=False,
+                 dtype=None,
+                 full_checkpoint=10,
+                 metrics_file=None,
+                 metrics_interval=None,
+                 seed=None,
+                 headless=False,
+                 compact=False,
+                 replay_capacity=None,
+                 replay_batch_size=256,
+                 replay_ratio=4.0,
+                 search_time=None,
+                 search_workers=1,
+                 record_file=None):
         '''
         filepath:        Path for file ending in .npz
         learning_rate:   Float (0, 1]
         discount_factor: Float [0, 1]
         epsilon:         Float [0, 1]
         log_level:       coup_rl log level
+        sparse:          Store the QTable sparsely, only allocating visited states.
+                         An existing dense file is converted.
+        dtype:           Numpy float dtype of the Q-values. Default float64 for a new table.
+                         An existing file is converted if supplied.
+        full_checkpoint: Save a full file every this many checkpoints.
+                         The others only save the Q-values changed since the last checkpoint.
+                         1 to always save full files.
+        metrics_file:    Path of a .csv or .jsonl file to write training metrics to
+        metrics_interval: Number of episodes between metrics rows.
+                          Metrics are only collected if this or metrics_file is supplied.
+        seed:            Int seed to replay a training run exactly. None for fresh entropy.
+                         The env and each agent get independent streams spawned from it.
+        headless:        Never render the env, even if gym_coup logs at the info level
+        compact:         Store only the reachable states of the QTable.
+                         An existing dense or sparse file is converted.
+        replay_capacity: Learn from a replay buffer of this many transitions instead of
+                         updating after every step. None to update after every step.
+        replay_batch_size: Number of transitions in each replayed minibatch
+        replay_ratio:    Number of transitions replayed for each new one
+        search_time:     Seconds for P2 to search each move with ISMCTS, using the QTable
+                         being trained as its prior. Only P1 learns. None for both to learn.
+        search_workers:  Number of processes P2 searches each move with.
+                         More than 1 needs a dense QTable, which they share in memory.
+        record_file:     Path of a trajectory file to append every game to
 
         Must supply lr, df, eps when creating new table.
         Otherwise, supplying them replaces params in existing file.
@@ -47,8 +92,16 @@ class SelfPlay:
         self.filepath_no_suf = '/'.join(fp_split)
         # Full filepath except episode num and .npz
 
+        self.headless = headless
+
+        # Independent random streams for the env, agents, and any worker processes
+        self.seed_sequence = np.random.SeedSequence(seed)
+        logger.debug(f'Seed: {self.seed_sequence.entropy}')
+        env_seed, p1_seed, p2_seed = self.seed_sequence.spawn(3)
+
         # Make the gym env
-        self.env = gym.make('coup-v0')
+        self.env = gym.make('coup-v0', record_file=record_file)
+        self.env.seed(env_seed)
 
         if log_level is not None:
             logger.setLevel(log_level)
@@ -56,7 +109,7 @@ class SelfPlay:
         # Try to load existing Q Table
         try:
             self.qtable = QTable()
-            self.qtable.load(self.filepath)
+            self.qtable.load(self.filepath, sparse=True if sparse else None, dtype=dtype, compact=compact)
             self.last_file = self.filepath
 
             # Update the params mid-training if supplied
@@ -72,12 +125,44 @@ class SelfPlay:
                 epsilon is not None):
                 # Create new Q Table
                 shape = (15, 15, 4, 4, 13, 13, self.env.action_space.n - 7)
-                self.qtable = QTable(shape, learning_rate, discount_factor, epsilon)
+                self.qtable = QTable(shape, learning_rate, discount_factor, epsilon,
+                                     sparse=sparse, dtype=dtype or np.float64, compact=compact)
             else:
                 raise RuntimeError('Agent file does not exist, and not enough information was provided to create a new agent')
 
-        self.p1 = Agent(1, self.env, self.qtable)
-        self.p2 = Agent(2, self.env, self.qtable)
+        # Track changed cells for delta checkpoints
+        self.full_checkpoint = full_checkpoint
+        # The first checkpoint after loading an existing file is always full,
+        # so this run's checkpoints don't depend on files an earlier run may have left
+        self.first_save_after_resume = self.last_file is not None
+        if self.full_checkpoint > 1:
+            self.qtable.track_changes()
+
+        self.metrics = None
+        if metrics_file is not None or metrics_interval is not None:
+            action_names = [self.env.actions[a] for a in range(NUM_ACTIONS)]
+            self.metrics = TrainingMetrics(action_names, metrics_file, metrics_interval or 1000)
+
+        # With replay, agents record transitions, which are added to the buffer after each game
+        self.replay = None
+        self.transitions = None
+        if replay_capacity:
+            replay_seed, = self.seed_sequence.spawn(1)
+            self.replay = ReplayBuffer(replay_capacity, rng=np.random.default_rng(replay_seed))
+            self.transitions = []
+        self.replay_batch_size = replay_batch_size
+        self.replay_ratio = replay_ratio
+        # Number of transitions owed to replay, carried between games
+        self._replay_credit = 0.0
+
+        self.p1 = Agent(1, self.env, self.qtable, transitions=self.transitions,
+                        metrics=self.metrics, rng=np.random.default_rng(p1_seed))
+        if search_time is not None:
+            self.p2 = ISMCTSAgent(2, self.env, self.qtable, time_budget=search_time,
+                                  workers=search_workers, rng=np.random.default_rng(p2_seed))
+        else:
+            self.p2 = Agent(2, self.env, self.qtable, transitions=self.transitions,
+                            metrics=self.metrics, rng=np.random.default_rng(p2_seed))
 
     def train(self, episodes, checkpoint, conv_eps):
         '''
@@ -87,51 +172,133 @@ class SelfPlay:
         '''
         ep = 1
         converged = False
-        while ep <= episodes and not converged:
-            self.env.reset()
-            self.run_game()
-
-            if ep % checkpoint == 0 or ep == episodes:
-                logger.info(f'Saving at checkpoint. Episode {ep} / {episodes}')
-
-                # Comparison metrics
-                if self.last_file is not None:
-                    # Use prev table
-                    qold = QTable()
-                    qold.load(self.last_file)
-                    num_changed = get_num_changed(qold.table, self.qtable.table)
-                    logger.info(f'\tNum Q-values modified: {num_changed}')
-                    converged = has_converged(qold.table, self.qtable.table, conv_eps)
-                    if converged:
-                        logger.info('Converged')
-
-                num_ep = str(self.start_ep + ep)
-                num_ep = (10-len(num_ep)) * '0' + num_ep
-                self.last_file = self.filepath_no_suf + num_ep + '.npz'
-                self.qtable.save(self.last_file)
-
-            ep += 1
+        try:
+            while ep <= episodes and not converged:
+                self.env.reset()
+                self.run_game()
+                if self.metrics is not None:
+                    self.metrics.end_episode(self.env)
+
+                if ep % checkpoint == 0 or ep == episodes:
+                    converged = self.save_checkpoint(ep, episodes, conv_eps)
+
+                ep += 1
+        finally:
+            if isinstance(self.p2, ISMCTSAgent):
+                self.p2.close()
+            # Writes the buffered metrics and recorded games, even if training was interrupted
+            if self.metrics is not None:
+                self.metrics.close()
+            self.env.close()
+
+    def save_checkpoint(self, ep, episodes, conv_eps, qtable=None):
+        '''
+        Save the agent to a new file named with its total number of episodes,
+        and compare it to the last saved file
+
+        When self.qtable is tracking changes, the comparison uses only the changed cells,
+        and the file is a delta on the last saved file unless a full file is due.
+
+        ep:       Number of episodes run in this training session
+        episodes: Total number of episodes in this training session
+        conv_eps: Convergence epsilon. Max difference for convergence
+        qtable:   QTable to save. Default self.qtable
+
+        Returns whether the value function has converged
+        '''
+        if qtable is None:
+            qtable = self.qtable
+        logger.info(f'Saving at checkpoint. Episode {ep} / {episodes}')
+
+        tracked = qtable is self.qtable and qtable.is_tracking_changes
+        converged = False
+        # Comparison metrics
+        if tracked and self.last_file is not None:
+            # Old values of changed cells are tracked, so no need to load the prev table
+            _, old, new = qtable.get_changes()
+            num_changed = get_num_changed(old, new)
+            logger.info(f'\tNum Q-values modified: {num_changed}')
+            converged = has_converged(old, new, conv_eps)
+            if converged:
+                logger.info('Converged')
+        elif self.last_file is not None:
+            # Use prev table
+            qold = QTable()
+            qold.load(self.last_file)
+            num_changed = get_num_changed(qold.table, qtable.table)
+            logger.info(f'\tNum Q-values modified: {num_changed}')
+            converged = has_converged(qold.table, qtable.table, conv_eps)
+            if converged:
+                logger.info('Converged')
+
+        num_ep = str(self.start_ep + ep)
+        num_ep = (10-len(num_ep)) * '0' + num_ep
+        filename = self.filepath_no_suf + num_ep + '.npz'
+        if os.path.exists(filename):
+            # Resumed from an earlier checkpoint. Deltas saved on the old file
+            # will refuse to load, since its checksum changes
+            logger.warning(f'Overwriting {filename}. Later delta checkpoints based on it can no longer be loaded')
+        if (tracked and self.last_file is not None and not self.first_save_after_resume and
+            qtable.delta_depth + 1 < self.full_checkpoint):
+            qtable.save_delta(filename, self.last_file)
+        else:
+            qtable.save(filename)
+        self.last_file = filename
+        self.first_save_after_resume = False
+        return converged
 
     def run_game(self):
         '''
         Run a single Coup game
         '''
-        done = False
-        whose_action = 0
-        while not done:
-            # P1 turn
-            while not done and whose_action != 1:
-                obs, reward, done, info = self.p1.step()
-                self.p2.reward -= reward # Make sure the other agent gets feedback for what happened
-                self.env.render()
-                whose_action = obs[-1]
-            # P2 turn
-            while not done and whose_action != 0:
-                obs2, reward2, done, info2 = self.p2.step()
-                self.p1.reward -= reward2 # Make sure the other agent gets feedback for what happened
-                self.env.render()
-                whose_action = obs2[-1]
-
-        # Do a final update now that the game is over
-        self.p1.update_q_value(0)
-        self.p2.update_q_value(0)
+        play_game(self.env, self.p1, self.p2, render=not self.headless)
+        if self.replay is not None:
+            self.replay_transitions()
+
+    def replay_transitions(self):
+        '''
+        Add the transitions of the last game to the replay buffer,
+        then replay minibatches of replay_ratio sampled transitions for each one
+        '''
+        if self.metrics is not None:
+            t = time.perf_counter()
+        self._replay_credit += self.replay_ratio * len(self.transitions)
+        self.replay.add(self.transitions)
+        self.transitions.clear()
+
+        num_batches = int(self._replay_credit // self.replay_batch_size)
+        if num_batches:
+            self.replay.replay(self.qtable, self.replay_batch_size, num_batches)
+            self._replay_credit -= num_batches * self.replay_batch_size
+        if self.metrics is not None:
+            self.metrics.add_time('update', t)
+
+def play_game(env, p1, p2, render=True):
+    '''
+    Run a single Coup game between two agents in env
+
+    env:    gym-coup env, already reset
+    p1, p2: Agents with ids 1 and 2
+    render: Render the env after every action
+    '''
+    done = False
+    whose_action = 0
+    while not done:
+        # P1 turn
+        while not done and whose_action != 1:
+            obs, reward, done, info = p1.step()
+            p2.reward -= reward # Make sure the other agent gets feedback for what happened
+            if render:
+                env.render()
+            whose_action = obs[-1]
+        # P2 turn
+        while not done and whose_action != 0:
+            obs2, reward2, done, info2 = p2.step()
+            p1.reward -= reward2 # Make sure the other agent gets feedback for what happened
+            if render:
+                env.render()
+            whose_action = obs2[-1]
+
+    # Do a final update now that the game is over
+    p1.end_game()
+    p2.end_game()
@@ -0,0 +1,471 @@
+import time
+import logging
+from array import array
+import numpy as np
+from gym_coup.envs.coup_env import (Game, Player, CoupEnv, Card, VALID_ACTIONS_BY_MASK,
+                                    PHASE_EXCHANGE_RETURN, NONE)
+from coup_rl.qtable import QTable
+from coup_rl.utils import convert_obs_to_state_offset, STATE_SHAPE
+
+logging.basicConfig()
+logger = logging.getLogger('coup_rl')
+
+# Actions stored in the QTable
+NUM_STORED_ACTIONS = 26
+
+class _NeedDraw(Exception):
+    '''
+    Raised by _ScriptedGame when a card is drawn past the end of its script
+    '''
+    def __init__(self, deck):
+        self.deck = deck
+
+class _ScriptedGame(Game):
+    '''
+    Game whose draws are chosen in advance instead of shuffled,
+    so every chance outcome of an action can be played out in turn
+
+    The deck is only a multiset of card values. Each draw takes the next value
+    of the script, and multiplies prob by its chance of being drawn at random.
+    '''
+    __slots__ = ('script', 'prob')
+
+    def draw_card(self, index=0):
+        if not self.script:
+            raise _NeedDraw(self.deck)
+        val = self.script.pop(0)
+        self.prob *= self.deck.count(val) / len(self.deck)
+        self.deck.remove(val)
+        return val
+
+    def shuffle_deck(self):
+        pass
+
+# A full game state is a tuple:
+#     (P1 card codes, P2 card codes, P1 coins, P2 coins, P1 last action, P2 last action,
+#      whose turn, whose action, is turn begin, P1 lost challenge, P2 lost challenge)
+# Card codes are as in Player.cards. Last actions from before the current turn
+# never affect the rest of the game, so they are NONE in the state.
+# The 2 cards drawn in an exchange are sorted, since they can be returned in either order.
+# The rules are the same for both players, so states are always from the view of
+# the player whose turn it is: P1 in the state is that player, and whose turn is 0.
+# States are packed into an int64 with encode_state to keep the state space small.
+
+def encode_state(state):
+    '''
+    Pack a full game state tuple into an int
+    '''
+    code = 0
+    for cards in state[0:2]:
+        for i in range(4):
+            code = code * 11 + (cards[i] + 1 if i < len(cards) else 0)
+    if not (0 <= state[2] <= 12 and 0 <= state[3] <= 12):
+        raise ValueError(f'Coins out of range in {state}')
+    code = (code * 13 + state[2]) * 13 + state[3]
+    code = (code * 33 + state[4] + 1) * 33 + state[5] + 1
+    for flag in state[6:11]:
+        code = code * 2 + int(flag)
+    return code
+
+def decode_state(code):
+    '''
+    Unpack an int from encode_state into a full game state tuple
+    '''
+    code = int(code)
+    flags = []
+    for _ in range(5):
+        code, f = divmod(code, 2)
+        flags.insert(0, f)
+    code, la2 = divmod(code, 33)
+    code, la1 = divmod(code, 33)
+    code, coins2 = divmod(code, 13)
+    code, coins1 = divmod(code, 13)
+    slots = []
+    for _ in range(8):
+        code, c = divmod(code, 11)
+        slots.insert(0, c - 1)
+    cards = [tuple([c for c in slots[p * 4:p * 4 + 4] if c != -1]) for p in range(2)]
+    return (cards[0], cards[1], coins1, coins2, la1 - 1, la2 - 1,
+            flags[0], flags[1], bool(flags[2]), bool(flags[3]), bool(flags[4]))
+
+def _make_game(state, script=()):
+    cards, coins, last_action, lost = state[0:2], state[2:4], state[4:6], state[9:11]
+    game = object.__new__(_ScriptedGame)
+    game.rng = None
+    game.players = []
+    deck = [3] * len(Card.names)
+    for p in range(2):
+        player = Player(p)
+        player._set_cards(cards[p])
+        player.coins = coins[p]
+        player.last_action = last_action[p]
+        player.lost_challenge = lost[p]
+        game.players.append(player)
+        for c in cards[p]:
+            deck[c >> 1] -= 1
+    game.deck = [v for v in range(len(Card.names)) for _ in range(deck[v])]
+    game.whose_turn, game.whose_action, game.is_turn_begin = state[6:9]
+    game.turn_count = 0
+    game.game_over = False
+    game.script = list(script)
+    game.prob = 1.0
+    return game
+
+def _get_state(game):
+    '''
+    Full state of a game from the view of the player whose turn it is
+
+    Returns (state or None if the game is over, whether the players are swapped from the game)
+    '''
+    if game.game_over:
+        return None, False
+    swap = game.whose_turn == 1
+    p1, p2 = game.players[::-1] if swap else game.players
+    cards = []
+    for p in [p1, p2]:
+        c = p.cards
+        if len(c) == 4 and c[2] > c[3]:
+            c = c[:2] + (c[3], c[2])
+        cards.append(c)
+    if game.is_turn_begin:
+        last_action = (NONE, NONE)
+    else:
+        last_action = (p1.last_action, p2.last_action)
+    return (cards[0], cards[1], p1.coins, p2.coins) + last_action + (
+            0, game.whose_action ^ swap, game.is_turn_begin,
+            p1.lost_challenge, p2.lost_challenge), swap
+
+def _play_out(state, play):
+    '''
+    Call play(game) on a new _ScriptedGame of the state for every chance outcome
+
+    Returns list of games after play. Each game's prob is the probability of its outcome.
+    '''
+    games = []
+    scripts = [()]
+    while scripts:
+        script = scripts.pop()
+        game = _make_game(state, script)
+        try:
+            play(game)
+        except _NeedDraw as e:
+            scripts += [script + (v,) for v in sorted(set(e.deck))]
+            continue
+        games.append(game)
+    return games
+
+def get_outcomes(state, action):
+    '''
+    Every chance outcome of taking an action in a full game state
+
+    Returns list of (next state or None if the game is over, whether its players are swapped
+                     from this state, probability, reward of the actor)
+    '''
+    name = CoupEnv.actions[action]
+    actor = state[7]
+    num_up = [sum([c & 1 for c in cards]) for cards in state[0:2]]
+    outcomes = {}
+    for game in _play_out(state, lambda g: getattr(g, name)()):
+        # Same reward as CoupEnv.step
+        reward = ((game.players[1 - actor].num_face_up - num_up[1 - actor]) -
+                  (game.players[actor].num_face_up - num_up[actor]))
+        key = _get_state(game) + (reward,)
+        outcomes[key] = outcomes.get(key, 0.0) + game.prob
+    return [(s, swap, p, r) for (s, swap, r), p in outcomes.items()]
+
+def get_initial_states():
+    '''
+    Every deal of a new game with P1 going first, and its probability
+
+    Returns list of (state, probability)
+    '''
+    def deal(game):
+        game.deal_cards()
+        # In a 2 player game, the player going first starts with 1 coin instead of 2
+        game.players[0].coins = 1
+
+    empty = ((), (), 0, 2, NONE, NONE, 0, 0, True, False, False)
+    states = {}
+    for game in _play_out(empty, deal):
+        key, _ = _get_state(game)
+        states[key] = states.get(key, 0.0) + game.prob
+    return list(states.items())
+
+class StateSpace:
+    '''
+    Every full game state reachable from a new game with P1 going first,
+    with the valid actions of each and the chance outcomes of each action
+    P1 of each state is the player whose turn it is.
+
+    Stored as flat arrays, so it can be saved and solved with numpy:
+        states:         Int64 (N,) full states packed by encode_state
+        actor:          Int8 (N,) player choosing the action, 0 or 1
+        stored:         Bool (N,) whether the actions are stored in the QTable (not an exchange return)
+        qtable_state:   Int64 (N,) QTable state offset from the actor's view
+        node_ptr:       Int64 (N + 1,) edges of state i are node_ptr[i]:node_ptr[i+1]
+        edge_action:    Int8 (E,) action of each edge, ascending within a state
+        edge_ptr:       Int64 (E + 1,) outcomes of edge j are edge_ptr[j]:edge_ptr[j+1]
+        out_next:       Int32 (O,) next state, -1 if the game is over
+        out_swap:       Bool (O,) whether P1 and P2 of the next state are swapped from this state
+        out_prob:       Float64 (O,) probability of the outcome
+        out_reward:     Int8 (O,) reward of the actor, as from CoupEnv.step
+        initial:        Int32 (I,) states a new game starts in
+        initial_prob:   Float64 (I,) probability of each
+    '''
+    FIELDS = ['states', 'actor', 'stored', 'qtable_state', 'node_ptr', 'edge_action',
+              'edge_ptr', 'out_next', 'out_swap', 'out_prob', 'out_reward', 'initial', 'initial_prob']
+
+    def __init__(self):
+        for f in self.FIELDS:
+            setattr(self, f, None)
+
+    @property
+    def num_states(self):
+        return len(self.states)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_action)
+
+    def enumerate(self):
+        '''
+        Find every reachable state by breadth first search from every deal
+        Takes about 20 minutes. Save the result to reuse it.
+        '''
+        start = time.time()
+        initial = get_initial_states()
+        # Packed state -> index. States are expanded in order of their index
+        index = {}
+        queue = array('q')
+        def get_index(state):
+            code = encode_state(state)
+            i = index.get(code)
+            if i is None:
+                i = len(index)
+                index[code] = i
+                queue.append(code)
+            return i
+
+        self.initial = np.array([get_index(s) for s, _ in initial], dtype=np.int32)
+        self.initial_prob = np.array([p for _, p in initial])
+
+        # Typed arrays take a fraction of the memory of lists
+        actor = array('b')
+        stored = array('b')
+        qtable_state = array('q')
+        node_ptr = array('q', [0])
+        edge_action = array('b')
+        edge_ptr = array('q', [0])
+        out_next = array('i')
+        out_swap = array('b')
+        out_prob = array('d')
+        out_reward = array('b')
+        i = 0
+        while i < len(queue):
+            state = decode_state(queue[i])
+            game = _make_game(state)
+            whose = game.whose_action
+            actor.append(whose)
+            stored.append(game.get_phase() != PHASE_EXCHANGE_RETURN)
+            qtable_state.append(convert_obs_to_state_offset(game.get_flat_obs(p2_view=whose == 1)))
+            for a in VALID_ACTIONS_BY_MASK[game.get_valid_action_mask()]:
+                edge_action.append(a)
+                for next_state, swap, p, r in get_outcomes(state, a):
+                    out_next.append(-1 if next_state is None else get_index(next_state))
+                    out_swap.append(swap)
+                    out_prob.append(p)
+                    out_reward.append(r)
+                edge_ptr.append(len(out_next))
+            node_ptr.append(len(edge_action))
+            i += 1
+            if i % 100000 == 0:
+                logger.info(f'Expanded {i} states, {len(queue) - i} queued, {time.time() - start:.0f}s')
+        del index
+
+        # Views of the typed arrays, to not copy them
+        self.states = np.frombuffer(queue, dtype=np.int64)
+        self.actor = np.frombuffer(actor, dtype=np.int8)
+        self.stored = np.frombuffer(stored, dtype=np.int8).astype(bool)
+        self.qtable_state = np.frombuffer(qtable_state, dtype=np.int64)
+        self.node_ptr = np.frombuffer(node_ptr, dtype=np.int64)
+        self.edge_action = np.frombuffer(edge_action, dtype=np.int8)
+        self.edge_ptr = np.frombuffer(edge_ptr, dtype=np.int64)
+        self.out_next = np.frombuffer(out_next, dtype=np.int32)
+        self.out_swap = np.frombuffer(out_swap, dtype=np.int8).astype(bool)
+        self.out_prob = np.frombuffer(out_prob, dtype=np.float64)
+        self.out_reward = np.frombuffer(out_reward, dtype=np.int8)
+        logger.info(f'{self.num_states} states, {self.num_edges} state-actions, '
+                    f'{len(self.out_next)} outcomes in {time.time() - start:.0f}s')
+
+    def save(self, filename):
+        np.savez(filename, **{f: getattr(self, f) for f in self.FIELDS})
+
+    def load(self, filename):
+        with np.load(filename) as data:
+            for f in self.FIELDS:
+                setattr(self, f, data.get(f))
+
+    def get_edge_nodes(self):
+        '''
+        State of each edge, int64 (E,)
+        '''
+        return np.repeat(np.arange(self.num_states), np.diff(self.node_ptr))
+
+    def get_outcome_edges(self):
+        '''
+        Edge of each outcome, int64 (O,)
+        '''
+        return np.repeat(np.arange(self.num_edges), np.diff(self.edge_ptr))
+
+def solve(space, discount_factor, tol=1e-8, max_iters=1000, policy_iters=100):
+    '''
+    Value iteration for greedy self-play
+
+    A Q-value is the actor's reward until its next stored decision, plus the discounted
+    value of that decision, like an Agent learns. The discount only applies at the actor's
+    own stored decisions, not the opponent's or its exchange returns.
+    The game is solved as zero-sum: a card lost on the opponent's step also counts,
+    as a reward to the opponent is the negative of the actor's. An Agent only counts
+    its own steps, but then each player values the game differently and greedy play
+    can cycle between policies without converging.
+    Exchange returns are chosen for the best value after them, rather than stored.
+    Ties go to the lowest action, like Agent.
+
+    With the discount only at a player's own decisions, the players' values aren't
+    exact negatives, so the greedy actions of a few hundred states can cycle forever.
+    After policy_iters iterations the chosen actions are fixed, and the rest of the
+    iterations only evaluate them. States left with a better action are logged.
+
+    space:           StateSpace
+    discount_factor: Float [0, 1)
+    tol:             Stop when no value changes by more than this
+    max_iters:       Max number of iterations
+    policy_iters:    Number of iterations the chosen actions can change for
+
+    Returns (q, chosen)
+        q:      Float64 (E,) Q-value of each edge to its actor
+        chosen: Int64 (N,) edge chosen greedily in each state
+    '''
+    start = time.time()
+    n = space.num_states
+    edge_node = space.get_edge_nodes()
+    edges = np.arange(space.num_edges)
+    # Expected reward of each edge to its actor
+    edge_reward = np.add.reduceat(space.out_prob * space.out_reward, space.edge_ptr[:-1])
+    discount = np.where(space.stored, discount_factor, 1.0)
+
+    # Each state has 2 values, to its actor and to the other player, in one array:
+    # w[i] to the actor of state i, and w[n + 1 + i] to the other player.
+    # Game over leads to the extra state n, with no future value
+    out_node = edge_node[space.get_outcome_edges()]
+    out_next = np.where(space.out_next < 0, n, space.out_next)
+    next_actor = np.where(space.out_next < 0, 0, space.actor[out_next % n])
+    # Whether the actor of a state is also the actor of the next state
+    same = (space.actor[out_node] ^ space.out_swap) == next_actor
+    del out_node, next_actor
+    actor_index = np.where(same, out_next, out_next + n + 1).astype(np.int32)
+    other_index = np.where(same, out_next + n + 1, out_next).astype(np.int32)
+    del out_next, same
+
+    # Value of each state to each player: the reward until their next stored decision
+    # plus the discounted Q-value there
+    w = np.zeros(2 * (n + 1))
+    chosen = None
+    for it in range(max_iters):
+        prev_chosen = chosen
+        q = edge_reward + np.add.reduceat(space.out_prob * w[actor_index], space.edge_ptr[:-1])
+        q_max = np.maximum.reduceat(q, space.node_ptr[:-1])
+        if it < policy_iters:
+            # First edge with the max is the lowest action
+            chosen = np.minimum.reduceat(np.where(q == q_max[edge_node], edges, space.num_edges),
+                                         space.node_ptr[:-1])
+        # The other player gets the negative reward of the chosen edge, and isn't discounted here
+        q_other = np.add.reduceat(space.out_prob * w[other_index], space.edge_ptr[:-1])
+        w_new = np.zeros_like(w)
+        w_new[:n] = discount * q[chosen]
+        w_new[n + 1:2 * n + 1] = q_other[chosen] - edge_reward[chosen]
+        del q_other
+        diff = np.amax(np.absolute(w_new - w))
+        w = w_new
+        if logger.isEnabledFor(logging.DEBUG):
+            num_changed = n if prev_chosen is None else np.count_nonzero(chosen != prev_chosen)
+            logger.debug(f'Iteration {it + 1}: max change {diff}, {num_changed} choices changed')
+        if diff < tol:
+            break
+    logger.info(f'Value iteration: {it + 1} iterations, max change {diff}, {time.time() - start:.0f}s')
+    num_greedy = np.count_nonzero(q[chosen] >= q_max - tol)
+    if num_greedy < n:
+        logger.info(f'{n - num_greedy} states have a better action than the fixed one')
+    return q, chosen
+
+def get_visits(space, chosen, epsilon, tol=1e-10, max_steps=10000):
+    '''
+    Expected number of visits to each state in a game, when both players
+    choose the greedy action, or a random valid action with probability epsilon
+
+    Returns (visits (N,), probability of each edge being taken in its state (E,))
+    '''
+    edge_node = space.get_edge_nodes()
+    out_edge = space.get_outcome_edges()
+    num_valid = np.diff(space.node_ptr)
+    policy = epsilon / num_valid[edge_node]
+    policy[chosen] += 1 - epsilon
+
+    ended = space.out_next < 0
+    out_next = space.out_next[~ended]
+    out_weight = (space.out_prob * policy[out_edge])[~ended]
+    out_node = edge_node[out_edge[~ended]]
+
+    d = np.zeros(space.num_states)
+    np.add.at(d, space.initial, space.initial_prob)
+    visits = np.zeros(space.num_states)
+    for _ in range(max_steps):
+        visits += d
+        d = np.bincount(out_next, weights=d[out_node] * out_weight, minlength=space.num_states)
+        if d.sum() < tol:
+            break
+    return visits, policy
+
+def project_to_qtable(space, q, visits, policy):
+    '''
+    Q-values of the QTable states, which leave out the phase of the turn and last actions,
+    so each holds many full states. Each is the average of its full states' Q-values,
+    weighted by how often they are visited, as Q-learning would average them.
+    Cells of unvisited full states are a plain average, and unreachable cells are 0.
+
+    Returns dense float64 array of the QTable shape
+    '''
+    edge_node = space.get_edge_nodes()
+    keep = space.stored[edge_node] & (space.edge_action < NUM_STORED_ACTIONS)
+    edges = np.flatnonzero(keep)
+    nodes = edge_node[edges]
+    cells = space.qtable_state[nodes] * NUM_STORED_ACTIONS + space.edge_action[edges]
+    q_actor = q[edges]
+    weights = visits[nodes] * policy[edges]
+
+    size = int(np.prod(STATE_SHAPE)) * NUM_STORED_ACTIONS
+    sum_w = np.bincount(cells, weights=weights, minlength=size)
+    sum_wq = np.bincount(cells, weights=weights * q_actor, minlength=size)
+    count = np.bincount(cells, minlength=size)
+    sum_q = np.bincount(cells, weights=q_actor, minlength=size)
+    table = np.where(sum_w > 0, sum_wq / np.where(sum_w > 0, sum_w, 1),
+                     sum_q / np.maximum(count, 1))
+    return table.reshape(STATE_SHAPE + (NUM_STORED_ACTIONS,))
+
+def solve_qtable(learning_rate, discount_factor, epsilon, space=None, tol=1e-8, max_iters=1000, policy_iters=100):
+    '''
+    Solve the game and return the result as a QTable, to use as a baseline agent
+    or to continue training from
+
+    learning_rate, discount_factor, epsilon: QTable parameters.
+        epsilon is also the exploration used to weight the full states of each QTable state.
+    space: StateSpace. Default enumerates it, which takes about 20 minutes.
+    '''
+    if space is None:
+        space = StateSpace()
+        space.enumerate()
+    q, chosen = solve(space, discount_factor, tol, max_iters, policy_iters)
+    visits, policy = get_visits(space, chosen, epsilon)
+    qtable = QTable(STATE_SHAPE + (NUM_STORED_ACTIONS,), learning_rate, discount_factor, epsilon)
+    qtable.table = project_to_qtable(space, q, visits, policy)
+    return qtable
@@ -0,0 +1,145 @@
+import numpy as np
+
+class SparseTable:
+    '''
+    Q-Table storage that only allocates visited states
+    Each state (every dimension except the last) maps to a row
+    of action values, allocated on the first write to that state.
+    Cells that were never written read as 0.
+
+    Supports the same tuple indexing of single cells as a numpy array.
+    '''
+    def __init__(self, shape, dtype=np.float64):
+        '''
+        shape: Tuple of ints for dimensions of table. Last is the actions.
+        dtype: Numpy dtype of the Q-values
+        '''
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.num_actions = self.shape[-1]
+        # Flat state index -> row of action values
+        self.rows = {}
+
+        # Row-major strides of the state dimensions
+        self._strides = []
+        stride = 1
+        for dim in reversed(self.shape[:-1]):
+            self._strides.insert(0, stride)
+            stride *= dim
+        self.num_states = stride
+
+        self._zero_row = np.zeros(self.num_actions, dtype=self.dtype)
+        self._zero_row.flags.writeable = False
+
+    def get_state_index(self, state):
+        '''
+        Flat index of a state, the table index without the action
+        '''
+        return sum([i * s for i, s in zip(state, self._strides)])
+
+    def get_row(self, state_ind):
+        '''
+        Action values of a flat state index. Read-only if never written.
+        '''
+        return self.rows.get(state_ind, self._zero_row)
+
+    def get_row_for_write(self, state_ind):
+        '''
+        Action values of a flat state index, allocating the row if needed
+        '''
+        row = self.rows.get(state_ind)
+        if row is None:
+            row = np.zeros(self.num_actions, dtype=self.dtype)
+            self.rows[state_ind] = row
+        return row
+
+    def __getitem__(self, ind_tpl):
+        return self.get_row(self.get_state_index(ind_tpl[:-1]))[ind_tpl[-1]]
+
+    def __setitem__(self, ind_tpl, val):
+        self.get_row_for_write(self.get_state_index(ind_tpl[:-1]))[ind_tpl[-1]] = val
+
+    def astype(self, dtype):
+        '''
+        Return a copy with the Q-values cast to another dtype
+        '''
+        table = SparseTable(self.shape, dtype)
+        for s, r in self.rows.items():
+            table.rows[s] = r.astype(dtype)
+        return table
+
+    @property
+    def nbytes(self):
+        return len(self.rows) * self.num_actions * self.dtype.itemsize
+
+    def get_states_and_rows(self):
+        '''
+        All allocated rows as arrays
+        Returns (flat state indices (n,), action values (n, num_actions))
+        '''
+        states = np.fromiter(self.rows.keys(), dtype=np.int64, count=len(self.rows))
+        if len(states):
+            rows = np.stack(list(self.rows.values()))
+        else:
+            rows = np.zeros((0, self.num_actions), dtype=self.dtype)
+        return states, rows
+
+    def count_nonzero(self):
+        _, rows = self.get_states_and_rows()
+        return np.count_nonzero(rows)
+
+    def to_dense(self):
+        '''
+        Return the full table as a numpy array
+        '''
+        arr = np.zeros(self.shape, dtype=self.dtype)
+        flat = arr.reshape(-1, self.num_actions)
+        states, rows = self.get_states_and_rows()
+        flat[states] = rows
+        return arr
+
+    @classmethod
+    def from_states_and_rows(cls, shape, states, rows):
+        table = cls(shape, rows.dtype)
+        for s, r in zip(states.tolist(), rows):
+            table.rows[s] = r.copy()
+        return table
+
+    @classmethod
+    def from_dense(cls, arr):
+        '''
+        Create from a full numpy array, allocating only states with a nonzero value
+        '''
+        flat = arr.reshape(-1, arr.shape[-1])
+        states = np.flatnonzero(flat.any(axis=1))
+        return cls.from_states_and_rows(arr.shape, states, flat[states])
+
+    def _aligned_rows(self, other):
+        '''
+        Rows of both tables for every state allocated in either
+        '''
+        if not isinstance(other, SparseTable):
+            other = SparseTable.from_dense(other)
+        states = set(self.rows.keys()) | set(other.rows.keys())
+        if not states:
+            empty = np.zeros((0, self.num_actions))
+            return empty, empty
+        a = np.stack([self.get_row(s) for s in states])
+        b = np.stack([other.get_row(s) for s in states])
+        return a, b
+
+    def num_changed(self, other):
+        '''
+        Number of cells with different values from another table
+        '''
+        a, b = self._aligned_rows(other)
+        return np.sum(a != b)
+
+    def max_abs_diff(self, other):
+        '''
+        Largest absolute difference of any cell from another table
+        '''
+        a, b = self._aligned_rows(other)
+        if a.size == 0:
+            return 0.0
+        return np.amax(np.absolute(a - b))
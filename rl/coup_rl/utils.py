@@ -1,4 +1,8 @@
+import functools
 import numpy as np
+from gym_coup.envs.coup_env import VALID_ACTION_ARRAYS, get_coins_bucket
+from coup_rl.sparse_table import SparseTable
+from coup_rl.compact_table import CompactTable
 
 def convert_obs_to_q_index(obs):
     '''
@@ -28,16 +32,220 @@ def convert_obs_to_q_index(obs):
 
     return [p1_cards, p2_cards, p1_face_up, p2_face_up, obs[16], obs[17]]
 
+# Dimensions of the state portion of the QTable index
+STATE_SHAPE = (15, 15, 4, 4, 13, 13)
+# Row-major strides of each state dimension
+STATE_STRIDES = tuple([int(np.prod(STATE_SHAPE[i+1:])) for i in range(len(STATE_SHAPE))])
+
+def _get_hand_index(c1, c2):
+    return c1 * 5 + c2 - (c1 * (c1+1))//2
+
+# Precomputed part of the state offset for each pair of cards or face up flags
+_P1_CARDS_OFFSET = [[_get_hand_index(c1, c2) * STATE_STRIDES[0] for c2 in range(5)] for c1 in range(5)]
+_P2_CARDS_OFFSET = [[_get_hand_index(c1, c2) * STATE_STRIDES[1] for c2 in range(5)] for c1 in range(5)]
+_P1_FACE_UP_OFFSET = [[(f1 * 2 + f2) * STATE_STRIDES[2] for f2 in range(2)] for f1 in range(2)]
+_P2_FACE_UP_OFFSET = [[(f1 * 2 + f2) * STATE_STRIDES[3] for f2 in range(2)] for f1 in range(2)]
+
+def convert_obs_to_state_offset(obs):
+    '''
+    Convert a CoupEnv observation into the flat index of its state in the QTable.
+    This is the same state as convert_obs_to_q_index, raveled into a single int,
+    and is the index for QTable.get_row
+
+    obs: CoupEnv Observation
+    '''
+    return (_P1_CARDS_OFFSET[obs[0]][obs[1]] +
+            _P2_CARDS_OFFSET[obs[4]][obs[5]] +
+            _P1_FACE_UP_OFFSET[obs[8]][obs[9]] +
+            _P2_FACE_UP_OFFSET[obs[12]][obs[13]] +
+            obs[16] * STATE_STRIDES[4] +
+            obs[17])
+
+def convert_obs_to_state_offsets(obs):
+    '''
+    Vectorized convert_obs_to_state_offset for many observations
+
+    obs: Int array (n, 21) of CoupEnv observations, like from BatchCoupEnv
+
+    Returns int64 array (n,)
+    '''
+    obs = obs.astype(np.int64)
+    return (_get_hand_index(obs[:, 0], obs[:, 1]) * STATE_STRIDES[0] +
+            _get_hand_index(obs[:, 4], obs[:, 5]) * STATE_STRIDES[1] +
+            (obs[:, 8] * 2 + obs[:, 9]) * STATE_STRIDES[2] +
+            (obs[:, 12] * 2 + obs[:, 13]) * STATE_STRIDES[3] +
+            obs[:, 16] * STATE_STRIDES[4] +
+            obs[:, 17])
+
+# Indices of the 2 cards kept by each exchange return action (26 - 31), in order
+EXCHANGE_KEPT_CARDS = [(2, 3), (1, 3), (1, 2), (0, 3), (0, 2), (0, 1)]
+
+def _build_exchange_state_offset():
+    '''
+    P1 cards and face up part of the state offset after each exchange return,
+    indexed by the 4 cards and 4 face up flags raveled, and exchange return action - 26
+
+    The env sorts the kept cards by card << 1 | face up, so the table does too.
+    '''
+    c = np.arange(5)
+    f = np.arange(2)
+    table = np.zeros((5, 5, 5, 5, 2, 2, 2, 2, 6), dtype=np.int64)
+    for i, (k1, k2) in enumerate(EXCHANGE_KEPT_CARDS):
+        # Broadcast the kept card and face up flags into their dimension of the table
+        cards = [c.reshape([-1 if d == k else 1 for d in range(4)] + [1] * 4) for k in (k1, k2)]
+        face_up = [f.reshape([1] * 4 + [-1 if d == k else 1 for d in range(4)]) for k in (k1, k2)]
+        codes = [cards[j] * 2 + face_up[j] for j in (0, 1)]
+        low = np.minimum(codes[0], codes[1])
+        high = np.maximum(codes[0], codes[1])
+        table[..., i] = (_get_hand_index(low >> 1, high >> 1) * STATE_STRIDES[0] +
+                         ((low & 1) * 2 + (high & 1)) * STATE_STRIDES[2])
+    return table.reshape(-1, 6)
+
+_EXCHANGE_STATE_OFFSET = _build_exchange_state_offset()
+
+def get_exchange_state_offsets(obs):
+    '''
+    State offsets after each exchange return, from an observation
+    during an exchange where P1 has 4 cards
+
+    obs: CoupEnv Observation, from the view of the player exchanging
+
+    Returns int array of 6, indexed by exchange return action - 26
+    '''
+    # Everything but P1's cards is the same after the exchange
+    rest = (_P2_CARDS_OFFSET[obs[4]][obs[5]] +
+            _P2_FACE_UP_OFFSET[obs[12]][obs[13]] +
+            obs[16] * STATE_STRIDES[4] +
+            obs[17])
+    # Raveled index of the 4 cards and face up flags. Faster than indexing each dimension
+    hand = ((((((obs[0] * 5 + obs[1]) * 5 + obs[2]) * 5 + obs[3]) * 2 + obs[8]) * 2 + obs[9]) * 2 + obs[10]) * 2 + obs[11]
+    return _EXCHANGE_STATE_OFFSET[hand] + rest
+
+def get_batch_exchange_state_offsets(obs):
+    '''
+    Vectorized get_exchange_state_offsets for many observations
+
+    obs: Int array (n, 21) of CoupEnv observations during an exchange
+
+    Returns int64 array (n, 6), indexed by exchange return action - 26
+    '''
+    obs = obs.astype(np.int64)
+    # Everything but P1's cards is the same after the exchange
+    rest = (convert_obs_to_state_offsets(obs) -
+            _get_hand_index(obs[:, 0], obs[:, 1]) * STATE_STRIDES[0] -
+            (obs[:, 8] * 2 + obs[:, 9]) * STATE_STRIDES[2])
+    hand = obs[:, 0]
+    for i in [1, 2, 3]:
+        hand = hand * 5 + obs[:, i]
+    for i in [8, 9, 10, 11]:
+        hand = hand * 2 + obs[:, i]
+    return _EXCHANGE_STATE_OFFSET[hand] + rest[:, None]
+
+# Bits of a valid action mask for the actions stored in the QTable (< 26)
+STORED_ACTIONS_MASK = (1 << 26) - 1
+
+# Record of one Q-learning update, to apply later with QTable.update_batch
+#   state, action: Flat state index and action of the Q-value to update
+#   reward:        Reward received since taking the action
+#   next_state:    Flat state index the agent acts from next
+#   next_mask:     Bitmask of the valid actions in next_state stored in the QTable
+#   done:          Game over. next_state and next_mask are unused
+TRANSITION_DTYPE = np.dtype([('state', np.int32),
+                             ('action', np.int8),
+                             ('reward', np.float32),
+                             ('next_state', np.int32),
+                             ('next_mask', np.uint32),
+                             ('done', np.bool_)])
+
 def get_num_changed(arr1, arr2):
     '''
     Get the number of cells with different values between numpy arrays
+    Either can also be a SparseTable or CompactTable
     '''
+    if isinstance(arr1, CompactTable):
+        return arr1.num_changed(arr2)
+    if isinstance(arr2, CompactTable):
+        return arr2.num_changed(arr1)
+    if isinstance(arr1, SparseTable):
+        return arr1.num_changed(arr2)
+    if isinstance(arr2, SparseTable):
+        return arr2.num_changed(arr1)
     return np.sum(arr1 != arr2)
 
 def has_converged(arr1, arr2, epsilon):
     '''
     Test if the value function has converged
     | Max difference of cells between iterations | < epsilon
+    Either can also be a SparseTable or CompactTable.
+    Also works on just the changed cells, like from QTable.get_changes
+    '''
+    if isinstance(arr1, CompactTable):
+        m = arr1.max_abs_diff(arr2)
+    elif isinstance(arr2, CompactTable):
+        m = arr2.max_abs_diff(arr1)
+    elif isinstance(arr1, SparseTable):
+        m = arr1.max_abs_diff(arr2)
+    elif isinstance(arr2, SparseTable):
+        m = arr2.max_abs_diff(arr1)
+    elif np.size(arr1) == 0:
+        m = 0.0
+    else:
+        m = np.amax(np.absolute(arr1 - arr2))
+    return m < epsilon
+
+@functools.lru_cache(maxsize=None)
+def get_decision_masks(num_actions):
+    '''
+    Valid action masks the agent can be choosing from in a QTable state,
+    over the actions stored in the QTable
+
+    The QTable state doesn't include the phase of the turn, so each state
+    holds several decisions (beginning of turn, responses, blocks).
+    The valid actions of each depend only on the agent's face up cards and coins.
+
+    num_actions: Number of actions stored in the QTable
+
+    Returns read-only bool array (4 face up, 13 coins, 13 opp coins, K, num_actions)
+    Unused slots of the K masks are all False.
+    Cached, since it is the same for every table.
+    '''
+    arrays = VALID_ACTION_ARRAYS.reshape(5, 8, 33, 4, -1)[..., :num_actions]
+    per_state = {}
+    for fu in range(4):
+        for bucket in range(8):
+            masks = arrays[:, bucket, :, fu].reshape(-1, num_actions)
+            masks = masks[masks.any(axis=1)]
+            per_state[fu, bucket] = np.unique(masks, axis=0)
+
+    k = max([len(m) for m in per_state.values()])
+    out = np.zeros((4, 13, 13, k, num_actions), dtype=bool)
+    for fu in range(4):
+        for c1 in range(13):
+            for c2 in range(13):
+                masks = per_state[fu, get_coins_bucket(c1, c2)]
+                out[fu, c1, c2, :len(masks)] = masks
+    out.flags.writeable = False
+    return out
+
+def get_greedy_actions(states, rows, shape, chunk_size=65536):
+    '''
+    Greedy action for every decision of each QTable state. See get_decision_masks.
+    Ties go to the lowest action.
+
+    states: Flat state indices (n,)
+    rows:   Action values of each state (n, num_actions)
+    shape:  Shape of the QTable
+
+    Returns int8 array (n, K), -1 for unused decision slots
     '''
-    m = np.amax(np.absolute(arr1 - arr2))
-    return m < epsilon
\ No newline at end of file
+    decision_masks = get_decision_masks(shape[-1])
+    _, _, fu, _, c1, c2 = np.unravel_index(states, shape[:-1])
+    greedy = np.empty((len(states), decision_masks.shape[3]), dtype=np.int8)
+    for start in range(0, len(states), chunk_size):
+        end = start + chunk_size
+        masks = decision_masks[fu[start:end], c1[start:end], c2[start:end]]
+        vals = np.where(masks, rows[start:end, None, :], -np.inf)
+        g = vals.argmax(axis=2)
+        g[~masks.any(axis=2)] = -1
+        greedy[start:end] = g
+    return greedy
@@ -0,0 +1,70 @@
+import json
+import logging
+import argparse
+import time
+import numpy as np
+from coup_rl.evaluate import evaluate_match, round_robin, wilson_interval
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coup RL agent evaluation\nPlay saved agents against each other with greedy play. The agents are not modified.\n2 agents: head-to-head win rate\n3+ agents: round robin with Elo ratings',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('files', nargs='+', help='Agent files to evaluate')
+    parser.add_argument('-g', '--games', type=int, default=100000, help='Number of games per pair of agents')
+    parser.add_argument('-w', '--workers', type=int, help='Number of processes. Default is the number of CPUs')
+    parser.add_argument('--num_envs', type=int, default=1024, help='Number of games each process plays at once')
+    parser.add_argument('--max_turns', type=int, default=200, help='Games still going after this many turns are a draw')
+    parser.add_argument('--seed', type=int, help='Seed to replay an evaluation exactly')
+    parser.add_argument('-o', '--output', help='Save the results to this JSON file')
+    parser.add_argument('-t', '--timer', action='store_true', help='Time the evaluation')
+    args = parser.parse_args()
+
+    if len(args.files) < 2:
+        parser.error('At least 2 agent files are needed')
+
+    logging.getLogger('coup_rl').setLevel(logging.INFO)
+    start = time.time()
+
+    if len(args.files) == 2:
+        result = evaluate_match(args.files[0], args.files[1], args.games,
+                                workers=args.workers, num_envs=args.num_envs, seed=args.seed,
+                                max_turns=args.max_turns)
+        wins = result['wins']
+        draws = result['draws']
+        games = result['games']
+        low, high = result['interval']
+        print(f'{args.files[0]} vs {args.files[1]}: {games.sum()} games')
+        print(f'Win rate: {result["win_rate"]:.4f}  95% CI [{low:.4f}, {high:.4f}]  ({draws.sum()} draws count as half a win)')
+        for seat in range(2):
+            score = wins[seat] + 0.5 * draws[seat]
+            low, high = wilson_interval(score, games[seat])
+            print(f'\tAs P{seat + 1}: {score / max(games[seat], 1):.4f}  95% CI [{low:.4f}, {high:.4f}]  ({games[seat]} games)')
+        output = {'files': args.files,
+                  'wins': wins.tolist(),
+                  'draws': draws.tolist(),
+                  'games': games.tolist(),
+                  'win_rate': result['win_rate'],
+                  'interval': list(result['interval'])}
+    else:
+        wins, elo = round_robin(args.files, args.games,
+                                workers=args.workers, num_envs=args.num_envs, seed=args.seed,
+                                max_turns=args.max_turns)
+        games = wins + wins.T
+        rates = np.divide(wins, games, out=np.full(wins.shape, np.nan), where=games > 0)
+        n = len(args.files)
+        print('Win rate of row agent against column agent')
+        print('     ' + ''.join([f'{j:>8d}' for j in range(n)]))
+        for i in range(n):
+            print(f'{i:>4d} ' + ''.join(['       -' if i == j else f'{rates[i, j]:8.4f}' for j in range(n)]))
+        print()
+        print('Rank   Elo  Agent')
+        for rank, i in enumerate(np.argsort(-elo)):
+            print(f'{rank + 1:>4d} {elo[i]:6.0f}  {i}: {args.files[i]}')
+        output = {'files': args.files,
+                  'wins': wins.tolist(),
+                  'elo': elo.tolist()}
+
+    if args.timer:
+        print(f'Total evaluation time: {time.time() - start} seconds')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
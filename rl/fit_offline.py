@@ -0,0 +1,49 @@
+import logging
+import argparse
+import time
+import numpy as np
+from coup_rl.qtable import QTable
+from coup_rl.offline import fitted_q_iteration
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+        description='Coup RL offline training\nFit a Q-table to recorded games by batch Q-iteration, without playing any.\nStarts from a new table, or fine tunes an existing agent with --base.')
+    parser.add_argument('filepath', help='File path and name for the fitted agent')
+    parser.add_argument('trajectories', nargs='+', help='Trajectory files of recorded games')
+    parser.add_argument('--base', help='Agent file to start from. State-actions not in the games keep its values')
+    parser.add_argument('--learning_rate', type=float, help='Learning Rate (0, 1] saved with the agent, for further training. Default 0.1 for a new agent')
+    parser.add_argument('--discount_factor', type=float, help='Discount Factor [0, 1). Default 0.9 for a new agent')
+    parser.add_argument('--epsilon', type=float, help='Ratio of exploration [0, 1] saved with the agent. Default 0.1 for a new agent')
+    parser.add_argument('--tol', type=float, default=1e-6, help='Stop when no Q-value changes by more than this in a sweep')
+    parser.add_argument('--max_iters', type=int, default=200, help='Max number of sweeps over the games')
+    parser.add_argument('--chunk_size', type=int, default=1 << 20, help='Number of records or transitions in memory at once')
+    parser.add_argument('--transitions', help='Keep the transitions built from the games in this file')
+    parser.add_argument('-t', '--timer', action='store_true', help='Time the entire fit')
+    args = parser.parse_args()
+
+    logging.getLogger('coup_rl').setLevel(logging.INFO)
+    start = time.time()
+
+    if args.base:
+        qtable = QTable()
+        qtable.load(args.base)
+        if args.learning_rate is not None:
+            qtable.learning_rate = args.learning_rate
+        if args.discount_factor is not None:
+            qtable.discount_factor = args.discount_factor
+        if args.epsilon is not None:
+            qtable.epsilon = args.epsilon
+    else:
+        shape = (15, 15, 4, 4, 13, 13, 26)
+        qtable = QTable(shape,
+                        0.1 if args.learning_rate is None else args.learning_rate,
+                        0.9 if args.discount_factor is None else args.discount_factor,
+                        0.1 if args.epsilon is None else args.epsilon,
+                        dtype=np.float64)
+
+    fitted_q_iteration(qtable, args.trajectories, tol=args.tol, max_iters=args.max_iters,
+                       chunk_size=args.chunk_size, transitions_file=args.transitions)
+    qtable.save(args.filepath)
+
+    if args.timer:
+        print(f'Total fit time: {time.time() - start} seconds')
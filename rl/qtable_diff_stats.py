@@ -1,24 +1,57 @@
+import os
+import csv
 import argparse
-from coup_rl.utils import get_num_changed
-from coup_rl.qtable import QTable
-import numpy as np
+from coup_rl.checkpoint_diff import DIM_NAMES, diff_saved_tables, diff_checkpoints
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('filepath1')
-    parser.add_argument('filepath2')
-    args = parser.parse_args()
+def print_stats(stats, by_dim=False):
+    print(f'Num changed: {stats["num_changed"]}')
+    print(f'Mean: {stats["mean_abs_diff"]}')
+    print(f'Max diff: {stats["max_abs_diff"]}')
+    print(f'Num nonzero in file 1: {stats["nonzero1"]}')
+    print(f'Num nonzero in file 2: {stats["nonzero2"]}')
+    print(f'Greedy actions changed: {stats["greedy_changed"]} / {stats["greedy_decisions"]}')
+    if by_dim:
+        for name in DIM_NAMES:
+            counts = stats['by_dim'][name]
+            print(f'Changed by {name}: ' + ' '.join([f'{i}:{n}' for i, n in enumerate(counts.tolist()) if n]))
 
-    qtable1 = QTable()
-    qtable1.load(args.filepath1)
-    qtable2 = QTable()
-    qtable2.load(args.filepath2)
+def get_row(stats, by_dim=False):
+    row = {k: v for k, v in stats.items() if k != 'by_dim'}
+    if by_dim:
+        for name in DIM_NAMES:
+            for i, n in enumerate(stats['by_dim'][name].tolist()):
+                row[f'{name}_{i}'] = n
+    return row
 
-    print(f'Num changed: {get_num_changed(qtable1.table, qtable2.table)}')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two saved agents, or each checkpoint in a directory to the one before it.\nThe tables are read a chunk of states at a time, so any size of table can be compared.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('filepath1', help='Agent file, or directory of checkpoints')
+    parser.add_argument('filepath2', nargs='?', help='Agent file to compare to the first')
+    parser.add_argument('--prefix', help='With a directory, only use checkpoints whose names start with this, like agent_')
+    parser.add_argument('--by_dim', action='store_true', help='Number of changed cells at each index of each dimension, like each number of coins')
+    parser.add_argument('--chunk_states', type=int, default=16384, help='Number of states to compare at once')
+    parser.add_argument('-o', '--output', help='Save a CSV row per comparison to this file')
+    args = parser.parse_args()
 
-    abs_dif = np.absolute(qtable1.table - qtable2.table)
-    print(f'Mean: {np.mean(abs_dif)}')
-    print(f'Max diff: {np.amax(abs_dif)}')
+    if os.path.isdir(args.filepath1):
+        if args.filepath2 is not None:
+            parser.error('Give 2 files, or a single directory')
+        series = diff_checkpoints(args.filepath1, args.prefix, args.chunk_states)
+        print('episode,num_changed,mean_abs_diff,max_abs_diff,nonzero,greedy_changed')
+        for ep, stats in series:
+            print(f'{ep},{stats["num_changed"]},{stats["mean_abs_diff"]},{stats["max_abs_diff"]},'
+                  f'{stats["nonzero2"]},{stats["greedy_changed"]}')
+        rows = [dict(episode=ep, **get_row(stats, args.by_dim)) for ep, stats in series]
+    else:
+        if args.filepath2 is None:
+            parser.error('Give 2 files, or a single directory')
+        stats = diff_saved_tables(args.filepath1, args.filepath2, args.chunk_states)
+        print_stats(stats, args.by_dim)
+        rows = [get_row(stats, args.by_dim)]
 
-    print(f'Num nonzero in file 1: {len(np.nonzero(qtable1.table)[0])}')
-    print(f'Num nonzero in file 2: {len(np.nonzero(qtable2.table)[0])}')
\ No newline at end of file
+    if args.output and rows:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
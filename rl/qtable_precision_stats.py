@@ -0,0 +1,48 @@
+import argparse
+from coup_rl.utils import get_greedy_actions
+from coup_rl.qtable import QTable
+import numpy as np
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare an agent to copies with lower precision Q-values')
+    parser.add_argument('filepath')
+    parser.add_argument('--dtypes', nargs='+', default=['float32', 'float16'], help='Dtypes to down-cast to')
+    args = parser.parse_args()
+
+    qtable = QTable()
+    qtable.load(args.filepath)
+    print(f'Dtype: {qtable.dtype}')
+
+    if qtable.is_sparse:
+        states, rows = qtable.table.get_states_and_rows()
+        shape = qtable.table.shape
+    elif qtable.is_compact:
+        states, rows = qtable.table.get_states_and_rows()
+        shape = qtable.table.shape
+        # Every reachable state has a row, so only visited states can have a different greedy action
+        visited = rows.any(axis=1)
+        states = states[visited]
+        rows = rows[visited]
+    else:
+        shape = qtable.table.shape
+        rows = qtable.table.reshape(-1, shape[-1])
+        # Only visited states can have a different greedy action
+        states = np.flatnonzero(rows.any(axis=1))
+        rows = rows[states]
+    print(f'Visited states: {len(states)}')
+    print(f'Size: {qtable.table.nbytes / 2**20:.1f} MB')
+
+    greedy = get_greedy_actions(states, rows, shape)
+    num_decisions = np.sum(greedy != -1)
+
+    for dtype in args.dtypes:
+        cast = rows.astype(dtype)
+        abs_dif = np.absolute(cast.astype(rows.dtype) - rows)
+        greedy_cast = get_greedy_actions(states, cast, shape)
+        num_disagree = np.sum(greedy != greedy_cast)
+
+        print(f'\n{dtype}')
+        print(f'Size: {qtable.table.nbytes * np.dtype(dtype).itemsize / rows.dtype.itemsize / 2**20:.1f} MB')
+        print(f'Max error: {np.amax(abs_dif) if abs_dif.size else 0}')
+        print(f'Mean error: {np.mean(abs_dif) if abs_dif.size else 0}')
+        print(f'Greedy actions changed: {num_disagree} / {num_decisions} ({100 * num_disagree / max(num_decisions, 1):.4f}%)')
\ No newline at end of file
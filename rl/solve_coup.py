@@ -0,0 +1,38 @@
+import os
+import logging
+import argparse
+import time
+from coup_rl.solver import StateSpace, solve_qtable
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+        description='Coup RL exact solver\nEnumerate every reachable game state and solve greedy self-play by value iteration.\nSaves a normal agent file, to play as a baseline or continue training from.')
+    parser.add_argument('filepath', help='File path and name for the solved agent')
+    parser.add_argument('--learning_rate', type=float, default=0.1, help='Learning Rate (0, 1] saved with the agent, for further training')
+    parser.add_argument('--discount_factor', type=float, default=0.9, help='Discount Factor [0, 1)')
+    parser.add_argument('--epsilon', type=float, default=0.1, help='Ratio of exploration [0, 1]. Also used to weight how often each game state is seen')
+    parser.add_argument('--states', help='Load the enumerated game states from this .npz file, or save them there if it does not exist')
+    parser.add_argument('--tol', type=float, default=1e-8, help='Stop value iteration when no value changes by more than this')
+    parser.add_argument('--max_iters', type=int, default=1000, help='Max number of value iterations')
+    parser.add_argument('--policy_iters', type=int, default=100, help='Number of value iterations the chosen actions can change for, before fixing them')
+    parser.add_argument('-t', '--timer', action='store_true', help='Time the entire solve')
+    args = parser.parse_args()
+
+    logging.getLogger('coup_rl').setLevel(logging.INFO)
+    start = time.time()
+
+    space = StateSpace()
+    if args.states and os.path.exists(args.states):
+        space.load(args.states)
+    else:
+        space.enumerate()
+        if args.states:
+            space.save(args.states)
+
+    qtable = solve_qtable(args.learning_rate, args.discount_factor, args.epsilon,
+                          space=space, tol=args.tol, max_iters=args.max_iters,
+                          policy_iters=args.policy_iters)
+    qtable.save(args.filepath)
+
+    if args.timer:
+        print(f'Total solve time: {time.time() - start} seconds')
@@ -1,7 +1,7 @@
 import logging
 import argparse
 import time
-from coup_rl import SelfPlay
+from coup_rl import SelfPlay, ParallelSelfPlay, ActorLearner, BatchSelfPlay
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
@@ -15,15 +15,110 @@ if __name__ == '__main__':
     parser.add_argument('--epsilon', type=float, help='Ratio of exploration [0, 1]')
     parser.add_argument('-d', '--debug', action='store_true', help='Log at the debug level')
     parser.add_argument('-t', '--timer', action='store_true', help='Time the entire training session')
+    parser.add_argument('-s', '--sparse', action='store_true', help='Store the Q-table sparsely, only allocating visited states')
+    parser.add_argument('--compact', action='store_true', help='Store only the reachable states of the Q-table, less than half the memory of the full table')
+    parser.add_argument('--dtype', choices=['float64', 'float32', 'float16'], help='Precision of the Q-values. Default float64 for a new agent')
+    parser.add_argument('--full_checkpoint', type=int, default=10, help='Save a full Q-table every this many checkpoints, and only the changed Q-values at the others. 1 for always full')
+    parser.add_argument('--metrics_file', help='Write training metrics to this .csv or .jsonl file')
+    parser.add_argument('--metrics_interval', type=int, help='Number of episodes between training metrics. Default 1000 with --metrics_file')
+    parser.add_argument('--seed', type=int, help='Seed to replay a training run exactly. Default is fresh entropy')
+    parser.add_argument('--headless', action='store_true', help='Never render games, even when debugging')
+    parser.add_argument('--replay', type=int, help='Learn from a replay buffer of this many transitions, in minibatches, instead of updating after every step')
+    parser.add_argument('--replay_batch_size', type=int, default=256, help='With --replay, number of transitions in each minibatch')
+    parser.add_argument('--replay_ratio', type=float, default=4.0, help='With --replay, number of transitions replayed for each new one')
+    parser.add_argument('--search_time', type=float, help='Seconds for P2 to search each move with ISMCTS, using the Q-table as its prior. Only P1 learns')
+    parser.add_argument('--search_workers', type=int, default=1, help='With --search_time, number of processes P2 searches each move with. Needs a dense Q-table')
+    parser.add_argument('--record', help='Append every game to this trajectory file')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes playing games in parallel on a shared Q-table')
+    parser.add_argument('--chunk', type=int, default=100, help='With multiple workers, max number of episodes a worker runs before reporting back')
+    parser.add_argument('-a', '--actors', type=int, default=0, help='Number of actor processes generating games for a single learner process')
+    parser.add_argument('--batch_size', type=int, default=4096, help='With actors, min number of transitions an actor sends to the learner at once')
+    parser.add_argument('--sync_interval', type=int, default=10, help='With actors, number of batches the learner applies between sending the actors a new Q-table')
+    parser.add_argument('-b', '--batch_envs', type=int, default=0, help='Number of games to play at once in a single process, updating the Q-table from all of them every step')
     args = parser.parse_args()
 
     log_level = logging.DEBUG if args.debug else logging.INFO
 
-    sp = SelfPlay(args.filepath,
-                  learning_rate=args.learning_rate,
-                  discount_factor=args.discount_factor,
-                  epsilon=args.epsilon,
-                  log_level=log_level)
+    if (args.metrics_file or args.metrics_interval) and (args.actors > 0 or args.workers > 1):
+        parser.error('Training metrics are only collected with a single process')
+    if args.compact and (args.actors > 0 or args.workers > 1):
+        parser.error('--compact is only used with a single process')
+    if args.replay and (args.actors > 0 or args.workers > 1):
+        parser.error('--replay is only used with a single process')
+    if args.record and (args.actors > 0 or args.workers > 1):
+        parser.error('--record is only used with a single process')
+    if args.search_time is not None and (args.actors > 0 or args.workers > 1):
+        parser.error('--search_time is only used with a single process')
+    if args.search_workers > 1 and (args.search_time is None or args.sparse or args.compact):
+        parser.error('--search_workers is only used with --search_time and a dense Q-table')
+    if args.batch_envs > 0:
+        if args.actors > 0 or args.workers > 1:
+            parser.error('--batch_envs is only used with a single process')
+        if (args.metrics_file or args.metrics_interval or args.replay or args.record or
+            args.search_time is not None):
+            parser.error('--batch_envs cannot be used with metrics, --replay, --record or --search_time')
+    if args.compact and args.sparse:
+        parser.error('--compact and --sparse cannot be used together')
+
+    if args.batch_envs > 0:
+        sp = BatchSelfPlay(args.filepath,
+                           learning_rate=args.learning_rate,
+                           discount_factor=args.discount_factor,
+                           epsilon=args.epsilon,
+                           log_level=log_level,
+                           sparse=args.sparse,
+                           dtype=args.dtype,
+                           full_checkpoint=args.full_checkpoint,
+                           compact=args.compact,
+                           num_envs=args.batch_envs,
+                           seed=args.seed)
+    elif args.actors > 0:
+        if args.workers > 1:
+            parser.error('--workers and --actors cannot be used together')
+        sp = ActorLearner(args.filepath,
+                          learning_rate=args.learning_rate,
+                          discount_factor=args.discount_factor,
+                          epsilon=args.epsilon,
+                          log_level=log_level,
+                          sparse=args.sparse,
+                          dtype=args.dtype,
+                          full_checkpoint=args.full_checkpoint,
+                          actors=args.actors,
+                          batch_size=args.batch_size,
+                          sync_interval=args.sync_interval,
+                          seed=args.seed)
+    elif args.workers > 1:
+        if args.sparse:
+            parser.error('--sparse cannot be used with multiple workers')
+        sp = ParallelSelfPlay(args.filepath,
+                              learning_rate=args.learning_rate,
+                              discount_factor=args.discount_factor,
+                              epsilon=args.epsilon,
+                              log_level=log_level,
+                              dtype=args.dtype,
+                              workers=args.workers,
+                              chunk=args.chunk,
+                              seed=args.seed)
+    else:
+        sp = SelfPlay(args.filepath,
+                      learning_rate=args.learning_rate,
+                      discount_factor=args.discount_factor,
+                      epsilon=args.epsilon,
+                      log_level=log_level,
+                      sparse=args.sparse,
+                      dtype=args.dtype,
+                      full_checkpoint=args.full_checkpoint,
+                      metrics_file=args.metrics_file,
+                      metrics_interval=args.metrics_interval,
+                      seed=args.seed,
+                      headless=args.headless,
+                      compact=args.compact,
+                      replay_capacity=args.replay,
+                      replay_batch_size=args.replay_batch_size,
+                      replay_ratio=args.replay_ratio,
+                      search_time=args.search_time,
+                      search_workers=args.search_workers,
+                      record_file=args.record)
 
     if args.timer:
         start = time.time()